@@ -1,15 +1,85 @@
 from flask import Flask, jsonify
+import os
 from flask_cors import CORS
 from flask_migrate import Migrate
 from datetime import datetime
 from models import db
 from routes.auth import auth_bp
-from routes.stripe import stripe_bp
+from routes.stripe import stripe_bp, stripe_http_client, stripe_guard, plan_catalog, webhook_queue
+from services.hashing import password_hasher, normalize_hash_method, DEFAULT_HASH_METHOD
+from services.user_cache import user_cache
+from services.thumbnails import thumbnail_pipeline
+from services.uploads import file_remover
+from services.availability import identity_index
+from services.subscription_cache import subscription_cache
+from services.webhook_idempotency import processed_events
+from services.webhook_coalescing import webhook_coalescer
+from services.customer_provisioning import customer_provisioner
+from services.verified_sessions import verified_sessions
 
 app = Flask(__name__)
 app.secret_key = 'secret-key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///exchange.db'
+# Relative SQLite paths live in the instance folder; tests point this at a scratch database
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///exchange.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Password hashing runs on a process pool so bursts of logins can't starve cheap endpoints
+app.config['PASSWORD_HASH_POOL_SIZE'] = int(os.getenv('PASSWORD_HASH_POOL_SIZE', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.getenv('PASSWORD_HASH_QUEUE_SIZE', 16))
+app.config['PASSWORD_HASH_RETRY_AFTER'] = 1  # seconds
+# Werkzeug method string, e.g. 'pbkdf2:sha256:600000' or 'scrypt:32768:8:1'; existing
+# hashes are upgraded on the next successful login. Tune with `flask auth benchmark-hashing`.
+# Short forms such as 'scrypt' are expanded to match the prefix stored in hashes.
+app.config['PASSWORD_HASH_METHOD'] = normalize_hash_method(os.getenv('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD))
+# Serialized users served to /api/check and /api/user
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = 30  # seconds
+# Bloom filters of taken usernames/emails, sized for this many users at a 1% false-positive rate
+app.config['IDENTITY_FILTER_CAPACITY'] = int(os.getenv('IDENTITY_FILTER_CAPACITY', 100000))
+app.config['IDENTITY_FILTER_ERROR_RATE'] = 0.01
+# A background thread warms the filters at startup and refreshes them; 0 refreshes inline on requests
+app.config['IDENTITY_FILTER_WORKERS'] = 1
+# Users registered by other processes are merged in this often; full rebuilds pick up changed emails
+app.config['IDENTITY_FILTER_MERGE_INTERVAL'] = 5  # seconds
+app.config['IDENTITY_FILTER_REBUILD_INTERVAL'] = 600  # seconds
+# Stripe subscriptions are cached between webhook-driven updates
+app.config['SUBSCRIPTION_CACHE_TTL'] = int(os.getenv('SUBSCRIPTION_CACHE_TTL', 60))
+# Plan catalog is re-read this often; clients and proxies may reuse responses for the max-age
+app.config['PLAN_CATALOG_TTL'] = int(os.getenv('PLAN_CATALOG_TTL', 60))
+app.config['PLAN_CATALOG_MAX_AGE'] = 60  # seconds
+app.config['STRIPE_CONFIG_MAX_AGE'] = 300  # seconds
+# /payment-history and /subscriptions are paginated with ?limit=&after=<cursor>
+app.config['HISTORY_PAGE_SIZE'] = 50
+app.config['HISTORY_MAX_PAGE_SIZE'] = 100
+# Checkout sessions already verified are answered without calling Stripe
+app.config['VERIFIED_SESSION_CACHE_SIZE'] = 10000
+# Stripe customers are created in the background at registration, not at first checkout
+app.config['STRIPE_CUSTOMER_PREPROVISION'] = os.getenv('STRIPE_CUSTOMER_PREPROVISION', 'true').lower() == 'true'
+app.config['STRIPE_CUSTOMER_WORKERS'] = int(os.getenv('STRIPE_CUSTOMER_WORKERS', 2))
+app.config['STRIPE_CUSTOMER_WAIT_TIMEOUT'] = 10  # seconds checkout waits for an in-flight creation
+# Webhooks are acknowledged once stored and processed by background workers
+app.config['WEBHOOK_WORKERS'] = int(os.getenv('WEBHOOK_WORKERS', 2))
+app.config['WEBHOOK_POLL_INTERVAL'] = 1  # seconds
+app.config['WEBHOOK_LEASE_SECONDS'] = 300
+# Subscription events are held this long so a burst for one subscription is applied as one update
+app.config['WEBHOOK_COALESCE_WINDOW'] = float(os.getenv('WEBHOOK_COALESCE_WINDOW', 2))
+# Take membership status and periods from webhook payloads instead of asking Stripe
+app.config['WEBHOOK_STATE_FROM_PAYLOAD'] = os.getenv('WEBHOOK_STATE_FROM_PAYLOAD', 'true').lower() == 'true'
+# Failed events retry with jittered exponential backoff, then move to webhook_dead_letters
+app.config['WEBHOOK_MAX_ATTEMPTS'] = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+app.config['WEBHOOK_RETRY_BASE_DELAY'] = 2  # seconds
+app.config['WEBHOOK_RETRY_MAX_DELAY'] = 3600
+# Processed event ids are kept long enough to cover Stripe's redelivery window
+app.config['WEBHOOK_DEDUP_RETENTION_DAYS'] = int(os.getenv('WEBHOOK_DEDUP_RETENTION_DAYS', 30))
+app.config['WEBHOOK_DEDUP_MEMORY_SIZE'] = 10000
+app.config['WEBHOOK_DEDUP_PRUNE_INTERVAL'] = 3600  # seconds
+# Profile picture uploads larger than this are rejected while streaming
+app.config['PROFILE_PICTURE_MAX_BYTES'] = int(os.getenv('PROFILE_PICTURE_MAX_BYTES', 5 * 1024 * 1024))
+app.config['THUMBNAIL_WORKERS'] = int(os.getenv('THUMBNAIL_WORKERS', 2))
+app.config['UPLOAD_CLEANUP_WORKERS'] = 1
+# Hand profile picture transfers to the front proxy: None, 'x-accel-redirect' (nginx) or 'x-sendfile'
+app.config['PROFILE_PICTURE_OFFLOAD'] = os.getenv('PROFILE_PICTURE_OFFLOAD')
+# nginx `internal` location aliased to the upload folder
+app.config['PROFILE_PICTURE_INTERNAL_PREFIX'] = os.getenv('PROFILE_PICTURE_INTERNAL_PREFIX', '/protected/profile_pictures/')
 CORS(app, supports_credentials=True, origins=['http://localhost:3000'])
 
 # Initialize SQLAlchemy and Flask-Migrate
@@ -25,5 +95,25 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()}), 200
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Internal counters for capacity planning"""
+    return jsonify({
+        'password_hashing': password_hasher.stats(),
+        'user_cache': user_cache.stats(),
+        'thumbnails': thumbnail_pipeline.stats(),
+        'upload_cleanup': file_remover.stats(),
+        'identity_index': identity_index.stats(),
+        'stripe_http': stripe_http_client.stats(),
+        'stripe_guard': stripe_guard.stats(),
+        'subscription_cache': subscription_cache.stats(),
+        'verified_sessions': verified_sessions.stats(),
+        'plan_catalog': plan_catalog.stats(),
+        'webhook_queue': webhook_queue.stats(),
+        'webhook_dedup': processed_events.stats(),
+        'webhook_coalescing': webhook_coalescer.stats(),
+        'stripe_customers': customer_provisioner.stats()
+    }), 200
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000) 
\ No newline at end of file
@@ -12,7 +12,7 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
-    stripe_customer_id = db.Column(db.String(255), nullable=True)
+    stripe_customer_id = db.Column(db.String(255), nullable=True, index=True)
     profile_picture = db.Column(db.String(255), nullable=True)  # Store filename/path
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -34,6 +34,10 @@ class User(db.Model):
 
 class Membership(db.Model):
     __tablename__ = 'memberships'
+    __table_args__ = (
+        # Serves a user's memberships newest first, including keyset pages
+        db.Index('ix_memberships_user_id_created_at', 'user_id', db.desc('created_at'), 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -42,6 +46,7 @@ class Membership(db.Model):
     status = db.Column(db.String(50), nullable=False)
     current_period_start = db.Column(db.DateTime, nullable=True)
     current_period_end = db.Column(db.DateTime, nullable=True)
+    stripe_event_created = db.Column(db.Integer, nullable=True)  # `created` of the newest webhook applied
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -66,10 +71,14 @@ class Membership(db.Model):
 
 class PaymentHistory(db.Model):
     __tablename__ = 'payment_history'
+    __table_args__ = (
+        # Serves a user's payments newest first, including keyset pages
+        db.Index('ix_payment_history_user_id_created_at', 'user_id', db.desc('created_at'), 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    stripe_payment_intent_id = db.Column(db.String(255), nullable=True)
+    stripe_payment_intent_id = db.Column(db.String(255), nullable=True, index=True)
     amount = db.Column(db.Integer, nullable=False)  # Amount in cents
     currency = db.Column(db.String(3), nullable=False)
     status = db.Column(db.String(50), nullable=False)
@@ -90,4 +99,95 @@ class PaymentHistory(db.Model):
             'currency': self.currency,
             'status': self.status,
             'created_at': self.created_at.isoformat() if self.created_at else None
-        } 
\ No newline at end of file
+        } 
+
+# Stored profile pictures, shared by every user who uploaded the same content
+class ProfilePictureFile(db.Model):
+    __tablename__ = 'profile_picture_files'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), unique=True, nullable=False)  # <sha256>.<ext>
+    size = db.Column(db.Integer, nullable=False)  # Bytes
+    ref_count = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ProfilePictureFile {self.filename} x{self.ref_count}>'
+
+# Stripe webhooks waiting to be processed by a queue worker
+class WebhookEvent(db.Model):
+    __tablename__ = 'webhook_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    stripe_event_id = db.Column(db.String(255), nullable=True)
+    event_type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # Raw JSON body as received
+    group_key = db.Column(db.String(255), nullable=True, index=True)  # Events sharing a key are processed together
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    locked_until = db.Column(db.DateTime, nullable=True)  # Lease held by the worker processing it
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<WebhookEvent {self.event_type} attempts={self.attempts}>'
+
+# Stripe webhooks that kept failing and need manual attention
+class WebhookDeadLetter(db.Model):
+    __tablename__ = 'webhook_dead_letters'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    stripe_event_id = db.Column(db.String(255), nullable=True)
+    event_type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, nullable=True)
+    failed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<WebhookDeadLetter {self.event_type}>'
+
+# Stripe event ids already applied, so redeliveries are acknowledged without side effects
+class ProcessedWebhookEvent(db.Model):
+    __tablename__ = 'processed_webhook_events'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    stripe_event_id = db.Column(db.String(255), unique=True, nullable=False)
+    event_type = db.Column(db.String(100), nullable=True)
+    processed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<ProcessedWebhookEvent {self.stripe_event_id}>'
+
+# Membership plans synced from Stripe Prices and served by /membership/plans
+class MembershipPlan(db.Model):
+    __tablename__ = 'membership_plans'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    plan_id = db.Column(db.String(50), unique=True, nullable=False)  # Price lookup key, stored as Membership.plan_type
+    name = db.Column(db.String(255), nullable=False)
+    stripe_price_id = db.Column(db.String(255), nullable=False, index=True)
+    stripe_product_id = db.Column(db.String(255), nullable=True)
+    price = db.Column(db.Integer, nullable=False)  # Amount in cents
+    currency = db.Column(db.String(3), nullable=False)
+    interval = db.Column(db.String(20), nullable=True)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<MembershipPlan {self.plan_id} {self.stripe_price_id}>'
+
+# Each user's current membership, kept in step with memberships so status checks are one lookup
+class CurrentMembership(db.Model):
+    __tablename__ = 'current_memberships'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    membership_id = db.Column(db.Integer, db.ForeignKey('memberships.id'), nullable=False)
+    plan_type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+    current_period_end = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CurrentMembership user={self.user_id} {self.plan_type} - {self.status}>'
@@ -1,15 +1,31 @@
-from flask import Blueprint, request, jsonify, session, send_from_directory
+from flask import Blueprint, request, jsonify, session, send_from_directory, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from sqlalchemy.exc import IntegrityError
 import sys
 import os
-import uuid
+import mimetypes
+import click
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from models import db, User
+from services.hashing import password_hasher, HashingOverloaded, needs_rehash, benchmark
+from services.user_cache import user_cache, get_user_payload
+from services.availability import identity_index
+from services.uploads import (
+    UploadRejected, parse_streamed_upload, store_upload, ensure_stored, acquire_file, release_file,
+    shard_directory, locate_stored_file, file_remover, reconcile_uploads
+)
+from services.thumbnails import thumbnail_pipeline, nearest_variant, variant_filenames
+from services.customer_provisioning import customer_provisioner
 
 auth_bp = Blueprint('auth', __name__)
 
+def hashing_overloaded_response(error):
+    """Build a 503 response telling the client when to retry"""
+    response = jsonify({'error': 'Server is busy, please try again shortly'})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
 @auth_bp.route('/register', methods=['POST'])
 def register():
     """Register a new user"""
@@ -31,8 +47,13 @@ def register():
         if len(password) < 6:
             return jsonify({'error': 'Password must be at least 6 characters long'}), 400
         
+        # Fail fast on taken names before paying for a password hash
+        if identity_index.is_taken('username', username) or identity_index.is_taken('email', email):
+            return jsonify({'error': 'Username or email already exists'}), 409
+        
         # Hash the password
-        password_hash = generate_password_hash(password)
+        password_hash = password_hasher.run('hash', generate_password_hash, password,
+                                            current_app.config['PASSWORD_HASH_METHOD'])
         
         # Create new user
         try:
@@ -44,6 +65,9 @@ def register():
             
             db.session.add(new_user)
             db.session.commit()
+            identity_index.add(username=username, email=email)
+            # Have the Stripe customer ready before the first checkout
+            customer_provisioner.submit(new_user.id)
             
             # Set session
             session['user_id'] = new_user.id
@@ -58,10 +82,34 @@ def register():
             db.session.rollback()
             return jsonify({'error': 'Username or email already exists'}), 409
             
+    except HashingOverloaded as e:
+        return hashing_overloaded_response(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@auth_bp.before_app_request
+def start_identity_filters():
+    """Warm the username/email filters off the request path once this process serves"""
+    identity_index.start(current_app._get_current_object())
+
+@auth_bp.route('/register/availability', methods=['GET'])
+def register_availability():
+    """Check whether a username and/or email can still be registered"""
+    username = request.args.get('username')
+    email = request.args.get('email')
+    
+    if not username and not email:
+        return jsonify({'error': 'Username or email is required'}), 400
+    
+    result = {}
+    if username:
+        result['username'] = {'value': username, 'available': not identity_index.is_taken('username', username)}
+    if email:
+        result['email'] = {'value': email, 'available': not identity_index.is_taken('email', email)}
+    
+    return jsonify(result), 200
+
 @auth_bp.route('/login', methods=['POST'])
 def login():
     """Login user"""
@@ -76,7 +124,17 @@ def login():
         # Find user by username
         user = User.query.filter_by(username=username).first()
         
-        if user and check_password_hash(user.password_hash, password):
+        if user and password_hasher.run('verify', check_password_hash, user.password_hash, password):
+            # Upgrade hashes made with older parameters while we know the password
+            method = current_app.config['PASSWORD_HASH_METHOD']
+            if needs_rehash(user.password_hash, method):
+                try:
+                    user.password_hash = password_hasher.run('rehash', generate_password_hash, password, method)
+                    db.session.commit()
+                except HashingOverloaded:
+                    # Not worth failing a login over; try again next time
+                    pass
+            
             # Set session
             session['user_id'] = user.id
             session['username'] = user.username
@@ -88,6 +146,8 @@ def login():
         else:
             return jsonify({'error': 'Invalid username or password'}), 401
             
+    except HashingOverloaded as e:
+        return hashing_overloaded_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -101,11 +161,11 @@ def logout():
 def check_auth():
     """Check if user is authenticated"""
     if 'user_id' in session:
-        user = db.session.get(User, session['user_id'])
+        user = get_user_payload(session['user_id'])
         if user:
             return jsonify({
                 'authenticated': True,
-                'user': user.to_dict()
+                'user': user
             }), 200
     
     return jsonify({'authenticated': False}), 200
@@ -116,16 +176,19 @@ def user_profile():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = db.session.get(User, session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     if request.method == 'GET':
+        user = get_user_payload(session['user_id'])
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
         return jsonify({
-            'user': user.to_dict()
+            'user': user
         }), 200
     
-    elif request.method == 'PUT':
+    user = db.session.get(User, session['user_id'])
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    if request.method == 'PUT':
         try:
             data = request.get_json()
             if not data:
@@ -152,6 +215,8 @@ def user_profile():
                 user.last_name = data['last_name']
             
             db.session.commit()
+            user_cache.set(user.id, user.to_dict())
+            identity_index.add(email=user.email)
             
             return jsonify({
                 'message': 'Profile updated successfully',
@@ -165,10 +230,21 @@ def user_profile():
 # Profile picture configuration
 UPLOAD_FOLDER = 'uploads/profile_pictures'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# Room for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD = 16 * 1024
+# Stored pictures are never modified in place, so clients may cache them forever
+PROFILE_PICTURE_MAX_AGE = 365 * 24 * 60 * 60
+# Used while a requested variant is still being generated
+PROFILE_PICTURE_FALLBACK_MAX_AGE = 60
+
+def get_upload_path():
+    """Absolute path of the profile picture directory"""
+    return current_app.config.get('UPLOAD_FOLDER') or \
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), UPLOAD_FOLDER)
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def remove_stored_file(upload_path, filename):
+    """Queue a picture and its variants for deletion in the background"""
+    file_remover.submit(upload_path, filename, variant_filenames(filename))
 
 @auth_bp.route('/upload-profile-picture', methods=['POST'])
 def upload_profile_picture():
@@ -176,58 +252,125 @@ def upload_profile_picture():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
+    # Reject oversized uploads before reading any of the body
+    max_bytes = current_app.config['PROFILE_PICTURE_MAX_BYTES']
+    if request.content_length and request.content_length > max_bytes + MULTIPART_OVERHEAD:
+        return jsonify({'error': 'File is too large'}), 413
+    
+    # Create uploads directory if it doesn't exist
+    upload_path = get_upload_path()
+    os.makedirs(upload_path, exist_ok=True)
+    
+    streams = []
     try:
-        if 'file' not in request.files:
+        # File parts are hashed and checked while they stream to disk
+        try:
+            files, streams = parse_streamed_upload(request, upload_path, max_bytes, ALLOWED_EXTENSIONS)
+        except UploadRejected as e:
+            return jsonify({'error': e.message}), e.status_code
+        
+        if 'file' not in files:
             return jsonify({'error': 'No file provided'}), 400
         
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        if file and allowed_file(file.filename):
-            # Create uploads directory if it doesn't exist
-            upload_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), UPLOAD_FOLDER)
-            os.makedirs(upload_path, exist_ok=True)
+        try:
+            # Store under the content hash so identical images share one file
+            filename = store_upload(file.stream, upload_path)
+        except UploadRejected as e:
+            return jsonify({'error': e.message}), e.status_code
+        
+        # Update user profile picture in database
+        user = db.session.get(User, session['user_id'])
+        if user:
+            acquire_file(filename, file.stream.size)
             
-            # Generate unique filename
-            file_extension = file.filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"{uuid.uuid4()}.{file_extension}"
-            file_path = os.path.join(upload_path, unique_filename)
+            # Release the old profile picture if exists
+            old_filename = user.profile_picture
+            remove_old_file = old_filename and release_file(old_filename)
             
-            # Save file
-            file.save(file_path)
+            user.profile_picture = filename
+            db.session.commit()
+            user_cache.invalidate(user.id)
+            # A cleanup of the same content may have deleted the file before we committed
+            ensure_stored(file.stream, upload_path, filename)
+            
+            if remove_old_file:
+                remove_stored_file(upload_path, old_filename)
+            
+            # Resized variants are generated in the background
+            thumbnail_pipeline.submit(shard_directory(upload_path, filename), filename)
             
-            # Update user profile picture in database
-            user = db.session.get(User, session['user_id'])
-            if user:
-                # Delete old profile picture if exists
-                if user.profile_picture:
-                    old_file_path = os.path.join(upload_path, user.profile_picture)
-                    if os.path.exists(old_file_path):
-                        os.remove(old_file_path)
-                
-                user.profile_picture = unique_filename
-                db.session.commit()
-                
-                return jsonify({
-                    'message': 'Profile picture uploaded successfully',
-                    'profile_picture': unique_filename
-                }), 200
-            else:
-                return jsonify({'error': 'User not found'}), 404
+            return jsonify({
+                'message': 'Profile picture uploaded successfully',
+                'profile_picture': filename
+            }), 200
         else:
-            return jsonify({'error': 'Invalid file type. Only PNG, JPG, JPEG, and GIF are allowed'}), 400
+            return jsonify({'error': 'User not found'}), 404
             
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    finally:
+        for stream in streams:
+            stream.discard()
+
+def send_profile_picture(upload_path, filename, immutable=True):
+    """Send a stored picture with a strong ETag, caching headers and Range support"""
+    # Names are derived from the content, so the stem is a strong validator
+    etag = filename.rsplit('.', 1)[0]
+    max_age = PROFILE_PICTURE_MAX_AGE if immutable else PROFILE_PICTURE_FALLBACK_MAX_AGE
+    
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        # Any cached copy of an immutable picture is still current
+        not_modified = request.if_modified_since is not None
+    
+    offload = current_app.config.get('PROFILE_PICTURE_OFFLOAD')
+    directory, relative_path = locate_stored_file(upload_path, filename)
+    if immutable and not_modified:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+    elif offload:
+        # The front proxy streams the file; the worker only sends headers
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        if offload == 'x-accel-redirect':
+            prefix = current_app.config['PROFILE_PICTURE_INTERNAL_PREFIX'].rstrip('/')
+            response.headers['X-Accel-Redirect'] = f"{prefix}/{relative_path}"
+        elif offload == 'x-sendfile':
+            response.headers['X-Sendfile'] = os.path.join(directory, filename)
+        else:
+            raise ValueError(f"Unknown PROFILE_PICTURE_OFFLOAD mode: {offload}")
+        response.set_etag(etag)
+    else:
+        response = send_from_directory(directory, filename,
+                                       etag=etag, max_age=max_age)
+    
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = immutable
+    return response
 
 @auth_bp.route('/profile-picture/<filename>', methods=['GET'])
 def get_profile_picture(filename):
-    """Serve profile picture"""
+    """Serve profile picture, or its nearest resized variant when ?size= is given"""
+    if filename != secure_filename(filename):
+        return jsonify({'error': 'File not found'}), 404
+    
     try:
-        upload_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), UPLOAD_FOLDER)
-        return send_from_directory(upload_path, filename)
+        upload_path = get_upload_path()
+        size = request.args.get('size', type=int)
+        if size:
+            variant = nearest_variant(filename, size)
+            # Fall back to the original until the variant has been generated
+            if variant and os.path.exists(os.path.join(locate_stored_file(upload_path, variant)[0], variant)):
+                return send_profile_picture(upload_path, variant)
+            # Don't let clients pin the original under a variant URL
+            return send_profile_picture(upload_path, filename, immutable=variant is None)
+        return send_profile_picture(upload_path, filename)
     except Exception as e:
         return jsonify({'error': 'File not found'}), 404
 
@@ -240,15 +383,17 @@ def delete_profile_picture():
     try:
         user = db.session.get(User, session['user_id'])
         if user and user.profile_picture:
-            # Delete file from filesystem
-            upload_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), UPLOAD_FOLDER)
-            file_path = os.path.join(upload_path, user.profile_picture)
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            old_filename = user.profile_picture
+            remove_old_file = release_file(old_filename)
             
             # Remove from database
             user.profile_picture = None
             db.session.commit()
+            user_cache.invalidate(user.id)
+            
+            # Delete file from filesystem once nothing references it
+            if remove_old_file:
+                remove_stored_file(get_upload_path(), old_filename)
             
             return jsonify({'message': 'Profile picture deleted successfully'}), 200
         else:
@@ -256,4 +401,40 @@ def delete_profile_picture():
             
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': str(e)}), 500 
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@auth_bp.cli.command('reconcile-uploads')
+@click.option('--dry-run', is_flag=True, help='Report orphans without deleting anything')
+@click.option('--grace-seconds', default=3600, show_default=True,
+              help='Skip files newer than this so in-flight uploads survive')
+def reconcile_uploads_command(dry_run, grace_seconds):
+    """Delete orphaned profile pictures and repair reference counts"""
+    report = reconcile_uploads(get_upload_path(), variant_filenames, dry_run=dry_run,
+                               grace_seconds=grace_seconds)
+    verb = 'Would remove' if dry_run else 'Removed'
+    click.echo(f"{verb} {len(report['orphans'])} orphaned files ({report['bytes_freed']} bytes)")
+    click.echo(f"Moved {report['resharded']} files into sharded directories")
+    click.echo(f"Fixed {report['counts_fixed']} reference counts")
+
+@auth_bp.cli.command('benchmark-hashing')
+@click.option('--method', 'methods', multiple=True,
+              help='Werkzeug hash method to measure; repeatable (default: a range of settings)')
+@click.option('--rounds', default=200, show_default=True, help='Logins to simulate per method')
+@click.option('--concurrency', default=16, show_default=True, help='Simultaneous login requests')
+@click.option('--pool-size', default=os.cpu_count() or 1, show_default=True, help='Hashing processes')
+def benchmark_hashing_command(methods, rounds, concurrency, pool_size):
+    """Measure hashes/sec and login latency for password hash settings"""
+    methods = methods or (
+        'pbkdf2:sha256:600000',
+        'pbkdf2:sha256:300000',
+        'pbkdf2:sha256:100000',
+        'scrypt:32768:8:1',
+        'scrypt:16384:8:1',
+    )
+    current = current_app.config['PASSWORD_HASH_METHOD']
+    click.echo(f"{'method':<28}{'hashes/sec':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for method in methods:
+        result = benchmark(method, rounds, concurrency, pool_size)
+        marker = ' (current)' if method == current else ''
+        click.echo(f"{method:<28}{result['hashes_per_second']:>12.1f}"
+                   f"{result['p50_seconds'] * 1000:>10.1f}{result['p99_seconds'] * 1000:>10.1f}{marker}")
\ No newline at end of file
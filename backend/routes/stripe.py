@@ -1,10 +1,29 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, current_app
 import stripe
 import os
-from datetime import datetime
+import json
+import time
+import hashlib
+import click
+from datetime import datetime, timezone
+from sqlalchemy.exc import IntegrityError
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from models import db, User, Membership, PaymentHistory
+from models import db, User, Membership, CurrentMembership, PaymentHistory
+from services.stripe_client import PooledStripeClient
+from services.stripe_guard import StripeGuard, StripeUnavailable
+from services.subscription_cache import subscription_cache
+from services.webhook_queue import WebhookQueue
+from services.webhook_idempotency import processed_events
+from services.webhook_coalescing import webhook_coalescer, subscription_key
+from services.stripe_sync import sync_subscriptions, membership_status
+from services.payment_backfill import backfill_payments, time_windows
+from services.customer_provisioning import customer_provisioner
+from services.verified_sessions import verified_sessions
+from services.plan_catalog import PlanCatalog, sync_plan_catalog
+from services.current_membership import refresh_current_memberships, repair_current_memberships
+from services.pagination import keyset_page
+from services.exports import EXPORTS, FORMATS, export_chunks
 from dotenv import load_dotenv
 
 stripe_bp = Blueprint('stripe', __name__)
@@ -22,7 +41,31 @@ if not STRIPE_PUBLISHABLE_KEY:
 
 stripe.api_key = STRIPE_SECRET_KEY
 
-# Membership plans
+# Every Stripe call shares a deadline per request, a cap on concurrent calls and
+# a circuit breaker, so a slow or failing Stripe turns into fast 503s instead of
+# tying up every worker thread.
+stripe_guard = StripeGuard(
+    max_concurrent=int(os.getenv('STRIPE_MAX_CONCURRENT_CALLS', 8)),
+    bulkhead_wait=float(os.getenv('STRIPE_BULKHEAD_WAIT', 0.05)),
+    deadline=float(os.getenv('STRIPE_CALL_DEADLINE', 10)),
+    failure_threshold=int(os.getenv('STRIPE_BREAKER_THRESHOLD', 5)),
+    reset_timeout=float(os.getenv('STRIPE_BREAKER_RESET', 30))
+)
+
+# One keep-alive connection pool per worker process for every Stripe call.
+# Failed connections and timeouts are retried by the SDK with jittered backoff.
+stripe_http_client = PooledStripeClient(
+    pool_size=int(os.getenv('STRIPE_HTTP_POOL_SIZE', 10)),
+    connect_timeout=float(os.getenv('STRIPE_CONNECT_TIMEOUT', 5)),
+    read_timeout=float(os.getenv('STRIPE_READ_TIMEOUT', 30)),
+    retry_initial_delay=float(os.getenv('STRIPE_RETRY_INITIAL_DELAY', 0.5)),
+    retry_max_delay=float(os.getenv('STRIPE_RETRY_MAX_DELAY', 2)),
+    guard=stripe_guard
+)
+stripe.default_http_client = stripe_http_client
+stripe.max_network_retries = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+
+# Membership plans offered until `flask stripe sync-plans` has filled the catalog
 MEMBERSHIP_PLANS = {
     'monthly': {
         'name': 'Monthly Membership',
@@ -33,24 +76,43 @@ MEMBERSHIP_PLANS = {
     }
 }
 
+plan_catalog = PlanCatalog(MEMBERSHIP_PLANS)
+
+# /config never changes while the process runs, so its body is built once
+STRIPE_CONFIG_BODY = json.dumps({'publishable_key': STRIPE_PUBLISHABLE_KEY}).encode()
+STRIPE_CONFIG_ETAG = hashlib.sha256(STRIPE_CONFIG_BODY).hexdigest()[:16]
+
+def stripe_unavailable_response(error):
+    """Build a 503 response telling the client when to retry"""
+    response = jsonify({'error': 'Payment provider is unavailable, please try again shortly'})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+def page_params():
+    """Read the ``limit`` and ``after`` cursor of a paginated listing from the query string"""
+    limit = request.args.get('limit', current_app.config.get('HISTORY_PAGE_SIZE', 50), type=int)
+    max_limit = current_app.config.get('HISTORY_MAX_PAGE_SIZE', 100)
+    return max(1, min(limit, max_limit)), request.args.get('after')
+
+def cacheable_json_response(body, etag, max_age):
+    """Send a prebuilt JSON body with an ETag, answering 304 when the client's copy is current"""
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
 @stripe_bp.route('/config', methods=['GET'])
 def get_stripe_config():
     """Get Stripe publishable key"""
-    return jsonify({'publishable_key': STRIPE_PUBLISHABLE_KEY}), 200
+    return cacheable_json_response(STRIPE_CONFIG_BODY, STRIPE_CONFIG_ETAG,
+                                   current_app.config.get('STRIPE_CONFIG_MAX_AGE', 300))
 
 @stripe_bp.route('/membership/plans', methods=['GET'])
 def get_membership_plans():
     """Get available membership plans"""
-    plans = []
-    for plan_id, plan_data in MEMBERSHIP_PLANS.items():
-        plans.append({
-            'id': plan_id,
-            'name': plan_data['name'],
-            'price': plan_data['price'],
-            'currency': plan_data['currency'],
-            'interval': plan_data['interval']
-        })
-    return jsonify({'plans': plans}), 200
+    body, version = plan_catalog.response_body()
+    return cacheable_json_response(body, version, current_app.config.get('PLAN_CATALOG_MAX_AGE', 60))
 
 @stripe_bp.route('/membership/create-checkout-session', methods=['POST'])
 def create_checkout_session():
@@ -62,7 +124,8 @@ def create_checkout_session():
         data = request.get_json()
         plan_id = data.get('plan_id')
         
-        if plan_id not in MEMBERSHIP_PLANS:
+        plan = plan_catalog.get(plan_id)
+        if plan is None:
             return jsonify({'error': 'Invalid plan'}), 400
         
         # Get user
@@ -71,22 +134,8 @@ def create_checkout_session():
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        stripe_customer_id = user.stripe_customer_id
-        
-        # Create Stripe customer if doesn't exist
-        if not stripe_customer_id:
-            customer = stripe.Customer.create(
-                email=user.email,
-                name=user.username,
-                metadata={'user_id': user.id}
-            )
-            stripe_customer_id = customer.id
-            
-            # Update user with Stripe customer ID
-            user.stripe_customer_id = stripe_customer_id
-            db.session.commit()
-        
-        plan = MEMBERSHIP_PLANS[plan_id]
+        # Usually created at registration; otherwise made (once) now
+        stripe_customer_id = customer_provisioner.ensure(user)
         
         # Create checkout session
         checkout_session = stripe.checkout.Session.create(
@@ -110,6 +159,9 @@ def create_checkout_session():
             'session_id': checkout_session.id
         }), 200
         
+    except StripeUnavailable as e:
+        db.session.rollback()
+        return stripe_unavailable_response(e)
     except Exception as e:
         db.session.rollback()
         print(f"Error in create_checkout_session: {str(e)}")
@@ -131,42 +183,56 @@ def verify_payment():
         if not session_id:
             return jsonify({'error': 'Session ID required'}), 400
         
-        # Retrieve the checkout session from Stripe
-        checkout_session = stripe.checkout.Session.retrieve(session_id)
+        # Already verified: only confirm the membership is still there
+        subscription_id = verified_sessions.get(session_id)
+        if subscription_id and Membership.query.filter_by(stripe_subscription_id=subscription_id).first():
+            return jsonify({'message': 'Membership already exists'}), 200
+        
+        # Retrieve the checkout session with its subscription in one Stripe call
+        checkout_session = stripe.checkout.Session.retrieve(session_id, expand=['subscription'])
         
         if checkout_session.payment_status == 'paid':
             # Get user from metadata
             user_id = int(checkout_session.metadata['user_id'])
             plan_id = checkout_session.metadata['plan_id']
-            subscription_id = checkout_session.subscription
+            subscription = checkout_session.subscription
+            subscription_cache.put(subscription)
             
             # Check if we already have this membership
             existing_membership = Membership.query.filter_by(
-                stripe_subscription_id=subscription_id
+                stripe_subscription_id=subscription['id']
             ).first()
             
             if not existing_membership:
-                # Get subscription details from Stripe
-                subscription = stripe.Subscription.retrieve(subscription_id)
-                
                 # Create new membership
                 new_membership = Membership(
                     user_id=user_id,
-                    stripe_subscription_id=subscription_id,
+                    stripe_subscription_id=subscription['id'],
                     plan_type=plan_id,
                     status=subscription['status'],
                     current_period_start=datetime.fromtimestamp(subscription['current_period_start']),
                     current_period_end=datetime.fromtimestamp(subscription['current_period_end'])
                 )
                 db.session.add(new_membership)
-                db.session.commit()
-                
-                return jsonify({'message': 'Membership created successfully'}), 200
+                try:
+                    refresh_current_memberships([user_id])
+                    db.session.commit()
+                    message = 'Membership created successfully'
+                except IntegrityError:
+                    # A concurrent verification created it first
+                    db.session.rollback()
+                    message = 'Membership already exists'
             else:
-                return jsonify({'message': 'Membership already exists'}), 200
+                message = 'Membership already exists'
+            
+            verified_sessions.add(session_id, subscription['id'])
+            return jsonify({'message': message}), 200
         else:
             return jsonify({'error': 'Payment not completed'}), 400
             
+    except StripeUnavailable as e:
+        db.session.rollback()
+        return stripe_unavailable_response(e)
     except Exception as e:
         db.session.rollback()
         print(f"Error verifying payment: {str(e)}")
@@ -179,32 +245,17 @@ def get_membership_status():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        user_id = session['user_id']
-        print(f"Checking membership status for user_id: {user_id}")
-        
-        # Get all memberships for user (for debugging)
-        all_memberships = Membership.query.filter_by(user_id=user_id).all()
-        print(f"Found {len(all_memberships)} total memberships for user")
-        
-        for m in all_memberships:
-            print(f"Membership ID: {m.id}, Status: {m.status}, Plan: {m.plan_type}")
+        # Kept current by every write to memberships; one primary-key lookup
+        current = db.session.get(CurrentMembership, session['user_id'])
         
-        # Get active membership for user
-        membership = Membership.query.filter_by(
-            user_id=user_id,
-            status='active'
-        ).order_by(Membership.created_at.desc()).first()
-        
-        if membership:
-            print(f"Found active membership: {membership.id}")
+        if current and current.status == 'active':
             return jsonify({
                 'has_membership': True,
-                'plan_type': membership.plan_type,
-                'status': membership.status,
-                'current_period_end': membership.current_period_end.isoformat() if membership.current_period_end else None
+                'plan_type': current.plan_type,
+                'status': current.status,
+                'current_period_end': current.current_period_end.isoformat() if current.current_period_end else None
             }), 200
         else:
-            print("No active membership found")
             return jsonify({'has_membership': False}), 200
             
     except Exception as e:
@@ -235,6 +286,8 @@ def create_payment_intent():
             'payment_intent_id': intent.id
         }), 200
         
+    except StripeUnavailable as e:
+        return stripe_unavailable_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -256,19 +309,12 @@ def create_subscription():
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Create Stripe customer if doesn't exist
-        if not user.stripe_customer_id:
-            customer = stripe.Customer.create(
-                email=user.email,
-                name=user.username,
-                metadata={'user_id': user.id}
-            )
-            user.stripe_customer_id = customer.id
-            db.session.commit()
+        # Usually created at registration; otherwise made (once) now
+        stripe_customer_id = customer_provisioner.ensure(user)
         
         # Create subscription
         subscription = stripe.Subscription.create(
-            customer=user.stripe_customer_id,
+            customer=stripe_customer_id,
             items=[{'price': price_id}],
             metadata={'user_id': str(user.id), 'plan_type': plan_type}
         )
@@ -281,6 +327,7 @@ def create_subscription():
             status=subscription.status
         )
         db.session.add(membership)
+        refresh_current_memberships([user.id])
         db.session.commit()
         
         return jsonify({
@@ -288,6 +335,9 @@ def create_subscription():
             'status': subscription.status
         }), 200
         
+    except StripeUnavailable as e:
+        db.session.rollback()
+        return stripe_unavailable_response(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -299,8 +349,10 @@ def get_user_subscriptions():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        user_id = session['user_id']
-        memberships = Membership.query.filter_by(user_id=user_id).all()
+        limit, after = page_params()
+        memberships, next_cursor = keyset_page(
+            Membership.query.filter_by(user_id=session['user_id']), Membership, limit, after
+        )
         
         subscriptions = []
         for membership in memberships:
@@ -312,8 +364,10 @@ def get_user_subscriptions():
                 'created_at': membership.created_at.isoformat() if membership.created_at else None
             })
         
-        return jsonify({'subscriptions': subscriptions}), 200
+        return jsonify({'subscriptions': subscriptions, 'next_cursor': next_cursor}), 200
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -337,13 +391,18 @@ def cancel_subscription(subscription_id):
         
         # Cancel in Stripe
         stripe.Subscription.cancel(subscription_id)
+        subscription_cache.invalidate(subscription_id)
         
         # Update local record
         membership.status = 'canceled'
+        refresh_current_memberships([user_id])
         db.session.commit()
         
         return jsonify({'message': 'Subscription canceled successfully'}), 200
         
+    except StripeUnavailable as e:
+        db.session.rollback()
+        return stripe_unavailable_response(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -355,10 +414,10 @@ def get_payment_history():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        user_id = session['user_id']
-        payments = PaymentHistory.query.filter_by(user_id=user_id).order_by(
-            PaymentHistory.created_at.desc()
-        ).all()
+        limit, after = page_params()
+        payments, next_cursor = keyset_page(
+            PaymentHistory.query.filter_by(user_id=session['user_id']), PaymentHistory, limit, after
+        )
         
         payment_list = []
         for payment in payments:
@@ -371,8 +430,10 @@ def get_payment_history():
                 'created_at': payment.created_at.isoformat() if payment.created_at else None
             })
         
-        return jsonify({'payments': payment_list}), 200
+        return jsonify({'payments': payment_list, 'next_cursor': next_cursor}), 200
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -385,28 +446,30 @@ def cancel_membership():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        # Get active membership for user
-        membership = Membership.query.filter_by(
-            user_id=session['user_id'],
-            status='active'
-        ).order_by(Membership.created_at.desc()).first()
+        current = db.session.get(CurrentMembership, session['user_id'])
         
-        if not membership:
+        if not current or current.status != 'active':
             return jsonify({'error': 'No active membership found'}), 404
+        membership = db.session.get(Membership, current.membership_id)
         
         # Cancel subscription in Stripe
         stripe.Subscription.modify(
             membership.stripe_subscription_id,
             cancel_at_period_end=True
         )
+        subscription_cache.invalidate(membership.stripe_subscription_id)
         
         # Update membership status
         membership.status = 'cancelled'
         membership.updated_at = datetime.utcnow()
+        refresh_current_memberships([membership.user_id])
         db.session.commit()
         
         return jsonify({'message': 'Membership cancelled successfully'}), 200
         
+    except StripeUnavailable as e:
+        db.session.rollback()
+        return stripe_unavailable_response(e)
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -436,113 +499,336 @@ def stripe_webhook():
         except Exception:
             return jsonify({'error': 'Invalid JSON'}), 400
     
-    # Handle the event
-    event_type = event.get('type')
+    # Redeliveries of events we've already applied need no work
+    if processed_events.is_processed(event.get('id')):
+        return jsonify({'status': 'duplicate'}), 200
     
-    if event_type == 'checkout.session.completed':
-        session_data = event['data']['object']
-        handle_successful_payment(session_data)
-    elif event_type == 'invoice.payment_succeeded':
-        invoice = event['data']['object']
-        handle_successful_payment_renewal(invoice)
-    elif event_type == 'customer.subscription.deleted':
-        subscription = event['data']['object']
-        handle_subscription_cancelled(subscription)
-    elif event_type == 'payment_intent.succeeded':
-        # Handle payment intent success for tests
-        payment_data = event['data']['object']
-        user_id = payment_data.get('metadata', {}).get('user_id')
-        if user_id:
-            payment = PaymentHistory(
-                user_id=int(user_id),
-                stripe_payment_intent_id=payment_data['id'],
-                amount=payment_data['amount'],
-                currency=payment_data['currency'],
-                status=payment_data['status']
-            )
-            db.session.add(payment)
-            db.session.commit()
+    # Acknowledge straight away; a queue worker does the actual processing
+    event_type = event.get('type') or ''
+    webhook_queue.enqueue(request.get_data(as_text=True), event_type, event.get('id'),
+                          group_key=subscription_key(event))
     
     return jsonify({'status': 'success'}), 200
 
-def handle_successful_payment(session_data):
-    """Handle successful payment from Stripe"""
+def process_webhook_events(events):
+    """Apply a batch of queued Stripe events in one transaction; exceptions make the queue retry them"""
+    pending = []
+    pending_ids = set()
+    for event in events:
+        event_id = event.get('id')
+        # The same event may have been queued more than once before any copy ran
+        if event_id and (event_id in pending_ids or processed_events.is_processed(event_id)):
+            continue
+        if event_id:
+            pending_ids.add(event_id)
+            # Committed together with the handlers' changes below
+            processed_events.stage(event_id, event.get('type') or '')
+        pending.append(event)
+    
+    singles, groups = webhook_coalescer.group(pending)
     try:
-        user_id = int(session_data['metadata']['user_id'])
-        plan_id = session_data['metadata']['plan_id']
-        subscription_id = session_data['subscription']
-        
-        # Get subscription details from Stripe
-        subscription = stripe.Subscription.retrieve(subscription_id)
-        
-        # Check if membership already exists
-        existing_membership = Membership.query.filter_by(
-            stripe_subscription_id=subscription_id
-        ).first()
-        
-        if existing_membership:
-            # Update existing membership
-            existing_membership.status = subscription['status']
-            existing_membership.current_period_start = datetime.fromtimestamp(subscription['current_period_start'])
-            existing_membership.current_period_end = datetime.fromtimestamp(subscription['current_period_end'])
-            existing_membership.updated_at = datetime.utcnow()
-        else:
-            # Create new membership
-            new_membership = Membership(
-                user_id=user_id,
-                stripe_subscription_id=subscription_id,
-                plan_type=plan_id,
-                status=subscription['status'],
-                current_period_start=datetime.fromtimestamp(subscription['current_period_start']),
-                current_period_end=datetime.fromtimestamp(subscription['current_period_end'])
-            )
-            db.session.add(new_membership)
-        
+        for event in singles:
+            apply_webhook_event(event)
+        results = [
+            (group, handle_subscription_events(subscription_id, group))
+            for subscription_id, group in groups.items()
+        ]
         db.session.commit()
-        
-    except Exception as e:
+    except IntegrityError:
         db.session.rollback()
-        print(f"Error handling successful payment: {e}")
+        if not all(processed_events.is_processed(event_id) for event_id in pending_ids):
+            raise
+        # Another worker applied these events first
+        return
+    
+    for event_id in pending_ids:
+        processed_events.committed(event_id)
+    for group, (writes, api_calls) in results:
+        webhook_coalescer.record(group, writes, api_calls)
+
+def apply_webhook_event(event):
+    """Dispatch a Stripe event that isn't tied to a subscription"""
+    if event.get('type') == 'payment_intent.succeeded':
+        payment_data = event['data']['object']
+        handle_payment_intent_succeeded(payment_data)
+
+webhook_queue = WebhookQueue(process_webhook_events)
+
+@stripe_bp.before_app_request
+def start_webhook_workers():
+    """Make sure this process works through stored webhooks, not only ones it receives"""
+    webhook_queue.start(current_app._get_current_object())
+
+@stripe_bp.cli.command('process-webhooks')
+def process_webhooks_command():
+    """Process every stored webhook that is due, e.g. the backlog left by a restart"""
+    handled = webhook_queue.drain()
+    click.echo(f"Processed {handled} webhook events")
+
+@stripe_bp.cli.command('prune-webhook-events')
+@click.option('--retention-days', type=int, default=None,
+              help='Keep markers this many days (default: WEBHOOK_DEDUP_RETENTION_DAYS)')
+def prune_webhook_events_command(retention_days):
+    """Forget processed Stripe event ids older than the retention window"""
+    removed = processed_events.prune(retention_days)
+    click.echo(f"Removed {removed} processed webhook event markers")
+
+@stripe_bp.cli.command('backfill-payments')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Earliest payment date (UTC) to backfill; required unless resuming')
+@click.option('--concurrency', default=4, show_default=True, help='Time windows fetched in parallel')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per insert transaction')
+@click.option('--dry-run', is_flag=True, help='Count what would be inserted without writing')
+@click.option('--resume', is_flag=True, help='Continue from the checkpoint saved by an interrupted run')
+@click.option('--checkpoint-file', default=None,
+              help='Where progress is saved (default: payment_backfill.json in the instance folder)')
+def backfill_payments_command(since, concurrency, batch_size, dry_run, resume, checkpoint_file):
+    """Record succeeded Stripe payments missing from payment history"""
+    checkpoint_file = checkpoint_file or os.path.join(current_app.instance_path, 'payment_backfill.json')
+    if resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            windows = json.load(f)['windows']
+        click.echo(f"Resuming {sum(not window['done'] for window in windows)} unfinished windows")
+    elif since is None:
+        raise click.UsageError('--since is required unless resuming')
+    else:
+        start = int(since.replace(tzinfo=timezone.utc).timestamp())
+        windows = time_windows(start, int(time.time()), concurrency)
+    
+    def on_checkpoint(windows, report):
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+        with open(checkpoint_file, 'w') as f:
+            json.dump({'windows': windows}, f)
+        click.echo(f"{report['inserted']} rows in {report['elapsed']:.1f}s ({report['rows_per_second']:.0f} rows/s)")
+    
+    report = backfill_payments(windows, concurrency=concurrency, batch_size=batch_size,
+                               dry_run=dry_run, on_checkpoint=on_checkpoint)
+    
+    if not dry_run and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    verb = 'Would insert' if dry_run else 'Inserted'
+    click.echo(f"{verb} {report['inserted']} payments from {report['fetched']} payment intents "
+               f"({report['pages']} pages, {report['rows_per_second']:.0f} rows/s); "
+               f"{report['duplicates']} already recorded, {report['unmatched']} without a matching user")
+
+@stripe_bp.cli.command('sync-subscriptions')
+@click.option('--dry-run', is_flag=True, help='Print what would change without writing')
+@click.option('--batch-size', default=500, show_default=True, help='Subscriptions per upsert batch')
+@click.option('--resume', is_flag=True, help='Continue from the cursor saved by an interrupted run')
+@click.option('--cursor-file', default=None,
+              help='Where progress is saved (default: stripe_sync.cursor in the instance folder)')
+def sync_subscriptions_command(dry_run, batch_size, resume, cursor_file):
+    """Reconcile memberships with every subscription in Stripe"""
+    cursor_file = cursor_file or os.path.join(current_app.instance_path, 'stripe_sync.cursor')
+    starting_after = None
+    if resume and os.path.exists(cursor_file):
+        with open(cursor_file) as f:
+            starting_after = f.read().strip() or None
+        click.echo(f"Resuming after {starting_after}")
+    
+    plan_for_price = plan_catalog.plan_for_price()
+    
+    def on_batch(report, changes):
+        if dry_run:
+            for action, subscription_id, diff in changes:
+                fields = ', '.join(f"{field}: {old!r} -> {new!r}" for field, (old, new) in diff.items())
+                click.echo(f"{action} {subscription_id}: {fields}")
+        else:
+            # Only advance the cursor once the batch is committed
+            os.makedirs(os.path.dirname(cursor_file), exist_ok=True)
+            with open(cursor_file, 'w') as f:
+                f.write(report['cursor'])
+        click.echo(f"{report['seen']} subscriptions in {report['elapsed']:.1f}s ({report['per_second']:.0f}/s)")
+    
+    report = sync_subscriptions(plan_for_price, batch_size=batch_size, dry_run=dry_run,
+                                starting_after=starting_after, on_batch=on_batch)
+    
+    if not dry_run and os.path.exists(cursor_file):
+        os.remove(cursor_file)
+    verb = 'Would create' if dry_run else 'Created'
+    click.echo(f"{verb} {report['created']}, updated {report['updated']}, unchanged {report['unchanged']}, "
+               f"skipped {report['unmatched']} without a matching user")
+
+@stripe_bp.cli.command('sync-plans')
+@click.option('--dry-run', is_flag=True, help='Report changes without writing them')
+def sync_plans_command(dry_run):
+    """Refresh the membership plan catalog from Stripe Prices"""
+    report = sync_plan_catalog(dry_run=dry_run)
+    if not dry_run:
+        plan_catalog.invalidate()
+    verb = 'Would create' if dry_run else 'Created'
+    click.echo(f"{verb} {report['created']}, updated {report['updated']}, unchanged {report['unchanged']}, "
+               f"deactivated {report['deactivated']} plans")
+
+@stripe_bp.cli.command('repair-current-memberships')
+@click.option('--batch-size', default=500, show_default=True, help='Users per transaction')
+@click.option('--dry-run', is_flag=True, help='Report drift without fixing it')
+def repair_current_memberships_command(batch_size, dry_run):
+    """Rebuild each user's current membership summary from the memberships table"""
+    report = repair_current_memberships(batch_size=batch_size, dry_run=dry_run)
+    verb = 'Would fix' if dry_run else 'Fixed'
+    click.echo(f"{verb} {report['created'] + report['updated'] + report['removed']} of {report['users']} users "
+               f"(created {report['created']}, updated {report['updated']}, removed {report['removed']})")
+
+@stripe_bp.cli.command('export')
+@click.argument('table', type=click.Choice(list(EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='ndjson', show_default=True)
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only rows created on or after this date (UTC)')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only rows created before this date (UTC)')
+@click.option('--output', type=click.File('w'), default='-', help='File to write (default: stdout)')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched and written at a time')
+def export_command(table, fmt, since, until, output, batch_size):
+    """Stream every user's payments or memberships as NDJSON or CSV"""
+    report = {'rows': 0}
+    for chunk in export_chunks(table, fmt, since, until, batch_size, report=report):
+        output.write(chunk)
+    output.flush()
+    click.echo(f"Exported {report['rows']} {table}", err=True)
+
+def subscription_state_from_event(event, subscription_id):
+    """Read status and billing period from an event payload, or None if any are missing"""
+    event_type = event.get('type') or ''
+    event_object = event['data']['object']
+    
+    if event_type.startswith('customer.subscription.'):
+        state = {
+            'status': event_object.get('status'),
+            'current_period_start': event_object.get('current_period_start'),
+            'current_period_end': event_object.get('current_period_end')
+        }
+    elif event_type == 'invoice.payment_succeeded':
+        # The subscription line carries the period the invoice paid for
+        periods = [
+            line['period'] for line in (event_object.get('lines') or {}).get('data') or []
+            if line.get('period') and line.get('subscription', subscription_id) == subscription_id
+        ]
+        period = max(periods, key=lambda period: period.get('end') or 0) if periods else {}
+        state = {
+            # A $0 invoice may belong to a trial, so only a real payment implies active
+            'status': 'active' if event_object.get('amount_paid') else None,
+            'current_period_start': period.get('start'),
+            'current_period_end': period.get('end')
+        }
+    else:
+        return None
+    
+    if any(value is None for value in state.values()):
+        return None
+    if event_type.startswith('customer.subscription.'):
+        state['cancel_at_period_end'] = event_object.get('cancel_at_period_end', False)
+    return state
 
-def handle_successful_payment_renewal(invoice):
-    """Handle successful payment renewal"""
+def handle_subscription_events(subscription_id, events):
+    """Bring a membership up to date with a burst of events for one subscription.
+
+    Events are applied oldest first to work out the final state, so the
+    membership is written at most once. Status and period come from the
+    newest event payload when it has them; the subscription is only looked up
+    when fields are missing, the payload is older than what the membership
+    already reflects, or WEBHOOK_STATE_FROM_PAYLOAD is off. Returns the number
+    of (writes, subscription lookups) made.
+    """
     try:
-        subscription_id = invoice['subscription']
-        
-        # Get subscription details
-        subscription = stripe.Subscription.retrieve(subscription_id)
+        checkout = None
+        state_event = None
+        cancelled = False
+        for event in events:
+            event_type = event.get('type') or ''
+            event_object = event['data']['object']
+            
+            # Keep cached subscriptions in step with what Stripe tells us
+            if event_type.startswith('customer.subscription.'):
+                subscription_cache.put(event_object)
+            elif event_type.startswith('invoice.'):
+                subscription_cache.invalidate(subscription_id)
+            
+            if event_type == 'checkout.session.completed':
+                checkout = event_object
+                state_event, cancelled = event, False
+            elif event_type in ('invoice.payment_succeeded', 'customer.subscription.created',
+                                'customer.subscription.updated'):
+                state_event, cancelled = event, False
+            elif event_type == 'customer.subscription.deleted':
+                state_event, cancelled = event, True
+        
+        if state_event is None:
+            return 0, 0
+        created = state_event.get('created')
         
-        # Find and update membership
         membership = Membership.query.filter_by(
             stripe_subscription_id=subscription_id
         ).first()
         
+        if cancelled:
+            if not membership:
+                return 0, 0
+            membership.status = 'cancelled'
+            membership.stripe_event_created = max(created or 0, membership.stripe_event_created or 0)
+            membership.updated_at = datetime.utcnow()
+            refresh_current_memberships([membership.user_id])
+            return 1, 0
+        
+        # Renewals for memberships we never created need no lookup
+        if membership is None and checkout is None:
+            return 0, 0
+        
+        state = None
+        stale = (membership is not None and membership.stripe_event_created is not None
+                 and (created or 0) < membership.stripe_event_created)
+        if stale:
+            # The cache may now hold this event's outdated copy
+            subscription_cache.invalidate(subscription_id)
+        elif current_app.config.get('WEBHOOK_STATE_FROM_PAYLOAD', True):
+            state = subscription_state_from_event(state_event, subscription_id)
+        
+        lookups = 0
+        if state is None:
+            # Get subscription details from Stripe
+            state = subscription_cache.get(subscription_id)
+            lookups = 1
+        
         if membership:
-            membership.current_period_start = datetime.fromtimestamp(subscription['current_period_start'])
-            membership.current_period_end = datetime.fromtimestamp(subscription['current_period_end'])
-            membership.status = subscription['status']
+            membership.status = membership_status(state, membership.status)
+            membership.current_period_start = datetime.fromtimestamp(state['current_period_start'])
+            membership.current_period_end = datetime.fromtimestamp(state['current_period_end'])
             membership.updated_at = datetime.utcnow()
-            db.session.commit()
+        else:
+            membership = Membership(
+                user_id=int(checkout['metadata']['user_id']),
+                stripe_subscription_id=subscription_id,
+                plan_type=checkout['metadata']['plan_id'],
+                status=membership_status(state),
+                current_period_start=datetime.fromtimestamp(state['current_period_start']),
+                current_period_end=datetime.fromtimestamp(state['current_period_end'])
+            )
+            db.session.add(membership)
+        if created:
+            membership.stripe_event_created = max(created, membership.stripe_event_created or 0)
+        refresh_current_memberships([membership.user_id])
+        return 1, lookups
         
     except Exception as e:
         db.session.rollback()
-        print(f"Error handling payment renewal: {e}")
+        print(f"Error handling events for subscription {subscription_id}: {e}")
+        raise
 
-def handle_subscription_cancelled(subscription):
-    """Handle subscription cancellation"""
+def handle_payment_intent_succeeded(payment_data):
+    """Record a successful one-off payment"""
     try:
-        subscription_id = subscription['id']
-        
-        # Find and update membership
-        membership = Membership.query.filter_by(
-            stripe_subscription_id=subscription_id
-        ).first()
-        
-        if membership:
-            membership.status = 'cancelled'
-            membership.updated_at = datetime.utcnow()
-            db.session.commit()
+        user_id = payment_data.get('metadata', {}).get('user_id')
+        if user_id:
+            payment = PaymentHistory(
+                user_id=int(user_id),
+                stripe_payment_intent_id=payment_data['id'],
+                amount=payment_data['amount'],
+                currency=payment_data['currency'],
+                status=payment_data['status']
+            )
+            db.session.add(payment)
         
     except Exception as e:
         db.session.rollback()
-        print(f"Error handling subscription cancellation: {e}") 
\ No newline at end of file
+        print(f"Error recording payment intent: {e}")
+        raise
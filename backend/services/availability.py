@@ -0,0 +1,201 @@
+import hashlib
+import math
+import threading
+import time
+import sys
+import os
+from flask import current_app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, User
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    ``might_contain`` never returns False for an added value, and returns True
+    for a value that was never added with roughly ``error_rate`` probability.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class IdentityIndex:
+    """Per-process Bloom filters of taken usernames and emails.
+
+    ``start`` warms the filters on a background thread as soon as the app
+    serves, and that thread keeps them fresh: users other processes registered
+    are merged in every ``IDENTITY_FILTER_MERGE_INTERVAL`` seconds with a
+    primary key range read, and every ``IDENTITY_FILTER_REBUILD_INTERVAL``
+    seconds the filters are rebuilt from the table, to pick up changed emails,
+    and swapped in when done. Requests never wait on a table scan; until the
+    first warm-up finishes they are answered by the database. A definite miss
+    skips the database probe entirely; a hit is confirmed with an indexed
+    query. Anything still missed in between is caught by the unique
+    constraints on insert. With ``IDENTITY_FILTER_WORKERS`` at 0 the refresh
+    runs inline when due instead (used by the test suite).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Serializes merges and rebuilds; requests only take ``_lock``
+        self._refresh_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._filters = None
+        # Values added while a rebuild reads the table, replayed into its filters
+        self._pending = None
+        self._max_user_id = 0
+        self._next_merge = 0
+        self._next_rebuild = 0
+        self._stats = {'probes_skipped': 0, 'probes': 0, 'false_positives': 0, 'merged': 0, 'rebuilds': 0}
+
+    def _rebuild(self):
+        config = current_app.config
+        capacity = config.get('IDENTITY_FILTER_CAPACITY', 100000)
+        error_rate = config.get('IDENTITY_FILTER_ERROR_RATE', 0.01)
+        filters = {
+            'username': BloomFilter(capacity, error_rate),
+            'email': BloomFilter(capacity, error_rate),
+        }
+        max_user_id = 0
+        with self._lock:
+            self._pending = []
+        try:
+            for user_id, username, email in db.session.query(User.id, User.username, User.email).yield_per(1000):
+                filters['username'].add(username)
+                filters['email'].add(email)
+                max_user_id = max(max_user_id, user_id)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for field, value in self._pending:
+                filters[field].add(value)
+            self._pending = None
+            self._filters = filters
+            self._max_user_id = max_user_id
+            self._stats['rebuilds'] += 1
+
+    def _merge(self):
+        # Registrations made by other processes since the last look
+        rows = db.session.query(User.id, User.username, User.email).filter(
+            User.id > self._max_user_id
+        ).order_by(User.id).all()
+        with self._lock:
+            for user_id, username, email in rows:
+                self._filters['username'].add(username)
+                self._filters['email'].add(email)
+                self._max_user_id = max(self._max_user_id, user_id)
+            self._stats['merged'] += len(rows)
+
+    def refresh(self):
+        """Rebuild the filters if that is due, otherwise merge in new users"""
+        with self._refresh_lock:
+            config = current_app.config
+            now = time.monotonic()
+            if self._filters is None or now >= self._next_rebuild:
+                self._rebuild()
+                self._next_rebuild = now + config.get('IDENTITY_FILTER_REBUILD_INTERVAL', 600)
+            else:
+                self._merge()
+            self._next_merge = min(now + config.get('IDENTITY_FILTER_MERGE_INTERVAL', 5), self._next_rebuild)
+
+    def _current_filters(self):
+        """The filters to check against, or None while they are still warming up"""
+        if current_app.config.get('IDENTITY_FILTER_WORKERS', 1) <= 0:
+            if self._filters is None or time.monotonic() >= self._next_merge:
+                self.refresh()
+        return self._filters
+
+    def start(self, app):
+        """Start this process's refresh thread, which warms the filters first"""
+        if app.config.get('IDENTITY_FILTER_WORKERS', 1) <= 0:
+            return
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._refresh_loop, args=(app,),
+                                            name='identity-filters', daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self, app):
+        with app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Identity filter refresh error: {e}")
+                finally:
+                    db.session.remove()
+                self._stopping.wait(app.config.get('IDENTITY_FILTER_MERGE_INTERVAL', 5))
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def add(self, username=None, email=None):
+        with self._lock:
+            for field, value in (('username', username), ('email', email)):
+                if value is None:
+                    continue
+                if self._filters is not None:
+                    self._filters[field].add(value)
+                if self._pending is not None:
+                    self._pending.append((field, value))
+
+    def is_taken(self, field, value):
+        """Return whether a user already has ``value`` as their ``field`` ('username' or 'email')"""
+        filters = self._current_filters()
+        if filters is not None and not filters[field].might_contain(value):
+            with self._lock:
+                self._stats['probes_skipped'] += 1
+            return False
+
+        taken = db.session.query(User.id).filter(getattr(User, field) == value).first() is not None
+        with self._lock:
+            self._stats['probes'] += 1
+            if not taken and filters is not None:
+                self._stats['false_positives'] += 1
+        return taken
+
+    def reset(self):
+        with self._lock:
+            self._filters = None
+            self._pending = None
+            self._max_user_id = 0
+            self._next_merge = 0
+            self._next_rebuild = 0
+            self._stats = {'probes_skipped': 0, 'probes': 0, 'false_positives': 0, 'merged': 0, 'rebuilds': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+identity_index = IdentityIndex()
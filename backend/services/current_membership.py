@@ -0,0 +1,79 @@
+import sys
+import os
+from datetime import datetime
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, Membership, CurrentMembership
+
+# Copied from the chosen membership onto the user's current_memberships row
+SUMMARY_FIELDS = ('membership_id', 'plan_type', 'status', 'current_period_end')
+
+
+def _rank(row):
+    # Newest active membership first, otherwise the newest of any status
+    return (row.status == 'active', row.created_at or datetime.min, row.id)
+
+
+def refresh_current_memberships(user_ids):
+    """Recompute the current_memberships rows of ``user_ids`` inside the current transaction.
+
+    Every code path that writes ``Membership`` calls this before committing,
+    so the summary commits or rolls back together with the change. Returns
+    counts of created, updated, removed and unchanged summary rows.
+    """
+    counts = {'created': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return counts
+
+    # New memberships need their ids and created_at
+    db.session.flush()
+    chosen = {}
+    for row in db.session.query(Membership.id, Membership.user_id, Membership.plan_type, Membership.status,
+                                Membership.current_period_end, Membership.created_at) \
+            .filter(Membership.user_id.in_(user_ids)):
+        if row.user_id not in chosen or _rank(row) > _rank(chosen[row.user_id]):
+            chosen[row.user_id] = row
+    existing = {
+        current.user_id: current
+        for current in CurrentMembership.query.filter(CurrentMembership.user_id.in_(user_ids))
+    }
+
+    for user_id in user_ids:
+        row = chosen.get(user_id)
+        current = existing.get(user_id)
+        if row is None:
+            if current is not None:
+                db.session.delete(current)
+                counts['removed'] += 1
+            continue
+
+        summary = {'membership_id': row.id, 'plan_type': row.plan_type, 'status': row.status,
+                   'current_period_end': row.current_period_end}
+        if current is None:
+            db.session.add(CurrentMembership(user_id=user_id, **summary))
+            counts['created'] += 1
+        elif all(getattr(current, field) == summary[field] for field in SUMMARY_FIELDS):
+            counts['unchanged'] += 1
+        else:
+            for field in SUMMARY_FIELDS:
+                setattr(current, field, summary[field])
+            counts['updated'] += 1
+    return counts
+
+
+def repair_current_memberships(batch_size=500, dry_run=False):
+    """Rebuild every current_memberships row from the memberships table, one batch of users per transaction"""
+    user_ids = sorted(
+        {user_id for (user_id,) in db.session.query(Membership.user_id).distinct()}
+        | {user_id for (user_id,) in db.session.query(CurrentMembership.user_id)}
+    )
+    report = {'users': len(user_ids), 'created': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    for start in range(0, len(user_ids), batch_size):
+        counts = refresh_current_memberships(user_ids[start:start + batch_size])
+        for key, value in counts.items():
+            report[key] += value
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    return report
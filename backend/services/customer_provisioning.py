@@ -0,0 +1,163 @@
+import threading
+import sys
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+import stripe
+from flask import current_app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, User
+from services.stripe_guard import StripeUnavailable
+
+
+def idempotency_key(user):
+    # Ids can be reused (a reset database, SQLite after a delete), so the key
+    # also names something only this row has
+    created = user.created_at.strftime('%Y%m%dT%H%M%S.%f') if user.created_at else user.email
+    return f'customer-for-user-{user.id}-{created}'
+
+
+class CustomerProvisioner:
+    """Creates each user's Stripe customer ahead of their first checkout.
+
+    ``submit`` is called at registration and does the work on a background
+    thread pool, so checkout normally finds ``stripe_customer_id`` already set.
+    ``ensure`` is the checkout side: it returns the stored id, waits for a
+    creation already in flight for that user, or creates the customer itself.
+    A per-user future makes sure one process never creates two customers for
+    one user. A Stripe idempotency key and a conditional UPDATE cover
+    concurrent processes. A worker count of 0 creates customers inline.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._inflight = {}
+        self._stats = {'submitted': 0, 'created': 0, 'ready': 0, 'waited': 0, 'failed': 0}
+
+    def _get_executor(self, workers):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stripe-customers')
+            return self._executor
+
+    def _claim(self, user_id):
+        """Return the in-flight creation for ``user_id`` and whether this caller must run it"""
+        with self._lock:
+            future = self._inflight.get(user_id)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._inflight[user_id] = future
+            return future, True
+
+    def _create(self, user_id):
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        if user.stripe_customer_id:
+            return user.stripe_customer_id
+
+        customer = stripe.Customer.create(
+            email=user.email,
+            name=user.username,
+            metadata={'user_id': user.id},
+            # Retries and racing processes get the same customer back
+            idempotency_key=idempotency_key(user)
+        )
+        stored = User.query.filter(User.id == user_id, User.stripe_customer_id.is_(None)).update(
+            {'stripe_customer_id': customer.id}, synchronize_session=False
+        )
+        db.session.commit()
+        with self._lock:
+            self._stats['created'] += 1
+        if not stored:
+            # Another process stored its customer first
+            return db.session.query(User.stripe_customer_id).filter_by(id=user_id).scalar()
+        return customer.id
+
+    def _complete(self, user_id, future):
+        try:
+            customer_id = self._create(user_id)
+        except Exception as e:
+            db.session.rollback()
+            with self._lock:
+                del self._inflight[user_id]
+                self._stats['failed'] += 1
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[user_id]
+        future.set_result(customer_id)
+        return customer_id
+
+    def _run(self, app, user_id, future):
+        with app.app_context():
+            try:
+                self._complete(user_id, future)
+            except Exception as e:
+                print(f"Error creating Stripe customer for user {user_id}: {e}")
+            finally:
+                db.session.remove()
+
+    def submit(self, user_id):
+        """Queue customer creation for a newly registered user"""
+        if not current_app.config.get('STRIPE_CUSTOMER_PREPROVISION', True):
+            return None
+        future, leader = self._claim(user_id)
+        if not leader:
+            return future
+        with self._lock:
+            self._stats['submitted'] += 1
+
+        workers = current_app.config.get('STRIPE_CUSTOMER_WORKERS', 2)
+        if workers <= 0:
+            try:
+                self._complete(user_id, future)
+            except Exception as e:
+                # Checkout will try again
+                print(f"Error creating Stripe customer for user {user_id}: {e}")
+            return future
+        app = current_app._get_current_object()
+        self._get_executor(workers).submit(self._run, app, user_id, future)
+        return future
+
+    def ensure(self, user):
+        """Return ``user``'s Stripe customer id, creating the customer at most once"""
+        if user.stripe_customer_id:
+            with self._lock:
+                self._stats['ready'] += 1
+            return user.stripe_customer_id
+
+        future, leader = self._claim(user.id)
+        if leader:
+            customer_id = self._complete(user.id, future)
+        else:
+            with self._lock:
+                self._stats['waited'] += 1
+            try:
+                customer_id = future.result(timeout=current_app.config.get('STRIPE_CUSTOMER_WAIT_TIMEOUT', 10))
+            except FutureTimeout:
+                raise StripeUnavailable('customer creation still in progress')
+            except Exception:
+                # The background attempt failed; make our own
+                return self.ensure(user)
+
+        # Pick up the id stored by whichever attempt won
+        db.session.refresh(user)
+        return customer_id
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._inflight)
+            return stats
+
+    def shutdown(self):
+        # Running creations take the lock to finish, so wait for them outside it
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+customer_provisioner = CustomerProvisioner()
@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+import sys
+import os
+from datetime import datetime
+from sqlalchemy import select
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, Membership, PaymentHistory
+
+# Exportable tables and the columns written for each, in output order
+EXPORTS = {
+    'payments': (PaymentHistory, ('id', 'user_id', 'stripe_payment_intent_id', 'amount', 'currency',
+                                  'status', 'created_at')),
+    'memberships': (Membership, ('id', 'user_id', 'stripe_subscription_id', 'plan_type', 'status',
+                                 'current_period_start', 'current_period_end', 'created_at', 'updated_at')),
+}
+
+FORMATS = ('ndjson', 'csv')
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export_rows(table, since=None, until=None, batch_size=1000):
+    """Yield rows of ``table`` as tuples, ``batch_size`` at a time from a streaming cursor.
+
+    Only plain columns are selected, so no ORM objects pile up in the
+    session, and ``yield_per`` keeps at most one batch in memory. ``since``
+    is inclusive and ``until`` exclusive, both on ``created_at``.
+    """
+    model, columns = EXPORTS[table]
+    query = select(*[getattr(model, column) for column in columns]).order_by(model.id)
+    if since:
+        query = query.where(model.created_at >= since)
+    if until:
+        query = query.where(model.created_at < until)
+    for row in db.session.execute(query.execution_options(yield_per=batch_size)):
+        yield tuple(_value(value) for value in row)
+
+
+def export_chunks(table, fmt='ndjson', since=None, until=None, batch_size=1000, report=None):
+    """Yield the export as text chunks of ``batch_size`` rows, ready to write or stream.
+
+    The running row count is kept in ``report['rows']`` when a dict is given.
+    """
+    columns = EXPORTS[table][1]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+
+    pending = 0
+    for row in export_rows(table, since, until, batch_size):
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row))) + '\n')
+        pending += 1
+        if report is not None:
+            report['rows'] = report.get('rows', 0) + 1
+        if pending >= batch_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,200 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Hashing workers are started from a clean server process: forking the app would
+# copy locks held by its other threads (webhook workers, thumbnails, cleanup)
+POOL_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+# Werkzeug's own default, spelled out so stored hashes can be compared against it
+DEFAULT_HASH_METHOD = 'pbkdf2:sha256:600000'
+
+
+class HashingOverloaded(Exception):
+    """Raised when the hashing queue is full and the request should be retried later"""
+
+    def __init__(self, retry_after):
+        super().__init__('Password hashing queue is full')
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """Runs CPU-bound password hashing on a fixed-size process pool.
+
+    At most ``pool_size + queue_size`` operations may be pending at once; further
+    submissions are rejected with HashingOverloaded instead of piling up behind
+    the pool and tying up request threads. A pool size of 0 runs operations
+    inline on the calling thread (used by the test suite).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._stats = {}
+
+    def _settings(self):
+        config = current_app.config
+        return (
+            config.get('PASSWORD_HASH_POOL_SIZE', os.cpu_count() or 1),
+            config.get('PASSWORD_HASH_QUEUE_SIZE', 16),
+            config.get('PASSWORD_HASH_RETRY_AFTER', 1),
+        )
+
+    def _get_executor(self, pool_size, queue_size):
+        # A forked worker must not reuse its parent's pool
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(max_workers=pool_size, mp_context=POOL_CONTEXT)
+                    self._slots = threading.BoundedSemaphore(pool_size + queue_size)
+                    self._pid = os.getpid()
+        return self._executor, self._slots
+
+    def _record(self, operation, elapsed=None, rejected=False):
+        with self._lock:
+            stats = self._stats.setdefault(operation, {
+                'count': 0,
+                'rejected': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+            })
+            if rejected:
+                stats['rejected'] += 1
+                return
+            stats['count'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+    def run(self, operation, func, *args):
+        """Run ``func(*args)`` on the pool and wait for its result"""
+        pool_size, queue_size, retry_after = self._settings()
+        start = time.perf_counter()
+
+        if pool_size <= 0:
+            result = func(*args)
+            self._record(operation, time.perf_counter() - start)
+            return result
+
+        executor, slots = self._get_executor(pool_size, queue_size)
+        if not slots.acquire(blocking=False):
+            self._record(operation, rejected=True)
+            raise HashingOverloaded(retry_after)
+
+        try:
+            result = executor.submit(func, *args).result()
+        finally:
+            slots.release()
+
+        self._record(operation, time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        """Return per-operation counters and latencies"""
+        with self._lock:
+            result = {}
+            for operation, stats in self._stats.items():
+                count = stats['count']
+                result[operation] = dict(stats)
+                result[operation]['avg_seconds'] = stats['total_seconds'] / count if count else 0.0
+            return result
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._executor = None
+            self._slots = None
+            self._pid = None
+
+
+password_hasher = PasswordHasher()
+
+
+def hash_method(password_hash):
+    """Return the method prefix of a Werkzeug hash, e.g. ``pbkdf2:sha256:600000``"""
+    return password_hash.split('$', 1)[0]
+
+
+def normalize_hash_method(method):
+    """Spell ``method`` out the way Werkzeug records it in hashes, e.g. ``scrypt`` -> ``scrypt:32768:8:1``.
+
+    Short forms would never match a stored prefix and every login would
+    rehash. Parsed with Werkzeug's defaults rather than by hashing, as this
+    runs at every app start. Raises ValueError for methods Werkzeug doesn't
+    accept.
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        if not args:
+            return 'scrypt:32768:8:1'
+        if len(args) != 3:
+            raise ValueError("'scrypt' takes 3 arguments.")
+        n, r, p = map(int, args)
+        return f'scrypt:{n}:{r}:{p}'
+    if name == 'pbkdf2':
+        if len(args) > 2:
+            raise ValueError("'pbkdf2' takes 2 arguments.")
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        # Unknown digests raise ValueError here rather than at the first login
+        hashlib.new(hash_name)
+        return f'pbkdf2:{hash_name}:{iterations}'
+    # Deprecated single-digest methods are recorded as given
+    hashlib.new(method)
+    return method
+
+
+def needs_rehash(password_hash, method):
+    """Whether ``password_hash`` was made with different parameters than ``method`` (as normalized)"""
+    return hash_method(password_hash) != method
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def benchmark(method, rounds, concurrency, pool_size):
+    """Measure verification throughput and latency for ``method`` on this machine.
+
+    ``concurrency`` threads each submit logins to a ``pool_size`` process pool,
+    mirroring how request threads share the hashing pool. Latency includes
+    time spent queued for a worker.
+    """
+    password = 'benchmark-password'
+    password_hash = generate_password_hash(password, method)
+
+    def timed_login(_):
+        start = time.perf_counter()
+        pool.submit(check_password_hash, password_hash, password).result()
+        return time.perf_counter() - start
+
+    with ProcessPoolExecutor(max_workers=pool_size, mp_context=POOL_CONTEXT) as pool:
+        # Start the worker processes before timing anything
+        list(pool.map(check_password_hash, [password_hash] * pool_size, [password] * pool_size))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as clients:
+            latencies = list(clients.map(timed_login, range(rounds)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'method': method,
+        'hashes_per_second': rounds / elapsed,
+        'p50_seconds': percentile(latencies, 0.50),
+        'p99_seconds': percentile(latencies, 0.99),
+    }
@@ -0,0 +1,41 @@
+import base64
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(created_at, row_id):
+    """Opaque token for the position just after ``(created_at, row_id)``"""
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(created_at, id)`` from an ``encode_cursor`` token; raise ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError as e:
+        # Covers bad base64, bad UTF-8 and a malformed payload
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def keyset_page(query, model, limit, after=None):
+    """Return one page of ``query`` newest first, and the cursor for the next page or None.
+
+    Rows are ordered by ``(created_at DESC, id)``, the order of the
+    ``(user_id, created_at DESC, id)`` indexes, so each page is a seek into
+    the index instead of skipping earlier pages. ``after`` is the
+    ``next_cursor`` returned with the previous page.
+    """
+    if after:
+        created_at, row_id = decode_cursor(after)
+        # The first term bounds the index range; the second breaks ties on created_at
+        query = query.filter(model.created_at <= created_at,
+                             or_(model.created_at < created_at,
+                                 and_(model.created_at == created_at, model.id > row_id)))
+    rows = query.order_by(model.created_at.desc(), model.id).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
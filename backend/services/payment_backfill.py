@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import stripe
+from sqlalchemy import insert
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, User, PaymentHistory
+from services.stripe_client import PAGE_SIZE
+
+
+def time_windows(since, until, count):
+    """Split ``[since, until)`` into ``count`` contiguous windows of unix seconds"""
+    count = max(1, min(count, until - since))
+    step = (until - since) / count
+    bounds = [since + round(step * i) for i in range(count)] + [until]
+    return [{'start': bounds[i], 'end': bounds[i + 1], 'cursor': None, 'done': False}
+            for i in range(count)]
+
+
+def _fetch_window(index, window, pages, stop):
+    """Page through one time window, handing each page to the writer"""
+    params = {'created': {'gte': window['start'], 'lt': window['end']}, 'limit': PAGE_SIZE}
+    cursor = window['cursor']
+    while not stop.is_set():
+        if cursor:
+            params['starting_after'] = cursor
+        page = stripe.PaymentIntent.list(**params)
+        data = list(page['data'])
+        cursor = data[-1]['id'] if data else cursor
+        done = not data or not page.get('has_more')
+        # Blocks while the writer is behind, which bounds memory
+        while not stop.is_set():
+            try:
+                pages.put((index, data, cursor, done), timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        if done:
+            return
+
+
+def _payment_rows(intents):
+    """Build PaymentHistory rows for succeeded intents not already recorded"""
+    succeeded = [intent for intent in intents if intent.get('status') == 'succeeded']
+    unique = {}
+    for intent in succeeded:
+        unique.setdefault(intent['id'], intent)
+
+    recorded = {
+        row.stripe_payment_intent_id for row in db.session.query(PaymentHistory.stripe_payment_intent_id)
+        .filter(PaymentHistory.stripe_payment_intent_id.in_(list(unique)))
+    } if unique else set()
+    customer_ids = {intent.get('customer') for intent in unique.values()} - {None}
+    users_by_customer = dict(db.session.query(User.stripe_customer_id, User.id).filter(
+        User.stripe_customer_id.in_(customer_ids)
+    ).all()) if customer_ids else {}
+
+    rows, unmatched = [], 0
+    for payment_intent_id, intent in unique.items():
+        if payment_intent_id in recorded:
+            continue
+        user_id = (intent.get('metadata') or {}).get('user_id') or users_by_customer.get(intent.get('customer'))
+        if not user_id:
+            unmatched += 1
+            continue
+        rows.append({
+            'user_id': int(user_id),
+            'stripe_payment_intent_id': payment_intent_id,
+            'amount': intent.get('amount_received') or intent['amount'],
+            'currency': intent['currency'],
+            'status': intent['status'],
+            'created_at': datetime.utcfromtimestamp(intent['created'])
+        })
+    duplicates = len(succeeded) - len(unique) + len(recorded)
+    return rows, unmatched, duplicates
+
+
+def backfill_payments(windows, concurrency=4, batch_size=1000, dry_run=False, on_checkpoint=None):
+    """Insert PaymentHistory rows for succeeded Stripe payment intents.
+
+    Each window (see ``time_windows``) is paged by its own fetch thread, at
+    most ``concurrency`` at a time, into a bounded queue drained by this
+    thread. Rows are deduplicated by ``stripe_payment_intent_id`` and inserted
+    with one ``executemany`` per ``batch_size`` rows. After each commit
+    ``on_checkpoint(windows, report)`` is called with every window's cursor,
+    so an interrupted run can resume from the windows it was given.
+    """
+    report = {'pages': 0, 'fetched': 0, 'inserted': 0, 'duplicates': 0, 'unmatched': 0,
+              'elapsed': 0.0, 'rows_per_second': 0.0}
+    pending = [i for i, window in enumerate(windows) if not window['done']]
+    if not pending:
+        return report
+
+    pages = queue.Queue(maxsize=max(2, concurrency * 2))
+    stop = threading.Event()
+    started = time.monotonic()
+    buffered = []
+
+    def flush():
+        rows, unmatched, duplicates = _payment_rows(buffered)
+        if rows and not dry_run:
+            db.session.execute(insert(PaymentHistory), rows)
+            db.session.commit()
+        report['inserted'] += len(rows)
+        report['unmatched'] += unmatched
+        report['duplicates'] += duplicates
+        report['elapsed'] = time.monotonic() - started
+        report['rows_per_second'] = report['inserted'] / report['elapsed'] if report['elapsed'] else 0.0
+        buffered.clear()
+        if on_checkpoint and not dry_run:
+            on_checkpoint(windows, report)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='payment-backfill')
+    try:
+        futures = [executor.submit(_fetch_window, i, dict(windows[i]), pages, stop) for i in pending]
+        remaining = len(pending)
+        while remaining:
+            try:
+                index, data, cursor, done = pages.get(timeout=0.5)
+            except queue.Empty:
+                for future in futures:
+                    if future.done() and future.exception():
+                        raise future.exception()
+                continue
+
+            buffered.extend(data)
+            windows[index]['cursor'] = cursor
+            windows[index]['done'] = done
+            report['pages'] += 1
+            report['fetched'] += len(data)
+            if done:
+                remaining -= 1
+            if len(buffered) >= batch_size or not remaining:
+                flush()
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+    return report
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import threading
+import time
+import sys
+import os
+import stripe
+from flask import current_app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, MembershipPlan
+from services.stripe_client import PAGE_SIZE
+
+# Columns copied from Stripe on every sync
+PLAN_FIELDS = ('name', 'stripe_price_id', 'stripe_product_id', 'price', 'currency', 'interval')
+
+
+def plan_from_price(price):
+    """Map a recurring Stripe Price (with its product expanded) onto MembershipPlan columns, or None"""
+    product = price.get('product') or {}
+    if isinstance(product, str):
+        product = {'id': product}
+    recurring = price.get('recurring') or {}
+    if not recurring or price.get('unit_amount') is None or product.get('active') is False:
+        return None
+    metadata = price.get('metadata') or {}
+    return {
+        'plan_id': price.get('lookup_key') or metadata.get('plan_id') or price['id'],
+        'name': product.get('name') or price.get('nickname') or price['id'],
+        'stripe_price_id': price['id'],
+        'stripe_product_id': product.get('id'),
+        'price': price['unit_amount'],
+        'currency': price['currency'],
+        'interval': recurring.get('interval'),
+    }
+
+
+def sync_plan_catalog(dry_run=False):
+    """Upsert the plan catalog from every active recurring Stripe Price.
+
+    Prices are listed with their products expanded, so the whole catalog
+    costs one paginated listing and no per-product calls. Plans are keyed by
+    ``plan_id`` (the price's lookup key), so moving a lookup key to a new
+    price updates the plan in place. Plans no longer offered in Stripe are
+    deactivated rather than deleted, because memberships still refer to them.
+    """
+    listing = stripe.Price.list(active=True, type='recurring', expand=['data.product'], limit=PAGE_SIZE)
+    offered = {}
+    for price in listing.auto_paging_iter():
+        plan = plan_from_price(price)
+        if plan:
+            offered.setdefault(plan['plan_id'], plan)
+
+    report = {'created': 0, 'updated': 0, 'unchanged': 0, 'deactivated': 0}
+    existing = {row.plan_id: row for row in MembershipPlan.query.all()}
+    for plan_id, plan in offered.items():
+        row = existing.get(plan_id)
+        if row is None:
+            db.session.add(MembershipPlan(active=True, **plan))
+            report['created'] += 1
+        elif row.active and all(getattr(row, field) == plan[field] for field in PLAN_FIELDS):
+            report['unchanged'] += 1
+        else:
+            for field in PLAN_FIELDS:
+                setattr(row, field, plan[field])
+            row.active = True
+            report['updated'] += 1
+    for plan_id, row in existing.items():
+        if plan_id not in offered and row.active:
+            row.active = False
+            report['deactivated'] += 1
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return report
+
+
+class PlanCatalog:
+    """Active membership plans with their ``/membership/plans`` body precomputed.
+
+    The catalog is read from ``membership_plans`` at most once per
+    ``PLAN_CATALOG_TTL`` seconds. The serialized response and its ETag are
+    built once per catalog version, which is a hash of the body, so requests in
+    between just send stored bytes. ``defaults`` is served until the first
+    sync has filled the table.
+    """
+
+    def __init__(self, defaults):
+        self._defaults = defaults
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stats = {'loads': 0, 'builds': 0}
+
+    def _load(self):
+        rows = MembershipPlan.query.filter_by(active=True).order_by(MembershipPlan.price, MembershipPlan.plan_id).all()
+        if not rows:
+            return dict(self._defaults)
+        return {row.plan_id: {
+            'name': row.name,
+            'price': row.price,
+            'currency': row.currency,
+            'interval': row.interval,
+            'stripe_price_id': row.stripe_price_id
+        } for row in rows}
+
+    def _current(self):
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is not None and snapshot['expires'] > time.monotonic():
+            return snapshot
+
+        plans = self._load()
+        body = json.dumps({'plans': [{
+            'id': plan_id,
+            'name': plan['name'],
+            'price': plan['price'],
+            'currency': plan['currency'],
+            'interval': plan['interval']
+        } for plan_id, plan in plans.items()]}).encode()
+        version = hashlib.sha256(body).hexdigest()[:16]
+        expires = time.monotonic() + current_app.config.get('PLAN_CATALOG_TTL', 60)
+
+        with self._lock:
+            self._stats['loads'] += 1
+            if self._snapshot is not None and self._snapshot['version'] == version:
+                # Same catalog: keep the bytes already built
+                self._snapshot = dict(self._snapshot, plans=plans, expires=expires)
+            else:
+                self._stats['builds'] += 1
+                self._snapshot = {'plans': plans, 'body': body, 'version': version, 'expires': expires}
+            return self._snapshot
+
+    def get(self, plan_id):
+        """Return the active plan called ``plan_id``, or None"""
+        return self._current()['plans'].get(plan_id)
+
+    def response_body(self):
+        """Return the serialized plans list and its version"""
+        snapshot = self._current()
+        return snapshot['body'], snapshot['version']
+
+    def plan_for_price(self):
+        """Map every known Stripe price id, including retired ones, to its plan id"""
+        mapping = {plan['stripe_price_id']: plan_id for plan_id, plan in self._defaults.items()}
+        mapping.update(db.session.query(MembershipPlan.stripe_price_id, MembershipPlan.plan_id).all())
+        return mapping
+
+    def invalidate(self):
+        with self._lock:
+            if self._snapshot is not None:
+                self._snapshot['expires'] = 0
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+            self._stats = {'loads': 0, 'builds': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['version'] = self._snapshot['version'] if self._snapshot else None
+            stats['plans'] = len(self._snapshot['plans']) if self._snapshot else 0
+            return stats
@@ -0,0 +1,111 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from stripe import RequestsClient
+
+# Stripe's maximum page size for list calls
+PAGE_SIZE = 100
+
+
+class PooledStripeClient(RequestsClient):
+    """Stripe HTTP client sharing one keep-alive connection pool per process.
+
+    The SDK's default client opens a session per thread; this one shares a
+    session whose adapter keeps up to ``pool_size`` connections to Stripe open,
+    so calls skip TCP and TLS setup. The number of retries is the SDK's
+    ``stripe.max_network_retries``; the exponential backoff between them, with
+    jitter, is tunable here. With a ``guard`` (see ``StripeGuard``) every
+    request runs inside its bulkhead and circuit breaker, and timeouts and
+    retries are cut short to fit the guard's deadline.
+    """
+
+    name = 'requests-pooled'
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30,
+                 retry_initial_delay=0.5, retry_max_delay=2, guard=None, **kwargs):
+        self.pool_size = pool_size
+        self.guard = guard
+        self.retry_initial_delay = retry_initial_delay
+        self.retry_max_delay = retry_max_delay
+        super().__init__(timeout=(connect_timeout, read_timeout), session=self._new_session(), **kwargs)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        # Block rather than open throwaway connections when the pool is busy
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def _timeout(self):
+        remaining = self.guard.remaining() if self.guard else None
+        if remaining is None:
+            return self._configured_timeout
+        # Never wait on Stripe past the caller's deadline
+        remaining = max(remaining, 0.001)
+        return tuple(min(timeout, remaining) for timeout in self._configured_timeout)
+
+    @_timeout.setter
+    def _timeout(self, timeout):
+        self._configured_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+    def request_with_retries(self, *args, **kwargs):
+        request = super().request_with_retries
+        if self.guard is None:
+            return request(*args, **kwargs)
+        return self.guard.call(lambda: request(*args, **kwargs))
+
+    def request_stream_with_retries(self, *args, **kwargs):
+        request = super().request_stream_with_retries
+        if self.guard is None:
+            return request(*args, **kwargs)
+        return self.guard.call(lambda: request(*args, **kwargs))
+
+    def _should_retry(self, response, api_connection_error, num_retries, max_network_retries):
+        remaining = self.guard.remaining() if self.guard else None
+        if remaining is not None and remaining <= self.retry_initial_delay:
+            # No time left for a backoff and another attempt
+            return False
+        return super()._should_retry(response, api_connection_error, num_retries, max_network_retries)
+
+    def _request_internal(self, *args, **kwargs):
+        # Sockets must not be shared with a forked parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._new_session()
+                    self._thread_local = threading.local()
+                    self._pid = os.getpid()
+        return super()._request_internal(*args, **kwargs)
+
+    def _sleep_time_seconds(self, num_retries, response=None):
+        sleep_seconds = min(self.retry_initial_delay * (2 ** (num_retries - 1)), self.retry_max_delay)
+        sleep_seconds = self._add_jitter_time(sleep_seconds)
+
+        # Honour a reasonable Retry-After from the API
+        retry_after = self._retry_after_header(response) or 0
+        if retry_after <= self.MAX_RETRY_AFTER:
+            sleep_seconds = max(retry_after, sleep_seconds)
+        return sleep_seconds
+
+    def stats(self):
+        """Connections opened versus requests sent over the pool"""
+        connections = 0
+        sent = 0
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                connections += pool.num_connections
+                sent += pool.num_requests
+        return {
+            'pool_size': self.pool_size,
+            'requests': sent,
+            'connections_opened': connections,
+            'connections_reused': max(0, sent - connections),
+        }
+
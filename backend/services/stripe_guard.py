@@ -0,0 +1,171 @@
+import math
+import threading
+import time
+from flask import g, has_request_context
+from stripe import APIConnectionError
+
+
+class StripeUnavailable(Exception):
+    """Raised instead of calling Stripe when it is failing, saturated or out of time"""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(f'Payment provider unavailable ({reason})')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and fails fast.
+
+    After ``reset_timeout`` seconds one trial call is let through (half-open);
+    its success closes the circuit and its failure opens it again. A trial
+    that never reports back is replaced after another ``reset_timeout``.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._opened_at = None
+            self._trial_started = None
+            self._opened = 0
+
+    def allow(self):
+        """Return 0 if a call may proceed, otherwise the seconds until it may"""
+        with self._lock:
+            if self._state == 'closed':
+                return 0
+            now = time.monotonic()
+            remaining = self._opened_at + self.reset_timeout - now
+            if remaining > 0:
+                return remaining
+            if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+                return self._trial_started + self.reset_timeout - now
+            self._state = 'half_open'
+            self._trial_started = now
+            return 0
+
+    def record_success(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                if self._state != 'open':
+                    self._opened += 1
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+                self._trial_started = None
+
+    def stats(self):
+        with self._lock:
+            return {'state': self._state, 'consecutive_failures': self._failures, 'times_opened': self._opened}
+
+
+class StripeGuard:
+    """Deadline, bulkhead and circuit breaker for outbound Stripe calls.
+
+    ``call`` wraps one SDK request (including its retries). At most
+    ``max_concurrent`` calls run at once; a caller that can't get a slot within
+    ``bulkhead_wait`` seconds is rejected, so a slow Stripe can't take every
+    worker thread. All calls made while handling one Flask request share a
+    ``deadline``-second budget (outside a request each call gets its own), and
+    ``remaining()`` lets the HTTP client shrink timeouts and skip retries to
+    fit it. Connection errors, timeouts, 429s and 5xx responses count as
+    failures for the breaker.
+    """
+
+    def __init__(self, max_concurrent=8, bulkhead_wait=0.05, deadline=10,
+                 failure_threshold=5, reset_timeout=30):
+        self.max_concurrent = max_concurrent
+        self.bulkhead_wait = bulkhead_wait
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {'calls': 0, 'failures': 0, 'rejected_open': 0,
+                       'rejected_bulkhead': 0, 'rejected_deadline': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _deadline_for_call(self):
+        if has_request_context():
+            if '_stripe_deadline' not in g:
+                g._stripe_deadline = time.monotonic() + self.deadline
+            return g._stripe_deadline
+        return time.monotonic() + self.deadline
+
+    def remaining(self):
+        """Seconds left for the call running on this thread, or None outside one"""
+        deadline = getattr(self._local, 'deadline', None)
+        return None if deadline is None else deadline - time.monotonic()
+
+    def call(self, func):
+        """Run ``func`` (returning ``(body, status, headers)``) under the guard"""
+        deadline = self._deadline_for_call()
+        if deadline <= time.monotonic():
+            self._count('rejected_deadline')
+            raise StripeUnavailable('deadline exceeded')
+
+        if not self._slots.acquire(timeout=self.bulkhead_wait):
+            self._count('rejected_bulkhead')
+            raise StripeUnavailable('too many concurrent calls')
+        wait = self.breaker.allow()
+        if wait:
+            self._slots.release()
+            self._count('rejected_open')
+            raise StripeUnavailable('circuit open', retry_after=math.ceil(wait))
+
+        with self._lock:
+            self._in_flight += 1
+            self._stats['calls'] += 1
+        self._local.deadline = deadline
+        try:
+            response = func()
+        except APIConnectionError:
+            self._count('failures')
+            self.breaker.record_failure()
+            if deadline <= time.monotonic():
+                self._count('rejected_deadline')
+                raise StripeUnavailable('deadline exceeded')
+            raise
+        finally:
+            self._local.deadline = None
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+        status = response[1]
+        if status == 429 or status >= 500:
+            self._count('failures')
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def reset(self):
+        self.breaker.reset()
+        with self._lock:
+            self._stats = {key: 0 for key in self._stats}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._in_flight
+        stats['max_concurrent'] = self.max_concurrent
+        stats['breaker'] = self.breaker.stats()
+        return stats
@@ -0,0 +1,152 @@
+import time
+import sys
+import os
+from datetime import datetime
+import stripe
+from sqlalchemy import insert, update
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, User, Membership
+from services.stripe_client import PAGE_SIZE
+from services.current_membership import refresh_current_memberships
+
+# Compared between Stripe and the memberships table
+SYNCED_FIELDS = ('user_id', 'plan_type', 'status', 'current_period_start', 'current_period_end')
+
+
+def membership_status(subscription, current_status=None):
+    """Map a Stripe subscription's status onto the spelling memberships use.
+
+    A membership cancelled here stays cancelled while Stripe reports the
+    subscription active until the end of the period it was cancelled at.
+    """
+    status = subscription['status']
+    if status == 'canceled':
+        return 'cancelled'
+    if current_status == 'cancelled' and subscription.get('cancel_at_period_end'):
+        return 'cancelled'
+    return status
+
+
+def membership_fields(subscription, plan_for_price):
+    """Map a Stripe subscription onto Membership columns (user_id excluded)"""
+    items = (subscription.get('items') or {}).get('data') or []
+    price_id = (items[0].get('price') or {}).get('id') if items else None
+
+    def timestamp(field):
+        value = subscription.get(field)
+        return datetime.fromtimestamp(value) if value else None
+
+    return {
+        'plan_type': plan_for_price.get(price_id, price_id) or 'unknown',
+        'status': membership_status(subscription),
+        'current_period_start': timestamp('current_period_start'),
+        'current_period_end': timestamp('current_period_end'),
+    }
+
+
+def sync_subscription_batch(subscriptions, plan_for_price, dry_run=False):
+    """Upsert memberships for one batch of subscriptions.
+
+    Two lookup queries cover the whole batch and the writes go out as one
+    ``executemany`` INSERT and one UPDATE. Returns the counts and the list of
+    changes as ``(action, subscription_id, {field: (old, new)})``.
+    """
+    subscription_ids = [subscription['id'] for subscription in subscriptions]
+    customer_ids = {subscription.get('customer') for subscription in subscriptions} - {None}
+
+    users_by_customer = dict(db.session.query(User.stripe_customer_id, User.id).filter(
+        User.stripe_customer_id.in_(customer_ids)
+    ).all()) if customer_ids else {}
+    existing = {
+        row.stripe_subscription_id: row
+        for row in db.session.query(Membership.id, Membership.stripe_subscription_id,
+                                    *[getattr(Membership, field) for field in SYNCED_FIELDS])
+        .filter(Membership.stripe_subscription_id.in_(subscription_ids))
+    }
+
+    now = datetime.utcnow()
+    inserts, updates, changes = [], [], []
+    # Users whose current membership may change, including previous owners
+    touched_users = set()
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'unmatched': 0}
+    for subscription in subscriptions:
+        fields = membership_fields(subscription, plan_for_price)
+        current = existing.get(subscription['id'])
+        user_id = users_by_customer.get(subscription.get('customer'))
+
+        if current is None:
+            if user_id is None:
+                # No local user has this customer id
+                counts['unmatched'] += 1
+                continue
+            fields['user_id'] = user_id
+            inserts.append(dict(fields, stripe_subscription_id=subscription['id'],
+                                created_at=now, updated_at=now))
+            touched_users.add(user_id)
+            changes.append(('create', subscription['id'], {field: (None, fields[field]) for field in SYNCED_FIELDS}))
+            counts['created'] += 1
+            continue
+
+        # Keep the owner when the customer isn't linked to a local user
+        fields['user_id'] = user_id or current.user_id
+        diff = {
+            field: (getattr(current, field), fields[field])
+            for field in SYNCED_FIELDS if getattr(current, field) != fields[field]
+        }
+        if not diff:
+            counts['unchanged'] += 1
+            continue
+        updates.append(dict(fields, id=current.id, updated_at=now))
+        touched_users.update((current.user_id, fields['user_id']))
+        changes.append(('update', subscription['id'], diff))
+        counts['updated'] += 1
+
+    if not dry_run:
+        if inserts:
+            db.session.execute(insert(Membership), inserts)
+        if updates:
+            db.session.execute(update(Membership), updates)
+        refresh_current_memberships(touched_users)
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return counts, changes
+
+
+def sync_subscriptions(plan_for_price, batch_size=500, dry_run=False, starting_after=None, on_batch=None):
+    """Stream every Stripe subscription into the memberships table.
+
+    Subscriptions are read with the SDK's auto-pagination and handled
+    ``batch_size`` at a time, so memory stays flat however many there are.
+    After each batch ``on_batch(report, changes)`` is called; ``report['cursor']``
+    is then the last subscription id handled, and passing it back as
+    ``starting_after`` resumes an interrupted run.
+    """
+    report = {'seen': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'unmatched': 0,
+              'cursor': starting_after, 'elapsed': 0.0, 'per_second': 0.0}
+    params = {'limit': PAGE_SIZE, 'status': 'all'}
+    if starting_after:
+        params['starting_after'] = starting_after
+
+    started = time.monotonic()
+
+    def flush(batch):
+        counts, changes = sync_subscription_batch(batch, plan_for_price, dry_run=dry_run)
+        for key, value in counts.items():
+            report[key] += value
+        report['seen'] += len(batch)
+        report['cursor'] = batch[-1]['id']
+        report['elapsed'] = time.monotonic() - started
+        report['per_second'] = report['seen'] / report['elapsed'] if report['elapsed'] else 0.0
+        if on_batch:
+            on_batch(report, changes)
+
+    batch = []
+    for subscription in stripe.Subscription.list(**params).auto_paging_iter():
+        batch.append(subscription)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return report
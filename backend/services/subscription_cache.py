@@ -0,0 +1,87 @@
+import threading
+import time
+from concurrent.futures import Future
+import stripe
+from flask import current_app
+
+
+class SubscriptionCache:
+    """Per-process TTL cache of Stripe subscriptions with single-flight misses.
+
+    Concurrent misses for the same id wait on one ``Subscription.retrieve``
+    call instead of each hitting the API. Webhook handlers keep entries fresh
+    with ``put`` (the event carries the subscription) or ``invalidate``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._inflight = {}
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'fetches': 0, 'updates': 0}
+
+    def _ttl(self):
+        return current_app.config.get('SUBSCRIPTION_CACHE_TTL', 60)
+
+    def get(self, subscription_id):
+        """Return the subscription, fetching it from Stripe at most once per TTL"""
+        ttl = self._ttl()
+        with self._lock:
+            entry = self._entries.get(subscription_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._stats['hits'] += 1
+                return entry[0]
+
+            self._stats['misses'] += 1
+            call = self._inflight.get(subscription_id)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._inflight[subscription_id] = call
+                self._stats['fetches'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            subscription = stripe.Subscription.retrieve(subscription_id)
+        except Exception as e:
+            with self._lock:
+                del self._inflight[subscription_id]
+            call.set_exception(e)
+            raise
+
+        with self._lock:
+            if ttl > 0:
+                self._entries[subscription_id] = (subscription, time.monotonic() + ttl)
+            del self._inflight[subscription_id]
+        call.set_result(subscription)
+        return subscription
+
+    def put(self, subscription):
+        """Replace the cached copy with a subscription received in a webhook"""
+        ttl = self._ttl()
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[subscription['id']] = (subscription, time.monotonic() + ttl)
+            self._stats['updates'] += 1
+
+    def invalidate(self, subscription_id):
+        with self._lock:
+            self._entries.pop(subscription_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'fetches': 0, 'updates': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            return stats
+
+
+subscription_cache = SubscriptionCache()
@@ -0,0 +1,104 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from PIL import Image, ImageOps
+
+# Square variants generated for every profile picture, in pixels
+VARIANT_SIZES = (64, 256, 512)
+VARIANT_FORMAT = 'webp'
+VARIANT_QUALITY = 80
+
+
+def variant_filename(filename, size):
+    stem = filename.rsplit('.', 1)[0]
+    return f"{stem}_{size}.{VARIANT_FORMAT}"
+
+
+def variant_filenames(filename):
+    return [variant_filename(filename, size) for size in VARIANT_SIZES]
+
+
+def nearest_variant(filename, size):
+    """Return the smallest variant at least ``size`` pixels wide, or None for the original"""
+    for variant_size in VARIANT_SIZES:
+        if variant_size >= size:
+            return variant_filename(filename, variant_size)
+    return None
+
+
+def generate_variants(upload_path, filename):
+    """Write every missing variant of ``filename`` and return how many were created"""
+    created = 0
+    with Image.open(os.path.join(upload_path, filename)) as original:
+        # Animated GIFs are reduced to their first frame
+        original.seek(0)
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        for size in VARIANT_SIZES:
+            variant_path = os.path.join(upload_path, variant_filename(filename, size))
+            if os.path.exists(variant_path):
+                continue
+
+            variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            # Write under a temporary name so readers never see a partial file
+            temp_path = f"{variant_path}.tmp"
+            variant.save(temp_path, VARIANT_FORMAT.upper(), quality=VARIANT_QUALITY)
+            os.replace(temp_path, variant_path)
+            created += 1
+    return created
+
+
+class ThumbnailPipeline:
+    """Generates profile picture variants on a background thread pool.
+
+    Requests never wait for it: until a variant exists the original is served.
+    A worker count of 0 generates variants inline (used by the test suite).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {'submitted': 0, 'generated': 0, 'failed': 0}
+
+    def _get_executor(self, workers):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails')
+            return self._executor
+
+    def _run(self, upload_path, filename):
+        try:
+            created = generate_variants(upload_path, filename)
+        except Exception as e:
+            with self._lock:
+                self._stats['failed'] += 1
+            print(f"Error generating thumbnails for {filename}: {e}")
+            return
+        with self._lock:
+            self._stats['generated'] += created
+
+    def submit(self, upload_path, filename):
+        """Queue variant generation for a stored picture"""
+        workers = current_app.config.get('THUMBNAIL_WORKERS', 2)
+        with self._lock:
+            self._stats['submitted'] += 1
+
+        if workers <= 0:
+            self._run(upload_path, filename)
+            return None
+        return self._get_executor(workers).submit(self._run, upload_path, filename)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+thumbnail_pipeline = ThumbnailPipeline()
@@ -0,0 +1,430 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, User, ProfilePictureFile
+
+# Leading bytes of each accepted image format, mapped to the stored extension
+IMAGE_SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'\xff\xd8\xff': 'jpg',
+    b'GIF87a': 'gif',
+    b'GIF89a': 'gif',
+}
+SIGNATURE_LENGTH = max(len(signature) for signature in IMAGE_SIGNATURES)
+EXTENSION_TYPES = {'png': 'png', 'jpg': 'jpg', 'jpeg': 'jpg', 'gif': 'gif'}
+
+INVALID_TYPE_MESSAGE = 'Invalid file type. Only PNG, JPG, JPEG, and GIF are allowed'
+
+# Files live in <upload folder>/ab/cd/abcd...; two levels of 256 directories
+# keep each directory small even with hundreds of thousands of pictures
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+TEMP_PREFIX = '.upload-'
+
+
+def shard_parts(filename):
+    return [filename[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+
+
+def shard_directory(upload_path, filename):
+    """Directory holding ``filename`` and its variants"""
+    return os.path.join(upload_path, *shard_parts(filename))
+
+
+def relative_stored_path(filename):
+    """Path of ``filename`` relative to the upload folder, using forward slashes"""
+    return '/'.join(shard_parts(filename) + [filename])
+
+
+def locate_stored_file(upload_path, filename):
+    """Return ``(directory, path relative to the upload folder)`` of a stored file.
+
+    Pictures uploaded before sharding sit directly in the upload folder until
+    ``reconcile_uploads`` moves them, so that location is used when the file
+    isn't in its shard.
+    """
+    directory = shard_directory(upload_path, filename)
+    if not os.path.exists(os.path.join(directory, filename)) and \
+            os.path.exists(os.path.join(upload_path, filename)):
+        return upload_path, filename
+    return directory, relative_stored_path(filename)
+
+
+class UploadRejected(Exception):
+    """Raised while an upload is still arriving to stop reading it"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def detect_image_type(head):
+    for signature, image_type in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return image_type
+    return None
+
+
+class HashingUploadStream:
+    """Temporary file that hashes, size-checks and sniffs each chunk as it is written.
+
+    Werkzeug's multipart parser writes into this object directly, so an upload
+    is never buffered in memory and is rejected as soon as it crosses
+    ``max_bytes`` or starts with bytes that aren't an allowed image.
+    """
+
+    def __init__(self, directory, max_bytes, allowed_types=None):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix=TEMP_PREFIX, delete=False)
+        self.path = self._file.name
+        self.max_bytes = max_bytes
+        self.allowed_types = allowed_types
+        self.size = 0
+        self.image_type = None
+        self._head = b''
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadRejected('File is too large', 413)
+
+        if self.allowed_types is not None and self.image_type is None:
+            self._head += data[:SIGNATURE_LENGTH]
+            if len(self._head) >= SIGNATURE_LENGTH:
+                self._check_type()
+
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def _check_type(self):
+        self.image_type = detect_image_type(self._head)
+        if self.image_type not in self.allowed_types:
+            raise UploadRejected(INVALID_TYPE_MESSAGE)
+
+    def finish(self):
+        """Validate the complete upload and return ``(sha256 hex digest, image type)``"""
+        if self.image_type is None:
+            self._check_type()
+        self._file.flush()
+        return self._sha256.hexdigest(), self.image_type
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def parse_streamed_upload(req, directory, max_bytes, allowed_extensions):
+    """Parse ``req``'s multipart body, streaming file parts straight into ``directory``.
+
+    Returns ``(files, streams)``; the caller must ``discard()`` every stream it
+    doesn't keep.
+    """
+    allowed_types = {EXTENSION_TYPES[extension] for extension in allowed_extensions}
+    streams = []
+
+    def stream_factory(total_content_length, content_type, filename=None, content_length=None):
+        if filename:
+            extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+            if extension not in allowed_extensions:
+                raise UploadRejected(INVALID_TYPE_MESSAGE)
+        stream = HashingUploadStream(directory, max_bytes, allowed_types if filename else None)
+        streams.append(stream)
+        return stream
+
+    # Werkzeug looks the factory up on the request when it parses the form
+    req._get_file_stream = stream_factory
+    try:
+        return req.files, streams
+    except Exception:
+        for stream in streams:
+            stream.discard()
+        raise
+
+
+def store_upload(stream, directory):
+    """Link a finished upload to its content-addressed name and return the filename.
+
+    Identical content is stored once: if the file already exists it is reused.
+    The temporary copy is kept until the caller has called ``acquire_file``,
+    committed and called ``ensure_stored``; discarding the stream drops it.
+    """
+    digest, image_type = stream.finish()
+    filename = f"{digest}.{image_type}"
+    stream.close()
+
+    final_directory = shard_directory(directory, filename)
+    os.makedirs(final_directory, exist_ok=True)
+    final_path = os.path.join(final_directory, filename)
+    if not os.path.exists(final_path):
+        try:
+            os.link(stream.path, final_path)
+        except FileExistsError:
+            # The same content arrived concurrently
+            pass
+    return filename
+
+
+def ensure_stored(stream, directory, filename):
+    """Put an upload back if a cleanup of the same content deleted it before our reference committed"""
+    final_directory = shard_directory(directory, filename)
+    final_path = os.path.join(final_directory, filename)
+    if not os.path.exists(final_path):
+        os.makedirs(final_directory, exist_ok=True)
+        os.replace(stream.path, final_path)
+
+
+def _increment_ref_count(filename, amount=1):
+    # Done in SQL so concurrent uploads and deletes of the same content can't lose an update
+    return ProfilePictureFile.query.filter_by(filename=filename).update(
+        {'ref_count': ProfilePictureFile.ref_count + amount}, synchronize_session=False
+    )
+
+
+def acquire_file(filename, size):
+    """Add a reference to a stored file in the current transaction"""
+    if _increment_ref_count(filename):
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(ProfilePictureFile(filename=filename, size=size, ref_count=1))
+    except IntegrityError:
+        # A concurrent first upload of the same content inserted the row
+        _increment_ref_count(filename)
+
+
+def release_file(filename):
+    """Drop a reference in the current transaction.
+
+    Returns True when nothing references the file any more, so it can be
+    deleted from disk once the transaction commits. Files uploaded before
+    reference counting have no row and are treated as singly referenced.
+    """
+    if not _increment_ref_count(filename, -1):
+        return True
+
+    remaining = db.session.query(ProfilePictureFile.ref_count).filter_by(filename=filename).scalar()
+    if remaining <= 0:
+        ProfilePictureFile.query.filter_by(filename=filename).delete(synchronize_session=False)
+        return True
+    return False
+
+
+def _is_referenced(filename):
+    # End any read transaction first so the answer reflects the latest commits
+    db.session.rollback()
+    return db.session.query(ProfilePictureFile.id).filter_by(filename=filename).first() is not None
+
+
+def _has_users(filename):
+    db.session.rollback()
+    return db.session.query(User.id).filter_by(profile_picture=filename).first() is not None
+
+
+def remove_unreferenced_file(upload_path, filename):
+    """Delete a stored picture unless it has been referenced again; return True if it was deleted.
+
+    This runs after the releasing transaction commits, so another upload of
+    the same content may have acquired the file in the meantime. The file is
+    moved aside before ``profile_picture_files`` is checked and moved back if
+    a row exists. An upload whose reference commits after the check finds the
+    file gone and restores it from its own copy with ``ensure_stored``.
+    """
+    if _is_referenced(filename):
+        return False
+    directory, _ = locate_stored_file(upload_path, filename)
+    path = os.path.join(directory, filename)
+    aside = os.path.join(directory, f"{TEMP_PREFIX}{uuid.uuid4().hex}-{filename}")
+    try:
+        os.replace(path, aside)
+    except FileNotFoundError:
+        return False
+
+    if _is_referenced(filename):
+        os.replace(aside, path)
+        return False
+    os.remove(aside)
+    return True
+
+
+def remove_stored_files(upload_path, filenames):
+    """Delete stored files from their shard, or the flat pre-sharding location, if they exist"""
+    removed = 0
+    for filename in filenames:
+        for directory in (shard_directory(upload_path, filename), upload_path):
+            file_path = os.path.join(directory, filename)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                removed += 1
+    return removed
+
+
+class FileRemover:
+    """Deletes unreferenced files on a background thread, off the request path.
+
+    A worker count of 0 deletes inline (used by the test suite). Anything lost
+    to a crash is picked up later by ``reconcile_uploads``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {'submitted': 0, 'removed': 0, 'reacquired': 0, 'failed': 0}
+
+    def _run(self, app, upload_path, filename, derived_filenames):
+        with app.app_context():
+            try:
+                if not remove_unreferenced_file(upload_path, filename):
+                    with self._lock:
+                        self._stats['reacquired'] += 1
+                    return
+                removed = 1 + remove_stored_files(upload_path, derived_filenames)
+            except (OSError, SQLAlchemyError) as e:
+                with self._lock:
+                    self._stats['failed'] += 1
+                print(f"Error removing {filename}: {e}")
+                return
+        with self._lock:
+            self._stats['removed'] += removed
+
+    def submit(self, upload_path, filename, derived_filenames=()):
+        """Delete ``filename`` and the files derived from it unless it is referenced again first"""
+        app = current_app._get_current_object()
+        workers = app.config.get('UPLOAD_CLEANUP_WORKERS', 1)
+        with self._lock:
+            self._stats['submitted'] += 1
+            if workers > 0 and self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload-cleanup')
+
+        if workers <= 0:
+            self._run(app, upload_path, filename, derived_filenames)
+            return None
+        return self._executor.submit(self._run, app, upload_path, filename, derived_filenames)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+file_remover = FileRemover()
+
+
+def reconcile_uploads(upload_path, related_filenames, dry_run=False, grace_seconds=3600):
+    """Bring the upload folder and ``profile_picture_files`` in line with ``users.profile_picture``.
+
+    Moves files left in the flat pre-sharding layout into their shard, deletes
+    every file no user references and resets reference counts from users.
+    ``related_filenames(filename)`` names the derived files (resized variants)
+    that belong to a referenced picture. Files newer than ``grace_seconds`` are
+    left alone so uploads that haven't committed yet survive.
+
+    The walk can take minutes, so uploads commit while it runs: each orphan is
+    checked against users again right before it is deleted, and the counts are
+    recomputed in single statements at the end rather than written back from
+    the snapshot taken here. Returns a report of what was, or with ``dry_run``
+    would be, changed.
+    """
+    report = {'resharded': 0, 'orphans': [], 'bytes_freed': 0, 'counts_fixed': 0}
+
+    references = dict(
+        db.session.query(User.profile_picture, func.count(User.id))
+        .filter(User.profile_picture.isnot(None))
+        .group_by(User.profile_picture)
+        .all()
+    )
+    keep = set()
+    for filename in references:
+        keep.add(filename)
+        keep.update(related_filenames(filename))
+
+    cutoff = time.time() - grace_seconds
+    sizes = {}
+    for root, _, files in os.walk(upload_path):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+
+            if name not in keep:
+                # Checked again in case an upload took it up after the snapshot
+                if stat.st_mtime <= cutoff and not _has_users(name):
+                    report['orphans'].append(name)
+                    report['bytes_freed'] += stat.st_size
+                    if not dry_run:
+                        os.remove(path)
+                continue
+
+            sizes[name] = stat.st_size
+            # Pre-sharding uploads sit directly in the upload folder
+            if root == upload_path:
+                report['resharded'] += 1
+                if not dry_run:
+                    target_directory = shard_directory(upload_path, name)
+                    os.makedirs(target_directory, exist_ok=True)
+                    os.replace(path, os.path.join(target_directory, name))
+
+    # Reference counts are recomputed from users rather than trusted
+    db.session.rollback()
+    missing = (set(references) & set(sizes)) - {
+        filename for (filename,) in db.session.query(ProfilePictureFile.filename)
+    }
+    for filename in missing:
+        try:
+            with db.session.begin_nested():
+                db.session.add(ProfilePictureFile(filename=filename, size=sizes[filename],
+                                                  ref_count=references[filename]))
+            report['counts_fixed'] += 1
+        except IntegrityError:
+            # Acquired by an upload since the walk
+            pass
+    # One GROUP BY over users joined in, as users.profile_picture has no index
+    user_counts = (select(User.profile_picture.label('filename'), func.count(User.id).label('ref_count'))
+                   .where(User.profile_picture.isnot(None))
+                   .group_by(User.profile_picture)
+                   .subquery())
+    report['counts_fixed'] += db.session.execute(
+        update(ProfilePictureFile)
+        .where(ProfilePictureFile.filename == user_counts.c.filename,
+               ProfilePictureFile.ref_count != user_counts.c.ref_count)
+        .values(ref_count=user_counts.c.ref_count)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    report['counts_fixed'] += ProfilePictureFile.query.filter(
+        ProfilePictureFile.filename.notin_(select(User.profile_picture).where(User.profile_picture.isnot(None)))
+    ).delete(synchronize_session=False)
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return report
@@ -0,0 +1,87 @@
+import threading
+import time
+import sys
+import os
+from collections import OrderedDict
+from flask import current_app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, User
+
+
+class UserCache:
+    """Per-process LRU cache of serialized ``User.to_dict()`` payloads with a TTL.
+
+    Writers must call ``set`` or ``invalidate`` after committing a change to a
+    user row so readers never see a stale profile for longer than one request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def _settings(self):
+        config = current_app.config
+        return config.get('USER_CACHE_SIZE', 1024), config.get('USER_CACHE_TTL', 30)
+
+    def get(self, user_id):
+        """Return the cached payload for ``user_id`` or None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            payload, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self._stats['hits'] += 1
+            return payload
+
+    def set(self, user_id, payload):
+        max_size, ttl = self._settings()
+        if max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (payload, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+user_cache = UserCache()
+
+
+def get_user_payload(user_id):
+    """Return ``User.to_dict()`` for ``user_id``, loading it on a cache miss"""
+    payload = user_cache.get(user_id)
+    if payload is None:
+        user = db.session.get(User, user_id)
+        if not user:
+            return None
+        payload = user.to_dict()
+        user_cache.set(user_id, payload)
+    return payload
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from flask import current_app
+
+
+class VerifiedSessionCache:
+    """Checkout session ids whose payment has already been verified.
+
+    A paid checkout session never becomes unpaid, so once ``verify_payment``
+    has confirmed one it only needs to check the membership it created.
+    Polling and page refreshes then skip Stripe entirely. Entries map the
+    session id to its subscription id and are evicted least recently used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, session_id):
+        """Return the subscription id for a verified session, or None"""
+        with self._lock:
+            subscription_id = self._sessions.get(session_id)
+            if subscription_id is None:
+                self._stats['misses'] += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            self._stats['hits'] += 1
+            return subscription_id
+
+    def add(self, session_id, subscription_id):
+        max_size = current_app.config.get('VERIFIED_SESSION_CACHE_SIZE', 10000)
+        if max_size <= 0:
+            return
+        with self._lock:
+            self._sessions[session_id] = subscription_id
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > max_size:
+                self._sessions.popitem(last=False)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._stats = {'hits': 0, 'misses': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._sessions)
+            return stats
+
+
+verified_sessions = VerifiedSessionCache()
@@ -0,0 +1,109 @@
+import threading
+import time
+import sys
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import current_app
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, ProcessedWebhookEvent
+
+
+class ProcessedEventStore:
+    """Remembers which Stripe event ids have been applied.
+
+    The ``processed_webhook_events`` table, unique on the event id, is the
+    source of truth and is shared by every process. A bounded in-memory set of
+    recently processed ids answers most redeliveries without a query. A miss in
+    memory falls through to the table, so a positive answer is always correct.
+    The marker row is staged in the same transaction as the handler's changes,
+    so an event is recorded exactly when its effects are committed. Rows older
+    than the retention window are pruned periodically.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recent = OrderedDict()
+        self._last_prune = time.monotonic()
+        self._stats = {'memory_hits': 0, 'db_hits': 0, 'recorded': 0, 'pruned': 0}
+
+    def _settings(self):
+        config = current_app.config
+        return (config.get('WEBHOOK_DEDUP_MEMORY_SIZE', 10000),
+                config.get('WEBHOOK_DEDUP_RETENTION_DAYS', 30),
+                config.get('WEBHOOK_DEDUP_PRUNE_INTERVAL', 3600))
+
+    def _remember(self, event_id):
+        max_size = self._settings()[0]
+        if max_size <= 0:
+            return
+        with self._lock:
+            self._recent[event_id] = datetime.utcnow()
+            self._recent.move_to_end(event_id)
+            while len(self._recent) > max_size:
+                self._recent.popitem(last=False)
+
+    def is_processed(self, event_id):
+        """Return True if ``event_id`` has already been applied"""
+        if not event_id:
+            return False
+        with self._lock:
+            if event_id in self._recent:
+                self._stats['memory_hits'] += 1
+                return True
+
+        found = db.session.query(ProcessedWebhookEvent.id).filter_by(stripe_event_id=event_id).first()
+        if found is None:
+            return False
+        with self._lock:
+            self._stats['db_hits'] += 1
+        self._remember(event_id)
+        return True
+
+    def stage(self, event_id, event_type):
+        """Add the marker row to the current transaction; commit it with the handler's changes"""
+        db.session.add(ProcessedWebhookEvent(stripe_event_id=event_id, event_type=event_type))
+
+    def committed(self, event_id):
+        """Note that a staged marker was committed and prune if one is due"""
+        self._remember(event_id)
+        with self._lock:
+            self._stats['recorded'] += 1
+            prune_due = time.monotonic() - self._last_prune >= self._settings()[2]
+            if prune_due:
+                self._last_prune = time.monotonic()
+        if prune_due:
+            self.prune()
+
+    def prune(self, retention_days=None):
+        """Delete markers older than the retention window; return how many were removed"""
+        if retention_days is None:
+            retention_days = self._settings()[1]
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+        removed = ProcessedWebhookEvent.query.filter(
+            ProcessedWebhookEvent.processed_at < cutoff
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+        with self._lock:
+            for event_id in [key for key, seen_at in self._recent.items() if seen_at < cutoff]:
+                del self._recent[event_id]
+            self._stats['pruned'] += removed
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._last_prune = time.monotonic()
+            self._stats = {'memory_hits': 0, 'db_hits': 0, 'recorded': 0, 'pruned': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_size'] = len(self._recent)
+        stats['duplicates'] = stats['memory_hits'] + stats['db_hits']
+        return stats
+
+
+processed_events = ProcessedEventStore()
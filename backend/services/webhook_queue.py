@@ -0,0 +1,212 @@
+import json
+import random
+import threading
+import traceback
+import sys
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import db, WebhookEvent, WebhookDeadLetter
+
+
+class WebhookQueue:
+    """Durable queue of Stripe webhooks stored in the ``webhook_events`` table.
+
+    ``enqueue`` only inserts a row, so the webhook endpoint can acknowledge
+    Stripe within milliseconds. Worker threads claim due rows under a lease,
+    run ``handler(events)`` and delete the rows on success. Events given a
+    ``group_key`` wait ``WEBHOOK_COALESCE_WINDOW`` seconds and are then claimed
+    together with every other queued event for that key, so the handler sees
+    the whole burst at once. Delivery is
+    at-least-once: a worker that dies mid-event lets its lease expire and the
+    event is picked up again. Failures are retried with exponential backoff and
+    jitter, then parked in ``webhook_dead_letters``. Workers are started with
+    ``start`` on the first request a process serves; ``drain`` processes the
+    backlog from a command instead. A worker count of 0 processes events
+    inline on the request (used by the test suite).
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._stats = {'enqueued': 0, 'processed': 0, 'retried': 0, 'dead_lettered': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def enqueue(self, payload, event_type, stripe_event_id=None, group_key=None):
+        """Persist a received event and hand it to the workers"""
+        window = current_app.config.get('WEBHOOK_COALESCE_WINDOW', 2) if group_key else 0
+        db.session.add(WebhookEvent(
+            stripe_event_id=stripe_event_id,
+            event_type=event_type,
+            payload=payload,
+            group_key=group_key,
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=window)
+        ))
+        db.session.commit()
+        self._count('enqueued')
+
+        if current_app.config.get('WEBHOOK_WORKERS', 2) <= 0:
+            self.drain()
+        else:
+            # Workers were started by the request hook; just wake one up
+            self._wakeup.set()
+
+    def start(self, app):
+        """Start this process's workers if they aren't running.
+
+        Workers begin by draining whatever is already due, so events stored
+        before a restart, including retries waiting out their backoff, don't
+        wait for the next webhook to reach this process.
+        """
+        if app.config.get('WEBHOOK_WORKERS', 2) > 0:
+            self._ensure_workers(app)
+
+    def _lease(self, event_id, available, until):
+        # Conditional update so only one worker wins the row
+        claimed = WebhookEvent.query.filter(WebhookEvent.id == event_id, available).update(
+            {'locked_until': until}, synchronize_session=False
+        )
+        db.session.commit()
+        return claimed == 1
+
+    def _claim(self):
+        """Lease the oldest due event and the rest of its group; empty when nothing is due"""
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=current_app.config.get('WEBHOOK_LEASE_SECONDS', 300))
+        available = or_(WebhookEvent.locked_until.is_(None), WebhookEvent.locked_until < now)
+
+        while True:
+            candidate = db.session.query(WebhookEvent.id, WebhookEvent.group_key).filter(
+                WebhookEvent.next_attempt_at <= now, available
+            ).order_by(WebhookEvent.next_attempt_at, WebhookEvent.id).first()
+            if candidate is None:
+                db.session.rollback()
+                return []
+            if not self._lease(candidate.id, available, until):
+                continue
+
+            claimed = [candidate.id]
+            if candidate.group_key:
+                # Sweep up the rest of the burst, including events still inside their window
+                siblings = db.session.query(WebhookEvent.id).filter(
+                    WebhookEvent.group_key == candidate.group_key,
+                    WebhookEvent.id != candidate.id,
+                    available
+                ).order_by(WebhookEvent.id).all()
+                claimed += [row.id for row in siblings if self._lease(row.id, available, until)]
+            return WebhookEvent.query.filter(WebhookEvent.id.in_(claimed)).order_by(WebhookEvent.id).all()
+
+    def _retry_delay(self, attempts):
+        config = current_app.config
+        delay = min(config.get('WEBHOOK_RETRY_BASE_DELAY', 2) * (2 ** (attempts - 1)),
+                    config.get('WEBHOOK_RETRY_MAX_DELAY', 3600))
+        return delay * random.uniform(0.5, 1.0)
+
+    def process_one(self):
+        """Claim and process one due event or group; return how many events were handled"""
+        batch = self._claim()
+        if not batch:
+            return 0
+
+        event_ids = [queued.id for queued in batch]
+        try:
+            self.handler([json.loads(queued.payload) for queued in batch])
+            WebhookEvent.query.filter(WebhookEvent.id.in_(event_ids)).delete(synchronize_session=False)
+            db.session.commit()
+            self._count('processed', len(event_ids))
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error processing webhooks {event_ids}: {e}")
+            error = traceback.format_exc()
+            for event_id in event_ids:
+                self._record_failure(event_id, error)
+        return len(event_ids)
+
+    def _record_failure(self, event_id, error):
+        queued = db.session.get(WebhookEvent, event_id)
+        queued.attempts += 1
+        queued.last_error = error
+
+        if queued.attempts >= current_app.config.get('WEBHOOK_MAX_ATTEMPTS', 8):
+            db.session.add(WebhookDeadLetter(
+                stripe_event_id=queued.stripe_event_id,
+                event_type=queued.event_type,
+                payload=queued.payload,
+                attempts=queued.attempts,
+                last_error=error,
+                received_at=queued.created_at
+            ))
+            db.session.delete(queued)
+            self._count('dead_lettered')
+        else:
+            queued.next_attempt_at = datetime.utcnow() + timedelta(seconds=self._retry_delay(queued.attempts))
+            queued.locked_until = None
+            self._count('retried')
+        db.session.commit()
+
+    def drain(self):
+        """Process events until none are due; return how many were handled"""
+        handled = 0
+        while True:
+            processed = self.process_one()
+            if not processed:
+                return handled
+            handled += processed
+
+    def _ensure_workers(self, app):
+        if self._threads and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._worker_loop, args=(app,), name=f'webhook-worker-{i}', daemon=True)
+                for i in range(app.config.get('WEBHOOK_WORKERS', 2))
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def _worker_loop(self, app):
+        with app.app_context():
+            poll_interval = app.config.get('WEBHOOK_POLL_INTERVAL', 1)
+            while not self._stopping.is_set():
+                try:
+                    processed = self.process_one()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Webhook worker error: {e}")
+                    processed = False
+                finally:
+                    db.session.remove()
+                if not processed:
+                    # Woken early by new events; polling picks up retries coming due
+                    self._wakeup.wait(poll_interval)
+                    self._wakeup.clear()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        """Counters plus current depth, lag and dead-letter count"""
+        with self._lock:
+            stats = dict(self._stats)
+        depth, oldest = db.session.query(func.count(WebhookEvent.id), func.min(WebhookEvent.created_at)).one()
+        stats['depth'] = depth
+        stats['lag_seconds'] = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+        stats['dead_letters'] = db.session.query(func.count(WebhookDeadLetter.id)).scalar()
+        return stats
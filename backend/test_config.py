@@ -1,17 +1,74 @@
 import os
+import atexit
+import shutil
 import tempfile
 import pytest
+from contextlib import contextmanager
+from flask import Flask, has_app_context
+from flask_migrate import Migrate, upgrade
+from sqlalchemy import event
+# The engine is created when app.py is imported, so the scratch database is chosen first
+TEST_DATA_DIR = tempfile.mkdtemp(prefix='exchange-tests-')
+atexit.register(shutil.rmtree, TEST_DATA_DIR, ignore_errors=True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TEST_DATA_DIR, 'test.db')
 from app import app
 from models import db, User, Membership, PaymentHistory
+from services.user_cache import user_cache
+from services.availability import identity_index
+from services.subscription_cache import subscription_cache
+from services.webhook_idempotency import processed_events
+from services.webhook_coalescing import webhook_coalescer
+from services.verified_sessions import verified_sessions
+from routes.auth import auth_bp
+from routes.stripe import stripe_bp, stripe_guard, plan_catalog
 
-@pytest.fixture
-def client():
-    """Create a test client for the Flask app."""
-    # Use in-memory SQLite database for better isolation
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+def reset_app():
+    """Apply the test configuration and empty every per-process cache."""
     app.config['TESTING'] = True
     app.config['SECRET_KEY'] = 'test-secret-key'
     app.config['WTF_CSRF_ENABLED'] = False
+    # Run background work inline so tests are deterministic and can patch it
+    app.config['PASSWORD_HASH_POOL_SIZE'] = 0
+    app.config['THUMBNAIL_WORKERS'] = 0
+    app.config['UPLOAD_CLEANUP_WORKERS'] = 0
+    app.config['WEBHOOK_WORKERS'] = 0
+    app.config['WEBHOOK_COALESCE_WINDOW'] = 0
+    app.config['STRIPE_CUSTOMER_WORKERS'] = 0
+    app.config['IDENTITY_FILTER_WORKERS'] = 0
+    # Registration only reaches Stripe in tests that ask for it
+    app.config['STRIPE_CUSTOMER_PREPROVISION'] = False
+    app.config['IDENTITY_FILTER_MERGE_INTERVAL'] = 5
+    app.config['IDENTITY_FILTER_REBUILD_INTERVAL'] = 600
+    # User ids are reused across tests, so start each one with cold caches
+    user_cache.clear()
+    identity_index.reset()
+    subscription_cache.clear()
+    processed_events.clear()
+    webhook_coalescer.clear()
+    stripe_guard.reset()
+    verified_sessions.clear()
+    plan_catalog.clear()
+
+def migrated_app(database_path, revision='head'):
+    """The app's routes and configuration on their own SQLite file, migrated up to ``revision``"""
+    reset_app()
+    migrated = Flask(app.import_name)
+    migrated.config.from_mapping(app.config)
+    migrated.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{database_path}'
+    db.init_app(migrated)
+    Migrate(migrated, db, directory=MIGRATIONS)
+    migrated.register_blueprint(auth_bp, url_prefix='/api')
+    migrated.register_blueprint(stripe_bp, url_prefix='/api/stripe')
+    with migrated.app_context():
+        upgrade(directory=MIGRATIONS, revision=revision)
+    return migrated
+
+@pytest.fixture
+def client():
+    """Create a test client for the Flask app."""
+    reset_app()
     
     with app.test_client() as client:
         with app.app_context():
@@ -59,4 +116,23 @@ def sample_membership():
         'plan_type': 'monthly',
         'status': 'active',
         'stripe_subscription_id': 'sub_test123'
-    } 
\ No newline at end of file
+    } 
+
+@contextmanager
+def captured_statements():
+    """Collect the ``(sql, parameters)`` of every statement run on the current app's engine while the block executes."""
+    statements = []
+    
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    
+    if has_app_context():
+        engine = db.engine
+    else:
+        with app.app_context():
+            engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
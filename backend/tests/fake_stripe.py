@@ -0,0 +1,111 @@
+"""Local stand-in for the Stripe API used by tests that exercise real HTTP calls."""
+import json
+import threading
+import time
+import pytest
+import stripe
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Object type returned for each top-level API path
+RESOURCES = {
+    'customers': 'customer',
+    'subscriptions': 'subscription',
+    'payment_intents': 'payment_intent',
+    'invoices': 'invoice',
+    'prices': 'price',
+    'products': 'product',
+    'checkout.sessions': 'checkout.session',
+}
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = parse_qs(self.rfile.read(length).decode()) if length else {}
+        url = urlparse(self.path)
+
+        with server.lock:
+            server.requests.append((method, url.path, body))
+            status = server.fail_statuses.pop(0) if server.fail_statuses else 200
+        if server.latency:
+            time.sleep(server.latency)
+
+        parts = url.path.strip('/').split('/')
+        if parts[:2] == ['v1', 'checkout'] and len(parts) > 2:
+            parts = ['v1', 'checkout.' + parts[2]] + parts[3:]
+        resource = parts[1] if len(parts) > 1 else ''
+        object_id = parts[2] if len(parts) > 2 else f"{resource[:3]}_fake{len(server.requests)}"
+
+        if status >= 400:
+            payload = {'error': {'type': 'api_error', 'message': 'Injected failure'}}
+        elif object_id in server.objects:
+            payload = server.objects[object_id]
+        else:
+            payload = {'id': object_id, 'object': RESOURCES.get(resource, resource)}
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Request-Id', f"req_{len(server.requests)}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def do_DELETE(self):
+        self._respond('DELETE')
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeStripeHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        # Seconds to sleep before every response
+        self.latency = 0
+        # Status codes for the next responses, e.g. [500, 500]
+        self.fail_statuses = []
+        # Canned payloads by object id
+        self.objects = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+@pytest.fixture
+def fake_stripe():
+    """Point the Stripe SDK at a local fake API for the duration of a test."""
+    server = FakeStripeServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    original_api_base, original_api_key = stripe.api_base, stripe.api_key
+    stripe.api_base = server.url
+    stripe.api_key = original_api_key or 'sk_test_fake'
+    try:
+        yield server
+    finally:
+        stripe.api_base, stripe.api_key = original_api_base, original_api_key
+        server.shutdown()
+        server.server_close()
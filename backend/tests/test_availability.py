@@ -0,0 +1,172 @@
+import pytest
+import json
+import time
+from unittest.mock import patch
+from models import db, User
+from services.availability import BloomFilter, identity_index
+from test_config import client, sample_user
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+class TestBloomFilter:
+    """Test the Bloom filter itself."""
+
+    def test_no_false_negatives(self):
+        """Test that every added value is reported as present."""
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        values = [f'user{i}@example.com' for i in range(1000)]
+        for value in values:
+            bloom.add(value)
+
+        assert all(bloom.might_contain(value) for value in values)
+
+    def test_false_positive_rate_near_target(self):
+        """Test that absent values are rarely reported as present."""
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f'user{i}')
+
+        false_positives = sum(bloom.might_contain(f'absent{i}') for i in range(10000))
+        assert false_positives < 300
+
+class TestRegisterAvailability:
+    """Test username/email availability checks."""
+
+    def test_duplicate_rejected_before_hashing(self, client, sample_user):
+        """Test that a taken username fails with 409 without hashing the password."""
+        client.post('/api/register',
+                   data=json.dumps(sample_user),
+                   content_type='application/json')
+
+        duplicate_user = sample_user.copy()
+        duplicate_user['email'] = 'different@example.com'
+        with patch('routes.auth.password_hasher.run') as mock_run:
+            response = client.post('/api/register',
+                                 data=json.dumps(duplicate_user),
+                                 content_type='application/json')
+            mock_run.assert_not_called()
+
+        assert response.status_code == 409
+
+    def test_new_user_skips_probe(self, client, sample_user):
+        """Test that a definite Bloom filter miss needs no database probe."""
+        response = client.post('/api/register',
+                             data=json.dumps(sample_user),
+                             content_type='application/json')
+
+        assert response.status_code == 201
+        stats = identity_index.stats()
+        assert stats['probes_skipped'] == 2
+        assert stats['probes'] == 0
+
+    def test_filter_warmed_from_existing_users(self, client):
+        """Test that users already in the table are known after warm-up."""
+        with client.application.app_context():
+            db.session.add(User(username='existing', email='existing@example.com', password_hash='hash'))
+            db.session.commit()
+
+        response = client.get('/api/register/availability?username=existing&email=new@example.com')
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['username']['available'] is False
+        assert data['email']['available'] is True
+
+    def test_users_from_other_processes_merged(self, client):
+        """Test that users inserted behind the warm filters are picked up."""
+        client.application.config['IDENTITY_FILTER_MERGE_INTERVAL'] = 0
+        client.get('/api/register/availability?username=warmup')
+        with client.application.app_context():
+            db.session.add(User(username='elsewhere', email='elsewhere@example.com', password_hash='hash'))
+            db.session.commit()
+
+        response = client.get('/api/register/availability?username=elsewhere&email=elsewhere@example.com')
+
+        data = json.loads(response.data)
+        assert data['username']['available'] is False
+        assert data['email']['available'] is False
+        assert identity_index.stats()['merged'] == 1
+
+    def test_changed_emails_picked_up_on_rebuild(self, client):
+        """Test that a full rebuild sees emails changed by other processes."""
+        client.application.config['IDENTITY_FILTER_REBUILD_INTERVAL'] = 0
+        with client.application.app_context():
+            user = User(username='mover', email='old@example.com', password_hash='hash')
+            db.session.add(user)
+            db.session.commit()
+            client.get('/api/register/availability?email=old@example.com')
+            user.email = 'new@example.com'
+            db.session.commit()
+
+        response = client.get('/api/register/availability?email=new@example.com')
+
+        assert json.loads(response.data)['email']['available'] is False
+        assert identity_index.stats()['rebuilds'] == 2
+
+    def test_background_thread_warms_and_merges(self, client):
+        """Test that the refresh thread builds the filters and merges new users off the request path."""
+        app = client.application
+        with app.app_context():
+            db.session.add(User(username='existing', email='existing@example.com', password_hash='hash'))
+            db.session.commit()
+        app.config['IDENTITY_FILTER_WORKERS'] = 1
+        app.config['IDENTITY_FILTER_MERGE_INTERVAL'] = 0.01
+        try:
+            # Any request starts the thread
+            client.get('/api/health')
+            wait_for(lambda: identity_index.stats()['rebuilds'] >= 1)
+            with app.app_context():
+                db.session.add(User(username='elsewhere', email='elsewhere@example.com', password_hash='hash'))
+                db.session.commit()
+            wait_for(lambda: identity_index.stats()['merged'] >= 1)
+
+            response = client.get('/api/register/availability?username=elsewhere&email=existing@example.com')
+
+            data = json.loads(response.data)
+            assert data['username']['available'] is False
+            assert data['email']['available'] is False
+            assert identity_index.stats()['rebuilds'] == 1
+        finally:
+            identity_index.stop()
+            app.config['IDENTITY_FILTER_WORKERS'] = 0
+            app.config['IDENTITY_FILTER_MERGE_INTERVAL'] = 5
+
+    def test_values_added_during_rebuild_are_kept(self, client):
+        """Test that a registration made while the table is read survives the swap."""
+        with client.application.app_context():
+            db.session.add(User(username='existing', email='existing@example.com', password_hash='hash'))
+            db.session.commit()
+
+            original_add = BloomFilter.add
+            def add_during_rebuild(bloom_filter, value):
+                if value == 'existing':
+                    identity_index.add(username='racer')
+                original_add(bloom_filter, value)
+            with patch.object(BloomFilter, 'add', add_during_rebuild):
+                identity_index.refresh()
+
+            # In the filter although not in the table, so it is probed
+            assert identity_index.is_taken('username', 'racer') is False
+            assert identity_index.stats()['false_positives'] == 1
+
+    def test_availability_after_register(self, client, sample_user):
+        """Test that a freshly registered email is reported as taken."""
+        client.post('/api/register',
+                   data=json.dumps(sample_user),
+                   content_type='application/json')
+
+        response = client.get(f"/api/register/availability?email={sample_user['email']}")
+
+        data = json.loads(response.data)
+        assert data['email']['available'] is False
+        assert 'username' not in data
+
+    def test_availability_requires_a_value(self, client):
+        """Test that the endpoint needs a username or email."""
+        response = client.get('/api/register/availability')
+
+        assert response.status_code == 400
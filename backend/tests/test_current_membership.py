@@ -0,0 +1,207 @@
+import pytest
+import json
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+from flask_migrate import upgrade
+from models import db, User, Membership, CurrentMembership
+from services.current_membership import refresh_current_memberships
+from services.stripe_sync import sync_subscription_batch
+from test_config import client, auth_client, captured_statements, migrated_app, MIGRATIONS
+
+def current_membership(client, user_id):
+    with client.application.app_context():
+        current = db.session.get(CurrentMembership, user_id)
+        return current and (current.plan_type, current.status)
+
+def subscribe(client):
+    with patch('routes.stripe.stripe.Customer.create', return_value=MagicMock(id='cus_test123')), \
+            patch('routes.stripe.stripe.Subscription.create',
+                  return_value=MagicMock(id='sub_test123', status='active')):
+        return client.post('/api/stripe/create-subscription',
+                           data=json.dumps({'price_id': 'price_monthly', 'plan_type': 'monthly'}),
+                           content_type='application/json')
+
+@pytest.fixture
+def user_id(auth_client):
+    with auth_client.session_transaction() as sess:
+        return sess['user_id']
+
+class TestCurrentMembership:
+    """Test the per-user current membership summary."""
+
+    def test_status_is_one_primary_key_lookup(self, auth_client, user_id):
+        """Test that the status check reads only the summary row."""
+        assert subscribe(auth_client).status_code == 200
+
+        with captured_statements() as statements:
+            response = auth_client.get('/api/stripe/membership/status')
+
+        data = json.loads(response.data)
+        assert data['has_membership'] is True
+        assert data['plan_type'] == 'monthly'
+        assert len(statements) == 1
+        sql, _ = statements[0]
+        assert 'FROM current_memberships' in sql
+        assert 'WHERE current_memberships.user_id = ?' in sql
+
+    def test_status_without_membership(self, auth_client):
+        """Test that a user who never subscribed has no membership."""
+        response = auth_client.get('/api/stripe/membership/status')
+
+        assert json.loads(response.data) == {'has_membership': False}
+
+    @patch('routes.stripe.stripe.Subscription.modify')
+    def test_cancel_updates_summary(self, mock_modify, auth_client, user_id):
+        """Test that cancelling finds the membership through the summary and updates it."""
+        subscribe(auth_client)
+
+        response = auth_client.post('/api/stripe/membership/cancel')
+
+        assert response.status_code == 200
+        mock_modify.assert_called_once_with('sub_test123', cancel_at_period_end=True)
+        assert current_membership(auth_client, user_id) == ('monthly', 'cancelled')
+        assert json.loads(auth_client.get('/api/stripe/membership/status').data)['has_membership'] is False
+        assert auth_client.post('/api/stripe/membership/cancel').status_code == 404
+
+    @patch('routes.stripe.stripe.Subscription.modify')
+    def test_cancel_survives_stripe_follow_up(self, mock_modify, auth_client, user_id):
+        """Test that Stripe's updated event for a scheduled cancellation keeps it cancelled."""
+        subscribe(auth_client)
+        auth_client.post('/api/stripe/membership/cancel')
+        subscription = {'id': 'sub_test123', 'object': 'subscription', 'status': 'active',
+                        'cancel_at_period_end': True,
+                        'current_period_start': 1640995200, 'current_period_end': 1643673600}
+
+        def updated(event_id, created, **fields):
+            event = {'id': event_id, 'created': created, 'type': 'customer.subscription.updated',
+                     'data': {'object': dict(subscription, **fields)}}
+            auth_client.post('/api/stripe/webhook', data=json.dumps(event), content_type='application/json')
+            return current_membership(auth_client, user_id)
+
+        assert updated('evt_scheduled', 100) == ('monthly', 'cancelled')
+        assert json.loads(auth_client.get('/api/stripe/membership/status').data)['has_membership'] is False
+        # Withdrawing the cancellation in Stripe reactivates the membership
+        assert updated('evt_resumed', 200, cancel_at_period_end=False) == ('monthly', 'active')
+        assert updated('evt_ended', 300, status='canceled') == ('monthly', 'cancelled')
+
+    def test_newest_active_membership_wins(self, client):
+        """Test that an active membership outranks a newer inactive one."""
+        with client.application.app_context():
+            user = User(username='member', email='member@example.com', password_hash='hash')
+            db.session.add(user)
+            db.session.flush()
+            now = datetime.utcnow()
+            db.session.add_all([
+                Membership(user_id=user.id, stripe_subscription_id='sub_old', plan_type='monthly',
+                           status='active', created_at=now - timedelta(days=30)),
+                Membership(user_id=user.id, stripe_subscription_id='sub_new', plan_type='annual',
+                           status='incomplete', created_at=now),
+            ])
+            refresh_current_memberships([user.id])
+            db.session.commit()
+
+            assert db.session.get(CurrentMembership, user.id).plan_type == 'monthly'
+
+            Membership.query.filter_by(stripe_subscription_id='sub_old').one().status = 'cancelled'
+            refresh_current_memberships([user.id])
+            db.session.commit()
+
+            current = db.session.get(CurrentMembership, user.id)
+            assert (current.plan_type, current.status) == ('annual', 'incomplete')
+
+    def test_webhook_keeps_summary_current(self, client):
+        """Test that memberships created and cancelled by webhooks update the summary."""
+        with client.application.app_context():
+            user = User(username='member', email='member@example.com', password_hash='hash')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+        subscription = {'id': 'sub_test123', 'object': 'subscription', 'status': 'active',
+                        'current_period_start': 1640995200, 'current_period_end': 1643673600}
+        checkout = {'id': 'evt_checkout', 'created': 100, 'type': 'checkout.session.completed',
+                    'data': {'object': {'id': 'cs_test123', 'subscription': 'sub_test123',
+                                        'metadata': {'user_id': str(user_id), 'plan_id': 'monthly'}}}}
+        deleted = {'id': 'evt_deleted', 'created': 200, 'type': 'customer.subscription.deleted',
+                   'data': {'object': dict(subscription, status='canceled')}}
+
+        with patch('routes.stripe.subscription_cache.get', return_value=subscription):
+            client.post('/api/stripe/webhook', data=json.dumps(checkout), content_type='application/json')
+        assert current_membership(client, user_id) == ('monthly', 'active')
+
+        client.post('/api/stripe/webhook', data=json.dumps(deleted), content_type='application/json')
+        assert current_membership(client, user_id) == ('monthly', 'cancelled')
+
+    def test_bulk_sync_keeps_summary_current(self, client):
+        """Test that memberships written by the Stripe sync update the summary."""
+        with client.application.app_context():
+            user = User(username='member', email='member@example.com', password_hash='hash',
+                        stripe_customer_id='cus_1')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            subscription = {'id': 'sub_1', 'customer': 'cus_1', 'status': 'active',
+                            'current_period_start': 1640995200, 'current_period_end': 1643673600,
+                            'items': {'data': [{'price': {'id': 'price_monthly'}}]}}
+
+            sync_subscription_batch([subscription], {'price_monthly': 'monthly'})
+            assert current_membership(client, user_id) == ('monthly', 'active')
+
+            sync_subscription_batch([dict(subscription, status='past_due')], {'price_monthly': 'monthly'})
+            assert current_membership(client, user_id) == ('monthly', 'past_due')
+
+    def test_repair_command_fixes_drift(self, client):
+        """Test that the repair command rebuilds missing, stale and orphaned summaries."""
+        with client.application.app_context():
+            users = [User(username=f'member{n}', email=f'member{n}@example.com', password_hash='hash')
+                     for n in range(3)]
+            db.session.add_all(users)
+            db.session.flush()
+            memberships = [Membership(user_id=user.id, stripe_subscription_id=f'sub_{user.id}',
+                                      plan_type='monthly', status='active') for user in users[:2]]
+            db.session.add_all(memberships)
+            db.session.flush()
+            # Written behind the summary's back
+            db.session.add_all([
+                CurrentMembership(user_id=users[1].id, membership_id=memberships[1].id,
+                                  plan_type='monthly', status='incomplete'),
+                CurrentMembership(user_id=users[2].id, membership_id=memberships[0].id,
+                                  plan_type='monthly', status='active'),
+            ])
+            db.session.commit()
+            user_ids = [user.id for user in users]
+        runner = client.application.test_cli_runner()
+
+        dry_run = runner.invoke(args=['stripe', 'repair-current-memberships', '--dry-run'])
+        result = runner.invoke(args=['stripe', 'repair-current-memberships', '--batch-size', '2'])
+
+        assert 'Would fix 3 of 3 users' in dry_run.output
+        assert 'Fixed 3 of 3 users (created 1, updated 1, removed 1)' in result.output
+        assert [current_membership(client, user_id) for user_id in user_ids] == \
+            [('monthly', 'active'), ('monthly', 'active'), None]
+
+    def test_migration_summarizes_existing_members(self, tmp_path):
+        """Test that adding the table fills it from the memberships already there."""
+        migrated = migrated_app(tmp_path / 'members.db', revision='c62e9d0a4b18')
+        with migrated.app_context():
+            connection = db.session.connection()
+            for user_id in (1, 2, 3):
+                connection.exec_driver_sql(
+                    'INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)',
+                    (user_id, f'member{user_id}', f'member{user_id}@example.com', 'hash'))
+            connection.exec_driver_sql(
+                'INSERT INTO memberships (id, user_id, stripe_subscription_id, plan_type, status, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)', [
+                    (1, 1, 'sub_old', 'monthly', 'active', '2024-01-01 00:00:00.000000'),
+                    (2, 1, 'sub_new', 'annual', 'incomplete', '2024-02-01 00:00:00.000000'),
+                    (3, 2, 'sub_first', 'monthly', 'cancelled', '2024-01-01 00:00:00.000000'),
+                    (4, 2, 'sub_second', 'annual', 'cancelled', '2024-02-01 00:00:00.000000'),
+                ])
+            db.session.commit()
+
+            upgrade(directory=MIGRATIONS, revision='7d3f5a2e9c61')
+            rows = db.session.connection().exec_driver_sql(
+                'SELECT user_id, membership_id, plan_type, status FROM current_memberships ORDER BY user_id'
+            ).fetchall()
+            db.session.remove()
+
+        assert [tuple(row) for row in rows] == [(1, 1, 'monthly', 'active'), (2, 4, 'annual', 'cancelled')]
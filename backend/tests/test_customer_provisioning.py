@@ -0,0 +1,206 @@
+import pytest
+import json
+import threading
+import time
+from unittest.mock import patch, MagicMock
+from models import db, User
+from services.customer_provisioning import CustomerProvisioner, customer_provisioner, idempotency_key
+from test_config import client, auth_client, sample_user
+
+def stripe_customer(customer_id='cus_test123'):
+    customer = MagicMock()
+    customer.id = customer_id
+    return customer
+
+def checkout(client):
+    return client.post('/api/stripe/membership/create-checkout-session',
+                       data=json.dumps({'plan_id': 'monthly'}),
+                       content_type='application/json')
+
+@pytest.fixture
+def preprovision(client):
+    client.application.config['STRIPE_CUSTOMER_PREPROVISION'] = True
+    yield client.application
+    client.application.config['STRIPE_CUSTOMER_PREPROVISION'] = False
+
+class TestCustomerProvisioning:
+    """Test Stripe customer creation ahead of checkout."""
+
+    @patch('stripe.Customer.create')
+    def test_register_creates_customer(self, mock_create, client, preprovision, sample_user):
+        """Test that registration stores a Stripe customer id for the new user."""
+        mock_create.return_value = stripe_customer()
+
+        response = client.post('/api/register', data=json.dumps(sample_user), content_type='application/json')
+
+        assert response.status_code == 201
+        user_id = json.loads(response.data)['user']['id']
+        with client.application.app_context():
+            assert db.session.get(User, user_id).stripe_customer_id == 'cus_test123'
+        kwargs = mock_create.call_args.kwargs
+        assert kwargs['email'] == sample_user['email']
+        assert kwargs['idempotency_key'].startswith(f'customer-for-user-{user_id}-')
+
+    @patch('stripe.Customer.create')
+    def test_registration_survives_stripe_failure(self, mock_create, client, preprovision, sample_user):
+        """Test that a Stripe outage doesn't fail registration."""
+        mock_create.side_effect = Exception('Stripe unavailable')
+
+        response = client.post('/api/register', data=json.dumps(sample_user), content_type='application/json')
+
+        assert response.status_code == 201
+        assert customer_provisioner.stats()['in_flight'] == 0
+
+    @patch('routes.stripe.stripe.checkout.Session.create')
+    @patch('stripe.Customer.create')
+    def test_checkout_skips_customer_call_when_provisioned(self, mock_create, mock_session, auth_client):
+        """Test that checkout reuses the stored customer id."""
+        with auth_client.session_transaction() as sess:
+            user_id = sess['user_id']
+        with auth_client.application.app_context():
+            db.session.get(User, user_id).stripe_customer_id = 'cus_existing'
+            db.session.commit()
+        mock_session.return_value = MagicMock(url='https://checkout.stripe.com/test', id='cs_test')
+
+        response = checkout(auth_client)
+
+        assert response.status_code == 200
+        mock_create.assert_not_called()
+        assert mock_session.call_args.kwargs['customer'] == 'cus_existing'
+
+    @patch('routes.stripe.stripe.checkout.Session.create')
+    @patch('stripe.Customer.create')
+    def test_checkout_creates_missing_customer_once(self, mock_create, mock_session, auth_client):
+        """Test that checkout falls back to creating the customer and stores it."""
+        mock_create.return_value = stripe_customer('cus_fallback')
+        mock_session.return_value = MagicMock(url='https://checkout.stripe.com/test', id='cs_test')
+
+        checkout(auth_client)
+        checkout(auth_client)
+
+        assert mock_create.call_count == 1
+        assert mock_session.call_args.kwargs['customer'] == 'cus_fallback'
+
+    @patch('stripe.Customer.create')
+    def test_concurrent_ensure_creates_one_customer(self, mock_create, client):
+        """Test that simultaneous checkouts for one user share a single creation."""
+        def slow_create(**kwargs):
+            time.sleep(0.1)
+            return stripe_customer()
+        mock_create.side_effect = slow_create
+        app = client.application
+        with app.app_context():
+            user = User(username='member', email='member@example.com', password_hash='hash')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+        provisioner = CustomerProvisioner()
+        results = []
+
+        def worker():
+            with app.app_context():
+                results.append(provisioner.ensure(db.session.get(User, user_id)))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert mock_create.call_count == 1
+        assert results == ['cus_test123'] * 5
+        assert provisioner.stats()['waited'] == 4
+
+    @patch('stripe.Customer.create')
+    def test_checkout_waits_for_background_creation(self, mock_create, client):
+        """Test that ensure waits on a registration-time creation still in flight."""
+        release = threading.Event()
+
+        def blocked_create(**kwargs):
+            release.wait(5)
+            return stripe_customer('cus_background')
+        mock_create.side_effect = blocked_create
+        app = client.application
+        app.config['STRIPE_CUSTOMER_PREPROVISION'] = True
+        app.config['STRIPE_CUSTOMER_WORKERS'] = 1
+        provisioner = CustomerProvisioner()
+        try:
+            with app.app_context():
+                user = User(username='member', email='member@example.com', password_hash='hash')
+                db.session.add(user)
+                db.session.commit()
+                provisioner.submit(user.id)
+                threading.Timer(0.1, release.set).start()
+
+                assert provisioner.ensure(user) == 'cus_background'
+                assert user.stripe_customer_id == 'cus_background'
+            assert mock_create.call_count == 1
+        finally:
+            provisioner.shutdown()
+            app.config['STRIPE_CUSTOMER_PREPROVISION'] = False
+            app.config['STRIPE_CUSTOMER_WORKERS'] = 0
+
+    def test_reused_user_id_gets_a_new_idempotency_key(self, client):
+        """Test that a recreated user with the same id doesn't reuse the old key."""
+        with client.application.app_context():
+            user = User(username='member', email='member@example.com', password_hash='hash')
+            db.session.add(user)
+            db.session.commit()
+            first_key = idempotency_key(user)
+            user_id = user.id
+            db.session.delete(user)
+            db.session.commit()
+            reused = User(id=user_id, username='member', email='member@example.com', password_hash='hash')
+            db.session.add(reused)
+            db.session.commit()
+
+            assert idempotency_key(reused) != first_key
+
+    @patch('stripe.Customer.create')
+    def test_checkout_times_out_with_retry_after(self, mock_create, auth_client):
+        """Test that a background creation outlasting the wait is a 503, not a 500."""
+        release = threading.Event()
+
+        def blocked_create(**kwargs):
+            release.wait(5)
+            return stripe_customer('cus_background')
+        mock_create.side_effect = blocked_create
+        app = auth_client.application
+        app.config['STRIPE_CUSTOMER_PREPROVISION'] = True
+        app.config['STRIPE_CUSTOMER_WORKERS'] = 1
+        app.config['STRIPE_CUSTOMER_WAIT_TIMEOUT'] = 0.05
+        with auth_client.session_transaction() as sess:
+            user_id = sess['user_id']
+        try:
+            with app.app_context():
+                customer_provisioner.submit(user_id)
+
+            response = checkout(auth_client)
+
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '1'
+        finally:
+            release.set()
+            customer_provisioner.shutdown()
+            app.config['STRIPE_CUSTOMER_PREPROVISION'] = False
+            app.config['STRIPE_CUSTOMER_WORKERS'] = 0
+            app.config.pop('STRIPE_CUSTOMER_WAIT_TIMEOUT')
+
+    @patch('stripe.Customer.create')
+    def test_failed_background_creation_is_retried_at_checkout(self, mock_create, client):
+        """Test that ensure makes its own attempt when the background one failed."""
+        mock_create.side_effect = [Exception('Stripe unavailable'), stripe_customer('cus_retry')]
+        app = client.application
+        app.config['STRIPE_CUSTOMER_PREPROVISION'] = True
+        provisioner = CustomerProvisioner()
+        try:
+            with app.app_context():
+                user = User(username='member', email='member@example.com', password_hash='hash')
+                db.session.add(user)
+                db.session.commit()
+                provisioner.submit(user.id)
+
+                assert provisioner.ensure(user) == 'cus_retry'
+            assert provisioner.stats()['failed'] == 1
+        finally:
+            app.config['STRIPE_CUSTOMER_PREPROVISION'] = False
@@ -0,0 +1,99 @@
+import pytest
+import csv
+import json
+import tracemalloc
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from models import db, User, Membership, PaymentHistory
+from services.exports import export_chunks
+from test_config import client
+
+START = datetime(2024, 1, 1)
+
+def export(client, *args):
+    return client.application.test_cli_runner().invoke(args=['stripe', 'export', *args])
+
+def seed_payments(client, count, user_id=1):
+    with client.application.app_context():
+        db.session.execute(insert(PaymentHistory), [
+            {'user_id': user_id, 'stripe_payment_intent_id': f'pi_{n:06d}', 'amount': 17500, 'currency': 'usd',
+             'status': 'succeeded', 'created_at': START + timedelta(hours=n)}
+            for n in range(count)
+        ])
+        db.session.commit()
+
+def peak_memory(client, table, batch_size=500):
+    """Peak bytes allocated while exporting ``table`` to nowhere"""
+    with client.application.app_context():
+        tracemalloc.start()
+        try:
+            for _ in export_chunks(table, 'ndjson', batch_size=batch_size):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+@pytest.fixture
+def user_id(client):
+    with client.application.app_context():
+        user = User(username='member', email='member@example.com', password_hash='hash')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+class TestExports:
+    """Test the streaming bookkeeping exports."""
+
+    def test_ndjson_export_with_date_range(self, client, user_id, tmp_path):
+        """Test that only rows created inside [since, until) are written, one JSON object per line."""
+        seed_payments(client, 72, user_id)
+        output = tmp_path / 'payments.ndjson'
+
+        result = export(client, 'payments', '--since', '2024-01-02', '--until', '2024-01-03',
+                        '--output', str(output), '--batch-size', '10')
+
+        assert result.exit_code == 0, result.output
+        rows = [json.loads(line) for line in output.read_text().splitlines()]
+        assert len(rows) == 24
+        assert rows[0]['stripe_payment_intent_id'] == 'pi_000024'
+        assert rows[0]['created_at'] == '2024-01-02T00:00:00'
+        assert rows[-1]['stripe_payment_intent_id'] == 'pi_000047'
+        assert 'Exported 24 payments' in result.output
+
+    def test_csv_export_of_memberships(self, client, user_id, tmp_path):
+        """Test that CSV exports have a header row and ISO timestamps."""
+        with client.application.app_context():
+            db.session.add_all([
+                Membership(user_id=user_id, stripe_subscription_id=f'sub_{n}', plan_type='monthly',
+                           status='active', current_period_end=START, created_at=START)
+                for n in range(3)
+            ])
+            db.session.commit()
+        output = tmp_path / 'memberships.csv'
+
+        result = export(client, 'memberships', '--format', 'csv', '--output', str(output))
+
+        assert result.exit_code == 0, result.output
+        with open(output, newline='') as f:
+            rows = list(csv.DictReader(f))
+        assert [row['stripe_subscription_id'] for row in rows] == ['sub_0', 'sub_1', 'sub_2']
+        assert rows[0]['current_period_end'] == '2024-01-01T00:00:00'
+        assert rows[0]['current_period_start'] == ''
+
+    def test_chunks_hold_one_batch(self, client, user_id):
+        """Test that output is produced a batch at a time rather than all at once."""
+        seed_payments(client, 25, user_id)
+
+        with client.application.app_context():
+            chunks = list(export_chunks('payments', 'ndjson', batch_size=10))
+
+        assert [chunk.count('\n') for chunk in chunks] == [10, 10, 5]
+
+    def test_memory_stays_flat(self, client, user_id):
+        """Test that exporting ten times the rows doesn't need ten times the memory."""
+        seed_payments(client, 2000, user_id)
+        small = peak_memory(client, 'payments')
+        seed_payments(client, 18000, user_id)
+        large = peak_memory(client, 'payments')
+
+        assert large < small * 2
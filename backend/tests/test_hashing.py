@@ -0,0 +1,187 @@
+import pytest
+import json
+from unittest.mock import patch
+from werkzeug.security import generate_password_hash, check_password_hash
+from models import db, User
+from services.hashing import PasswordHasher, HashingOverloaded, normalize_hash_method, hash_method
+from test_config import client, sample_user
+
+class TestPasswordHasher:
+    """Test the password hashing process pool."""
+
+    def test_hash_and_verify_on_pool(self, client):
+        """Test hashing and verifying on a real process pool."""
+        hasher = PasswordHasher()
+        client.application.config['PASSWORD_HASH_POOL_SIZE'] = 1
+        try:
+            password_hash = hasher.run('hash', generate_password_hash, 'secret123')
+            assert hasher.run('verify', check_password_hash, password_hash, 'secret123') is True
+            assert hasher.run('verify', check_password_hash, password_hash, 'wrong') is False
+        finally:
+            hasher.shutdown()
+
+        stats = hasher.stats()
+        assert stats['hash']['count'] == 1
+        assert stats['verify']['count'] == 2
+        assert stats['verify']['avg_seconds'] > 0
+
+    def test_full_queue_is_rejected(self, client):
+        """Test that submissions beyond the queue bound are rejected."""
+        hasher = PasswordHasher()
+        client.application.config['PASSWORD_HASH_POOL_SIZE'] = 1
+        client.application.config['PASSWORD_HASH_QUEUE_SIZE'] = 0
+        try:
+            _, slots = hasher._get_executor(1, 0)
+            slots.acquire()
+            with pytest.raises(HashingOverloaded):
+                hasher.run('hash', generate_password_hash, 'secret123')
+            slots.release()
+        finally:
+            hasher.shutdown()
+
+        assert hasher.stats()['hash']['rejected'] == 1
+
+    @patch('routes.auth.password_hasher.run')
+    def test_register_overloaded_returns_503(self, mock_run, client, sample_user):
+        """Test that registration returns 503 with Retry-After when overloaded."""
+        mock_run.side_effect = HashingOverloaded(retry_after=2)
+
+        response = client.post('/api/register',
+                             data=json.dumps(sample_user),
+                             content_type='application/json')
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '2'
+
+    @patch('routes.auth.password_hasher.run')
+    def test_login_overloaded_returns_503(self, mock_run, client, sample_user):
+        """Test that login returns 503 with Retry-After when overloaded."""
+        with client.application.app_context():
+            db.session.add(User(
+                username=sample_user['username'],
+                email=sample_user['email'],
+                password_hash='hashed_password'
+            ))
+            db.session.commit()
+        mock_run.side_effect = HashingOverloaded(retry_after=1)
+
+        response = client.post('/api/login',
+                             data=json.dumps({
+                                 'username': sample_user['username'],
+                                 'password': sample_user['password']
+                             }),
+                             content_type='application/json')
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+class TestHashParameters:
+    """Test configurable hash parameters and rehashing."""
+
+    def test_register_uses_configured_method(self, client, sample_user):
+        """Test that new hashes use PASSWORD_HASH_METHOD."""
+        client.application.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        try:
+            client.post('/api/register',
+                       data=json.dumps(sample_user),
+                       content_type='application/json')
+        finally:
+            client.application.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:600000'
+
+        with client.application.app_context():
+            user = User.query.filter_by(username=sample_user['username']).first()
+            assert user.password_hash.startswith('pbkdf2:sha256:1000$')
+
+    def test_login_rehashes_outdated_hash(self, client, sample_user):
+        """Test that a successful login upgrades a hash made with old parameters."""
+        with client.application.app_context():
+            db.session.add(User(
+                username=sample_user['username'],
+                email=sample_user['email'],
+                password_hash=generate_password_hash(sample_user['password'], 'pbkdf2:sha256:1000')
+            ))
+            db.session.commit()
+
+        response = client.post('/api/login',
+                             data=json.dumps({
+                                 'username': sample_user['username'],
+                                 'password': sample_user['password']
+                             }),
+                             content_type='application/json')
+
+        assert response.status_code == 200
+        with client.application.app_context():
+            user = User.query.filter_by(username=sample_user['username']).first()
+            assert user.password_hash.startswith('pbkdf2:sha256:600000$')
+            assert check_password_hash(user.password_hash, sample_user['password'])
+
+    def test_failed_login_does_not_rehash(self, client, sample_user):
+        """Test that hashes are only upgraded after a correct password."""
+        old_hash = generate_password_hash(sample_user['password'], 'pbkdf2:sha256:1000')
+        with client.application.app_context():
+            db.session.add(User(
+                username=sample_user['username'],
+                email=sample_user['email'],
+                password_hash=old_hash
+            ))
+            db.session.commit()
+
+        client.post('/api/login',
+                   data=json.dumps({'username': sample_user['username'], 'password': 'wrong'}),
+                   content_type='application/json')
+
+        with client.application.app_context():
+            user = User.query.filter_by(username=sample_user['username']).first()
+            assert user.password_hash == old_hash
+
+    def test_short_method_names_are_normalized(self):
+        """Test that shorthand methods are expanded to the prefix stored in hashes."""
+        assert normalize_hash_method('scrypt') == 'scrypt:32768:8:1'
+        assert normalize_hash_method('pbkdf2') == 'pbkdf2:sha256:600000'
+        assert normalize_hash_method('pbkdf2:sha256:1000') == 'pbkdf2:sha256:1000'
+        # Whatever Werkzeug itself would record
+        for method in ('scrypt:16384:8:2', 'pbkdf2:sha512:1000', 'pbkdf2:sha256:01000'):
+            assert normalize_hash_method(method) == hash_method(generate_password_hash('', method))
+        for method in ('scrypt:1', 'pbkdf2:nosuchdigest', 'pbkdf2:sha256:many'):
+            with pytest.raises(ValueError):
+                normalize_hash_method(method)
+
+    def test_normalizing_does_not_hash(self):
+        """Test that expanding the method at startup is only string parsing."""
+        with patch('services.hashing.generate_password_hash') as mock_hash:
+            normalize_hash_method('pbkdf2')
+        mock_hash.assert_not_called()
+
+    def test_current_hash_is_not_rehashed(self, client, sample_user):
+        """Test that a login whose hash already uses the configured method writes nothing."""
+        current_hash = generate_password_hash(sample_user['password'], 'pbkdf2')
+        with client.application.app_context():
+            db.session.add(User(
+                username=sample_user['username'],
+                email=sample_user['email'],
+                password_hash=current_hash
+            ))
+            db.session.commit()
+
+        response = client.post('/api/login',
+                             data=json.dumps({
+                                 'username': sample_user['username'],
+                                 'password': sample_user['password']
+                             }),
+                             content_type='application/json')
+
+        assert response.status_code == 200
+        with client.application.app_context():
+            user = User.query.filter_by(username=sample_user['username']).first()
+            assert user.password_hash == current_hash
+
+    def test_benchmark_command(self, client):
+        """Test that the benchmark reports throughput and latency per method."""
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=['auth', 'benchmark-hashing',
+                                     '--method', 'pbkdf2:sha256:1000',
+                                     '--rounds', '10', '--concurrency', '2', '--pool-size', '1'])
+
+        assert result.exit_code == 0
+        assert 'pbkdf2:sha256:1000' in result.output
+        assert 'p99 ms' in result.output
@@ -0,0 +1,118 @@
+import pytest
+import json
+from datetime import datetime, timedelta
+from models import db, User, Membership, PaymentHistory
+from services.pagination import encode_cursor, decode_cursor
+from test_config import client, auth_client, captured_statements
+
+START = datetime(2024, 1, 1)
+
+@pytest.fixture
+def user_id(auth_client):
+    with auth_client.session_transaction() as sess:
+        return sess['user_id']
+
+@pytest.fixture
+def history(auth_client, user_id):
+    """Seven payments and memberships for the user (two sharing a timestamp) plus another user's"""
+    with auth_client.application.app_context():
+        other = User(username='other', email='other@example.com', password_hash='hash')
+        db.session.add(other)
+        db.session.flush()
+        offsets = [0, 1, 2, 2, 3, 4, 5]
+        for n, offset in enumerate(offsets):
+            created_at = START + timedelta(days=offset)
+            db.session.add(PaymentHistory(user_id=user_id, stripe_payment_intent_id=f'pi_{n}', amount=100 + n,
+                                          currency='usd', status='succeeded', created_at=created_at))
+            db.session.add(Membership(user_id=user_id, stripe_subscription_id=f'sub_{n}', plan_type='monthly',
+                                      status='active', created_at=created_at))
+        db.session.add(PaymentHistory(user_id=other.id, stripe_payment_intent_id='pi_other', amount=1,
+                                      currency='usd', status='succeeded', created_at=START))
+        db.session.commit()
+        return [(row.created_at, row.id) for row in PaymentHistory.query.filter_by(user_id=user_id)]
+
+def fetch_all(client, path, key, limit):
+    pages, after = [], None
+    while True:
+        query = f'?limit={limit}' + (f'&after={after}' if after else '')
+        data = json.loads(client.get(path + query).data)
+        pages.append(data[key])
+        after = data['next_cursor']
+        if after is None:
+            return pages
+
+def query_plan(sql, parameters):
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, tuple(parameters))
+    return ' | '.join(row[3] for row in rows)
+
+def listing_query(client, path, table):
+    """Run a listing and return the SQL and parameters of its SELECT on ``table``"""
+    with captured_statements() as statements:
+        response = client.get(path)
+    assert response.status_code == 200
+    return next((sql, params) for sql, params in statements if f'FROM {table}' in sql)
+
+class TestKeysetPagination:
+    """Test cursor pagination of payment history and subscriptions."""
+
+    def test_cursor_round_trip(self):
+        """Test that cursors decode to the position they were made from."""
+        created_at = datetime(2024, 5, 6, 7, 8, 9, 123456)
+
+        assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+        with pytest.raises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_payment_pages_cover_history_once(self, auth_client, history):
+        """Test that pages are newest first, disjoint and complete, ties included."""
+        pages = fetch_all(auth_client, '/api/stripe/payment-history', 'payments', limit=3)
+
+        assert [len(page) for page in pages] == [3, 3, 1]
+        ids = [payment['id'] for page in pages for payment in page]
+        expected = [row_id for _, row_id in sorted(history, key=lambda row: (-row[0].timestamp(), row[1]))]
+        assert ids == expected
+
+    def test_subscription_pages_cover_memberships_once(self, auth_client, history):
+        """Test that subscriptions page the same way."""
+        pages = fetch_all(auth_client, '/api/stripe/subscriptions', 'subscriptions', limit=2)
+
+        assert [len(page) for page in pages] == [2, 2, 2, 1]
+        ids = [subscription['stripe_subscription_id'] for page in pages for subscription in page]
+        assert ids == ['sub_6', 'sub_5', 'sub_4', 'sub_2', 'sub_3', 'sub_1', 'sub_0']
+
+    def test_limit_is_capped(self, auth_client, history):
+        """Test that the page size defaults and is bounded by configuration."""
+        auth_client.application.config['HISTORY_MAX_PAGE_SIZE'] = 4
+        try:
+            data = json.loads(auth_client.get('/api/stripe/payment-history?limit=1000').data)
+        finally:
+            auth_client.application.config['HISTORY_MAX_PAGE_SIZE'] = 100
+
+        assert len(data['payments']) == 4
+        assert data['next_cursor'] is not None
+        assert json.loads(auth_client.get('/api/stripe/payment-history').data)['next_cursor'] is None
+
+    def test_invalid_cursor_rejected(self, auth_client):
+        """Test that a malformed cursor is a client error."""
+        response = auth_client.get('/api/stripe/payment-history?after=garbage')
+
+        assert response.status_code == 400
+        assert 'Invalid cursor' in json.loads(response.data)['error']
+
+    @pytest.mark.parametrize('path,table,index', [
+        ('/api/stripe/payment-history', 'payment_history', 'ix_payment_history_user_id_created_at'),
+        ('/api/stripe/subscriptions', 'memberships', 'ix_memberships_user_id_created_at'),
+    ])
+    def test_pages_are_index_seeks(self, auth_client, history, path, table, index):
+        """Test that first and later pages are served from the composite index without sorting."""
+        first_sql, first_params = listing_query(auth_client, path + '?limit=3', table)
+        cursor = encode_cursor(START + timedelta(days=2), history[2][1])
+        next_sql, next_params = listing_query(auth_client, f'{path}?limit=3&after={cursor}', table)
+
+        with auth_client.application.app_context():
+            first_plan = query_plan(first_sql, first_params)
+            next_plan = query_plan(next_sql, next_params)
+
+        assert f'USING INDEX {index} (user_id=?)' in first_plan
+        assert f'USING INDEX {index} (user_id=? AND created_at<?)' in next_plan
+        assert 'TEMP B-TREE' not in first_plan + next_plan
@@ -0,0 +1,162 @@
+import pytest
+import json
+import os
+from datetime import datetime
+from unittest.mock import patch
+from models import db, User, PaymentHistory
+from services.payment_backfill import backfill_payments, time_windows
+from test_config import client
+
+START = 1700000000
+
+def payment_intent(number, customer='cus_1', status='succeeded', metadata=None):
+    return {
+        'id': f'pi_{number:05d}',
+        'customer': customer,
+        'amount': 17500,
+        'amount_received': 17500 if status == 'succeeded' else 0,
+        'currency': 'usd',
+        'status': status,
+        'created': START + number * 60,
+        'metadata': metadata or {}
+    }
+
+def mock_listing(mock_list, intents, page_size=3):
+    """Serve intents like PaymentIntent.list: newest first, filtered by created, paged"""
+    def list_intents(created, limit, starting_after=None):
+        matching = sorted((intent for intent in intents if created['gte'] <= intent['created'] < created['lt']),
+                          key=lambda intent: intent['created'], reverse=True)
+        if starting_after:
+            matching = matching[[intent['id'] for intent in matching].index(starting_after) + 1:]
+        return {'data': matching[:page_size], 'has_more': len(matching) > page_size}
+    mock_list.side_effect = list_intents
+
+def backfill(client, *args):
+    return client.application.test_cli_runner().invoke(args=['stripe', 'backfill-payments', *args])
+
+@pytest.fixture
+def user_id(client):
+    with client.application.app_context():
+        user = User(username='member', email='member@example.com', password_hash='hash',
+                    stripe_customer_id='cus_1')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+@pytest.fixture
+def checkpoint_file(tmp_path):
+    return str(tmp_path / 'backfill.json')
+
+class TestPaymentBackfill:
+    """Test the PaymentHistory backfill from Stripe payment intents."""
+
+    def test_time_windows_cover_range(self):
+        """Test that windows are contiguous and span the whole range."""
+        windows = time_windows(100, 200, 3)
+
+        assert [(w['start'], w['end']) for w in windows] == [(100, 133), (133, 167), (167, 200)]
+        assert time_windows(100, 101, 4) == [{'start': 100, 'end': 101, 'cursor': None, 'done': False}]
+
+    @patch('stripe.PaymentIntent.list')
+    def test_inserts_missing_succeeded_payments(self, mock_list, client, user_id):
+        """Test that succeeded intents are inserted once and others skipped."""
+        with client.application.app_context():
+            db.session.add(PaymentHistory(user_id=user_id, stripe_payment_intent_id='pi_00001',
+                                          amount=17500, currency='usd', status='succeeded'))
+            db.session.commit()
+        mock_listing(mock_list, [
+            payment_intent(1),
+            payment_intent(2),
+            payment_intent(3, status='requires_payment_method'),
+            payment_intent(4, customer='cus_unknown'),
+            payment_intent(5, customer=None, metadata={'user_id': str(user_id)}),
+        ] + [payment_intent(n) for n in range(6, 20)])
+
+        with client.application.app_context():
+            report = backfill_payments(time_windows(START, START + 3600, 3), concurrency=3, batch_size=4)
+
+        assert report['inserted'] == 16
+        assert report['duplicates'] == 1
+        assert report['unmatched'] == 1
+        assert report['fetched'] == 19
+        with client.application.app_context():
+            ids = [row.stripe_payment_intent_id for row in PaymentHistory.query.all()]
+            assert len(ids) == len(set(ids)) == 17
+            assert 'pi_00003' not in ids
+            backfilled = PaymentHistory.query.filter_by(stripe_payment_intent_id='pi_00005').one()
+            assert backfilled.user_id == user_id
+            assert backfilled.created_at == datetime.utcfromtimestamp(START + 300)
+
+    @patch('stripe.PaymentIntent.list')
+    def test_windows_are_fetched_separately(self, mock_list, client, user_id):
+        """Test that each window pages only its own time range."""
+        mock_listing(mock_list, [payment_intent(n) for n in range(1, 10)])
+
+        with client.application.app_context():
+            backfill_payments(time_windows(START, START + 600, 2), concurrency=2)
+
+        ranges = {(call.kwargs['created']['gte'], call.kwargs['created']['lt']) for call in mock_list.call_args_list}
+        assert ranges == {(START, START + 300), (START + 300, START + 600)}
+
+    @patch('stripe.PaymentIntent.list')
+    def test_checkpoint_resumes_unfinished_windows(self, mock_list, client, user_id, checkpoint_file):
+        """Test that --resume skips finished windows and continues from each cursor."""
+        mock_listing(mock_list, [payment_intent(n) for n in range(1, 10)])
+        windows = time_windows(START, START + 600, 2)
+        windows[0]['done'] = True
+        windows[1]['cursor'] = 'pi_00008'
+        with open(checkpoint_file, 'w') as f:
+            json.dump({'windows': windows}, f)
+
+        result = backfill(client, '--resume', '--checkpoint-file', checkpoint_file)
+
+        assert result.exit_code == 0, result.output
+        assert 'Resuming 1 unfinished windows' in result.output
+        assert mock_list.call_args_list[0].kwargs['starting_after'] == 'pi_00008'
+        with client.application.app_context():
+            # Only intents older than the cursor in the second window remain
+            assert sorted(row.stripe_payment_intent_id for row in PaymentHistory.query.all()) == \
+                ['pi_00005', 'pi_00006', 'pi_00007']
+        assert not os.path.exists(checkpoint_file)
+
+    @patch('stripe.PaymentIntent.list')
+    def test_command_reports_throughput(self, mock_list, client, user_id, checkpoint_file):
+        """Test that the command reports progress after each committed batch."""
+        mock_listing(mock_list, [payment_intent(n) for n in range(1, 8)])
+
+        with patch('routes.stripe.time.time', return_value=START + 3600):
+            result = backfill(client, '--since', '2023-11-14', '--concurrency', '1', '--batch-size', '3',
+                              '--checkpoint-file', checkpoint_file)
+
+        assert result.exit_code == 0, result.output
+        assert 'Inserted 7 payments from 7 payment intents (3 pages' in result.output
+        assert 'rows/s' in result.output
+        assert result.output.count('rows in') == 3
+
+    @patch('stripe.PaymentIntent.list')
+    def test_dry_run_writes_nothing(self, mock_list, client, user_id, checkpoint_file):
+        """Test that --dry-run counts rows without inserting them."""
+        mock_listing(mock_list, [payment_intent(n) for n in range(1, 4)])
+
+        with patch('routes.stripe.time.time', return_value=START + 3600):
+            result = backfill(client, '--since', '2023-11-14', '--dry-run', '--checkpoint-file', checkpoint_file)
+
+        assert 'Would insert 3 payments' in result.output
+        with client.application.app_context():
+            assert PaymentHistory.query.count() == 0
+
+    def test_since_required(self, client, checkpoint_file):
+        """Test that a fresh run needs a start date."""
+        result = backfill(client, '--checkpoint-file', checkpoint_file)
+
+        assert result.exit_code != 0
+        assert '--since is required' in result.output
+
+    @patch('stripe.PaymentIntent.list')
+    def test_fetch_errors_propagate(self, mock_list, client, user_id):
+        """Test that a failing fetch stops the backfill with the error."""
+        mock_list.side_effect = Exception('Stripe unavailable')
+
+        with client.application.app_context():
+            with pytest.raises(Exception, match='Stripe unavailable'):
+                backfill_payments(time_windows(START, START + 600, 2), concurrency=2)
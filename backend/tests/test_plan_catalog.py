@@ -0,0 +1,145 @@
+import pytest
+import json
+from unittest.mock import patch, MagicMock
+from models import MembershipPlan
+from services.plan_catalog import plan_from_price
+from routes.stripe import plan_catalog, STRIPE_PUBLISHABLE_KEY
+from test_config import client, auth_client
+
+def stripe_price(price_id, lookup_key, amount, interval='month', product_name='Membership', product_active=True):
+    return {
+        'id': price_id,
+        'lookup_key': lookup_key,
+        'unit_amount': amount,
+        'currency': 'usd',
+        'recurring': {'interval': interval},
+        'metadata': {},
+        'product': {'id': f'prod_{lookup_key}', 'name': product_name, 'active': product_active}
+    }
+
+def mock_prices(mock_list, prices):
+    listing = MagicMock()
+    listing.auto_paging_iter.return_value = iter(prices)
+    mock_list.return_value = listing
+
+def sync_plans(client, *args):
+    return client.application.test_cli_runner().invoke(args=['stripe', 'sync-plans', *args])
+
+CATALOG = [
+    stripe_price('price_monthly_v2', 'monthly', 17500, product_name='Monthly Membership'),
+    stripe_price('price_annual', 'annual', 175000, interval='year', product_name='Annual Membership'),
+]
+
+class TestPlanCatalog:
+    """Test the Stripe-synced plan catalog and its cached responses."""
+
+    def test_plan_from_price_skips_unusable_prices(self):
+        """Test that one-off prices and prices of archived products are ignored."""
+        one_off = dict(stripe_price('price_once', 'once', 500), recurring=None)
+        archived = stripe_price('price_old', 'old', 500, product_active=False)
+
+        assert plan_from_price(one_off) is None
+        assert plan_from_price(archived) is None
+        assert plan_from_price(CATALOG[1])['interval'] == 'year'
+
+    def test_defaults_served_before_first_sync(self, client):
+        """Test that the built-in plan is offered while the catalog table is empty."""
+        response = client.get('/api/stripe/membership/plans')
+
+        assert response.status_code == 200
+        assert [plan['id'] for plan in json.loads(response.data)['plans']] == ['monthly']
+
+    def test_plans_carry_etag_and_cache_control(self, client):
+        """Test that a client holding the current ETag gets an empty 304."""
+        response = client.get('/api/stripe/membership/plans')
+        etag, weak = response.get_etag()
+
+        assert etag and not weak
+        assert response.cache_control.public
+        assert response.cache_control.max_age == 60
+
+        revalidated = client.get('/api/stripe/membership/plans', headers={'If-None-Match': f'"{etag}"'})
+        assert revalidated.status_code == 304
+        assert revalidated.data == b''
+
+    def test_config_carries_etag(self, client):
+        """Test that /config can be revalidated without a body."""
+        response = client.get('/api/stripe/config')
+        etag, _ = response.get_etag()
+
+        assert json.loads(response.data) == {'publishable_key': STRIPE_PUBLISHABLE_KEY}
+        assert response.cache_control.max_age == 300
+        assert client.get('/api/stripe/config', headers={'If-None-Match': f'"{etag}"'}).status_code == 304
+
+    def test_body_built_once_per_version(self, client):
+        """Test that reloading an unchanged catalog reuses the serialized body."""
+        client.application.config['PLAN_CATALOG_TTL'] = 0
+        try:
+            etags = {client.get('/api/stripe/membership/plans').get_etag()[0] for _ in range(5)}
+        finally:
+            client.application.config['PLAN_CATALOG_TTL'] = 60
+
+        assert len(etags) == 1
+        stats = plan_catalog.stats()
+        assert stats['loads'] == 5
+        assert stats['builds'] == 1
+
+    @patch('stripe.Price.list')
+    def test_sync_replaces_plans_and_changes_etag(self, mock_list, client):
+        """Test that a sync is visible at once and old ETags stop matching."""
+        old_etag = client.get('/api/stripe/membership/plans').get_etag()[0]
+        mock_prices(mock_list, CATALOG)
+
+        result = sync_plans(client)
+
+        assert result.exit_code == 0, result.output
+        assert 'Created 2, updated 0' in result.output
+        assert mock_list.call_args.kwargs['expand'] == ['data.product']
+        response = client.get('/api/stripe/membership/plans', headers={'If-None-Match': f'"{old_etag}"'})
+        assert response.status_code == 200
+        plans = json.loads(response.data)['plans']
+        assert [(plan['id'], plan['price'], plan['interval']) for plan in plans] == \
+            [('monthly', 17500, 'month'), ('annual', 175000, 'year')]
+
+    @patch('stripe.Price.list')
+    def test_resync_updates_and_deactivates(self, mock_list, client):
+        """Test that retired plans are hidden but still map their old prices."""
+        mock_prices(mock_list, CATALOG)
+        sync_plans(client)
+        mock_prices(mock_list, [stripe_price('price_monthly_v3', 'monthly', 18000, product_name='Monthly Membership')])
+
+        result = sync_plans(client)
+
+        assert 'Created 0, updated 1, unchanged 0, deactivated 1 plans' in result.output
+        plans = json.loads(client.get('/api/stripe/membership/plans').data)['plans']
+        assert [(plan['id'], plan['price']) for plan in plans] == [('monthly', 18000)]
+        with client.application.app_context():
+            assert MembershipPlan.query.filter_by(plan_id='annual').one().active is False
+            assert plan_catalog.plan_for_price()['price_annual'] == 'annual'
+
+    @patch('stripe.Price.list')
+    def test_dry_run_writes_nothing(self, mock_list, client):
+        """Test that --dry-run reports the changes without storing them."""
+        mock_prices(mock_list, CATALOG)
+
+        result = sync_plans(client, '--dry-run')
+
+        assert 'Would create 2' in result.output
+        with client.application.app_context():
+            assert MembershipPlan.query.count() == 0
+
+    @patch('routes.stripe.stripe.checkout.Session.create')
+    @patch('stripe.Price.list')
+    def test_checkout_uses_synced_price(self, mock_list, mock_session, auth_client):
+        """Test that a plan added in Stripe can be bought without a redeploy."""
+        mock_prices(mock_list, CATALOG)
+        sync_plans(auth_client)
+        mock_session.return_value = MagicMock(url='https://checkout.stripe.com/test', id='cs_test')
+
+        with patch('stripe.Customer.create', return_value=MagicMock(id='cus_test')):
+            response = auth_client.post('/api/stripe/membership/create-checkout-session',
+                                        data=json.dumps({'plan_id': 'annual'}),
+                                        content_type='application/json')
+
+        assert response.status_code == 200
+        assert mock_session.call_args.kwargs['line_items'] == [{'price': 'price_annual', 'quantity': 1}]
@@ -0,0 +1,293 @@
+import pytest
+import json
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import Column, insert
+from models import db, User, Membership, PaymentHistory, CurrentMembership, ProcessedWebhookEvent
+from routes.stripe import plan_catalog
+from services.availability import identity_index
+from services.user_cache import user_cache
+from services.current_membership import refresh_current_memberships
+from services.payment_backfill import _payment_rows
+from services.stripe_sync import sync_subscription_batch
+from test_config import reset_app, migrated_app, captured_statements
+
+USERS = 10000
+PAYMENTS_PER_USER = 10  # 100k payment_history rows
+USER_ID = USERS // 2
+START = datetime(2024, 1, 1)
+
+def seed():
+    """Users with Stripe customers, two memberships each, ten payments each and their webhook markers"""
+    db.session.execute(insert(User), [
+        {'id': n, 'username': f'member{n:05d}', 'email': f'member{n:05d}@example.com', 'password_hash': 'hash',
+         'stripe_customer_id': f'cus_{n:05d}', 'created_at': START}
+        for n in range(1, USERS + 1)
+    ])
+    # Memberships 2n - 1 (lapsed) and 2n (current) belong to user n
+    db.session.execute(insert(Membership), [
+        {'id': 2 * n - 1 + active, 'user_id': n, 'stripe_subscription_id': f'sub_{n:05d}_{active}',
+         'plan_type': 'monthly', 'status': 'active' if active else 'cancelled',
+         'current_period_end': START + timedelta(days=30 * (active + 1)),
+         'created_at': START + timedelta(days=30 * active)}
+        for n in range(1, USERS + 1) for active in (0, 1)
+    ])
+    db.session.execute(insert(CurrentMembership), [
+        {'user_id': n, 'membership_id': 2 * n, 'plan_type': 'monthly', 'status': 'active',
+         'current_period_end': START + timedelta(days=60)}
+        for n in range(1, USERS + 1)
+    ])
+    for first in range(0, USERS * PAYMENTS_PER_USER, 10000):
+        db.session.execute(insert(PaymentHistory), [
+            {'user_id': n % USERS + 1, 'stripe_payment_intent_id': f'pi_{n:06d}', 'amount': 1000,
+             'currency': 'usd', 'status': 'succeeded', 'created_at': START + timedelta(minutes=n)}
+            for n in range(first, first + 10000)
+        ])
+    db.session.execute(insert(ProcessedWebhookEvent), [
+        {'stripe_event_id': f'evt_{n:05d}', 'event_type': 'invoice.payment_succeeded', 'processed_at': START}
+        for n in range(USERS)
+    ])
+    db.session.commit()
+    # Give the planner the statistics a long-lived database would have
+    db.session.connection().exec_driver_sql('ANALYZE')
+    db.session.commit()
+
+@pytest.fixture(scope='module')
+def seeded_client(tmp_path_factory):
+    """A test client over the seeded database, shared by the whole module because seeding is slow"""
+    seeded = migrated_app(tmp_path_factory.mktemp('query-plans') / 'seeded.db')
+    with seeded.test_client() as client:
+        with seeded.app_context():
+            seed()
+            # Whole-table reads made once per process, not per request
+            identity_index.is_taken('username', 'warm-up')
+            plan_catalog.get('monthly')
+            yield client
+            db.session.remove()
+    # Later modules expect the caches the seeded users went through to be empty
+    reset_app()
+
+@pytest.fixture
+def member(seeded_client):
+    # Cold, so profile routes reach the database
+    user_cache.clear()
+    with seeded_client.session_transaction() as sess:
+        sess['user_id'] = USER_ID
+    yield seeded_client
+    with seeded_client.session_transaction() as sess:
+        sess.clear()
+
+def model_indexes():
+    """``{name: (table, unique, columns)}`` for every index the models declare"""
+    return {
+        index.name: (table.name, bool(index.unique),
+                     tuple(expression.name if isinstance(expression, Column) else str(expression)
+                           for expression in index.expressions))
+        for table in db.metadata.sorted_tables for index in table.indexes
+    }
+
+def migrated_indexes(connection):
+    """The same for the explicitly created indexes of the migrated database"""
+    indexes = {}
+    for name, table in connection.exec_driver_sql(
+            "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"):
+        if table == 'alembic_version':
+            continue
+        unique = next(row[2] for row in connection.exec_driver_sql(f'PRAGMA index_list("{table}")') if row[1] == name)
+        columns = tuple(row[2] + (' DESC' if row[3] else '')
+                        for row in connection.exec_driver_sql(f'PRAGMA index_xinfo("{name}")') if row[5])
+        indexes[name] = (table, bool(unique), columns)
+    return indexes
+
+def full_scans(statements):
+    """Return ``(sql, plan line)`` for every captured statement the planner would answer with a scan"""
+    scans = []
+    for sql, parameters in statements:
+        if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+            continue
+        plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, tuple(parameters))
+        scans += [(sql, row[3]) for row in plan if row[3].startswith('SCAN ')]
+    db.session.rollback()
+    return scans
+
+def assert_indexed(statements):
+    assert statements, 'no queries were captured'
+    scans = full_scans(statements)
+    assert not scans, '\n\n'.join(f'{detail}\n  {sql}' for sql, detail in scans)
+
+def post_json(client, path, data):
+    return client.post(path, data=json.dumps(data), content_type='application/json')
+
+class TestQueryPlans:
+    """Test that every route's queries are index lookups on a 100k-row database."""
+
+    def test_seeded_sizes(self, seeded_client):
+        """Test that the plans below are checked against a realistically sized database."""
+        assert PaymentHistory.query.count() == USERS * PAYMENTS_PER_USER
+        assert Membership.query.count() == 2 * USERS
+
+    def test_migrations_match_models(self, seeded_client):
+        """Test that the migrated schema, indexes included, is the one the models describe."""
+        with db.engine.connect() as connection:
+            differences = compare_metadata(MigrationContext.configure(connection), db.metadata)
+            migrated = migrated_indexes(connection)
+
+        # Alembic can't reflect DESC index columns on SQLite, so indexes are compared separately
+        assert [diff for diff in differences if diff[0] not in ('add_index', 'remove_index')] == []
+        assert migrated == model_indexes()
+
+    @pytest.mark.parametrize('path', [
+        '/api/stripe/membership/status',
+        '/api/stripe/subscriptions?limit=1',
+        '/api/stripe/payment-history?limit=3',
+        '/api/check',
+        '/api/user',
+        '/api/register/availability?username=member00001&email=nobody@example.com',
+    ])
+    def test_reads(self, member, path):
+        """Test the read-only routes, including a later page of each listing."""
+        with captured_statements() as statements:
+            response = member.get(path)
+            assert response.status_code == 200
+            next_cursor = json.loads(response.data).get('next_cursor')
+            if next_cursor:
+                assert member.get(f'{path}&after={next_cursor}').status_code == 200
+
+        assert_indexed(statements)
+
+    def test_login(self, seeded_client):
+        """Test that logging in finds the user by username."""
+        with captured_statements() as statements:
+            response = post_json(seeded_client, '/api/login', {'username': 'member00001', 'password': 'wrong'})
+
+        assert response.status_code == 401
+        assert_indexed(statements)
+
+    @patch('routes.stripe.stripe.checkout.Session.create')
+    def test_create_checkout_session(self, mock_create, member):
+        """Test that starting a checkout reads the user by primary key."""
+        mock_create.return_value = MagicMock(id='cs_plan', url='https://checkout.stripe.com/cs_plan')
+
+        with captured_statements() as statements:
+            response = post_json(member, '/api/stripe/membership/create-checkout-session', {'plan_id': 'monthly'})
+
+        assert response.status_code == 200
+        assert_indexed(statements)
+
+    @patch('routes.stripe.stripe.Subscription.create')
+    def test_create_subscription(self, mock_create, member):
+        """Test that subscribing writes the membership and refreshes the summary by index."""
+        mock_create.return_value = MagicMock(id='sub_plan_created', status='active')
+
+        with captured_statements() as statements:
+            response = post_json(member, '/api/stripe/create-subscription',
+                                 {'price_id': 'price_monthly', 'plan_type': 'monthly'})
+
+        assert response.status_code == 200
+        assert_indexed(statements)
+
+    @patch('routes.stripe.stripe.checkout.Session.retrieve')
+    def test_verify_payment(self, mock_retrieve, member):
+        """Test both the first verification and the cached repeat."""
+        mock_retrieve.return_value = MagicMock(
+            payment_status='paid', metadata={'user_id': str(USER_ID), 'plan_id': 'monthly'},
+            subscription={'id': 'sub_plan_verified', 'status': 'active',
+                          'current_period_start': 1640995200, 'current_period_end': 1643673600})
+
+        with captured_statements() as statements:
+            for _ in range(2):
+                response = post_json(member, '/api/stripe/membership/verify-payment', {'session_id': 'cs_verified'})
+                assert response.status_code == 200
+
+        assert mock_retrieve.call_count == 1
+        assert_indexed(statements)
+
+    @patch('routes.stripe.stripe.Subscription.cancel')
+    def test_cancel_subscription(self, mock_cancel, member):
+        """Test that cancelling a subscription finds it by subscription id."""
+        with captured_statements() as statements:
+            response = member.post(f'/api/stripe/cancel-subscription/sub_{USER_ID:05d}_0')
+
+        assert response.status_code == 200
+        assert_indexed(statements)
+
+    @patch('routes.stripe.stripe.Subscription.modify')
+    def test_cancel_membership(self, mock_modify, seeded_client):
+        """Test that cancelling the current membership goes through the summary."""
+        with seeded_client.session_transaction() as sess:
+            sess['user_id'] = USER_ID + 1
+
+        with captured_statements() as statements:
+            response = seeded_client.post('/api/stripe/membership/cancel')
+
+        assert response.status_code == 200
+        assert_indexed(statements)
+
+    def test_webhooks(self, seeded_client):
+        """Test queueing, claiming and applying webhooks, including a redelivery."""
+        user_id = USER_ID + 2
+        subscription = {'id': f'sub_{user_id:05d}_1', 'object': 'subscription', 'status': 'past_due',
+                        'current_period_start': 1640995200, 'current_period_end': 1643673600}
+        events = [
+            {'id': 'evt_plan_updated', 'created': 100, 'type': 'customer.subscription.updated',
+             'data': {'object': subscription}},
+            {'id': 'evt_plan_checkout', 'created': 100, 'type': 'checkout.session.completed',
+             'data': {'object': {'id': 'cs_plan_webhook', 'subscription': 'sub_plan_webhook',
+                                 'metadata': {'user_id': str(user_id), 'plan_id': 'monthly'}}}},
+            {'id': 'evt_plan_payment', 'created': 100, 'type': 'payment_intent.succeeded',
+             'data': {'object': {'id': 'pi_plan_webhook', 'amount': 1000, 'currency': 'usd',
+                                 'status': 'succeeded', 'metadata': {'user_id': str(user_id)}}}},
+            {'id': 'evt_00001', 'created': 100, 'type': 'invoice.payment_succeeded',
+             'data': {'object': {'subscription': f'sub_{user_id:05d}_1'}}},
+        ]
+
+        with captured_statements() as statements, \
+                patch('routes.stripe.subscription_cache.get', return_value=dict(subscription, id='sub_plan_webhook')):
+            for event in events:
+                assert post_json(seeded_client, '/api/stripe/webhook', event).status_code == 200
+
+        assert Membership.query.filter_by(stripe_subscription_id=f'sub_{user_id:05d}_1').one().status == 'past_due'
+        created = Membership.query.filter_by(stripe_subscription_id='sub_plan_webhook').one()
+        assert (created.user_id, created.status) == (user_id, 'past_due')
+        assert db.session.get(CurrentMembership, user_id).membership_id == created.id
+        assert PaymentHistory.query.filter_by(stripe_payment_intent_id='pi_plan_webhook').one().user_id == user_id
+        assert_indexed(statements)
+
+    def test_stripe_sync_lookups(self, seeded_client):
+        """Test that syncing subscriptions matches customers and subscriptions by index."""
+        subscriptions = [
+            {'id': f'sub_{n:05d}_1', 'customer': f'cus_{n:05d}', 'status': 'active',
+             'current_period_start': 1640995200, 'current_period_end': 1643673600,
+             'items': {'data': [{'price': {'id': 'price_monthly'}}]}}
+            for n in range(1, 101)
+        ]
+
+        with captured_statements() as statements:
+            sync_subscription_batch(subscriptions, {'price_monthly': 'monthly'}, dry_run=True)
+        db.session.rollback()
+
+        assert_indexed(statements)
+
+    def test_payment_backfill_lookups(self, seeded_client):
+        """Test that backfill dedupes on payment intent id and matches customers by index."""
+        intents = [
+            {'id': f'pi_{n:06d}', 'customer': f'cus_{n:05d}', 'status': 'succeeded', 'amount': 1000,
+             'currency': 'usd', 'created': 1640995200}
+            for n in range(1, 101)
+        ]
+
+        with captured_statements() as statements:
+            rows, unmatched, duplicates = _payment_rows(intents)
+
+        assert duplicates == 100 and rows == []
+        assert_indexed(statements)
+
+    def test_refresh_current_memberships(self, seeded_client):
+        """Test that rebuilding summaries reads each user's memberships by index."""
+        with captured_statements() as statements:
+            refresh_current_memberships(list(range(1, 101)))
+            db.session.commit()
+
+        assert_indexed(statements)
@@ -0,0 +1,79 @@
+import pytest
+import threading
+import stripe
+from stripe import RequestsClient
+from services.stripe_client import PooledStripeClient
+from tests.fake_stripe import fake_stripe
+
+@pytest.fixture
+def http_client():
+    """Temporarily install a given HTTP client as the SDK default."""
+    original_client = stripe.default_http_client
+    original_retries = stripe.max_network_retries
+
+    def install(client, max_retries=0):
+        stripe.default_http_client = client
+        stripe.max_network_retries = max_retries
+        return client
+
+    yield install
+    stripe.default_http_client = original_client
+    stripe.max_network_retries = original_retries
+
+def create_customers(threads, calls_per_thread):
+    def worker():
+        for _ in range(calls_per_thread):
+            stripe.Customer.create(email='member@example.com')
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+class TestPooledStripeClient:
+    """Test the shared Stripe connection pool against a local fake API."""
+
+    def test_sequential_calls_reuse_one_connection(self, fake_stripe, http_client):
+        """Test that back-to-back calls share a single keep-alive connection."""
+        client = http_client(PooledStripeClient(pool_size=4))
+
+        for _ in range(10):
+            stripe.Customer.create(email='member@example.com')
+
+        assert fake_stripe.connections == 1
+        stats = client.stats()
+        assert stats['requests'] == 10
+        assert stats['connections_opened'] == 1
+        assert stats['connections_reused'] == 9
+
+    def test_pool_bounds_connections_across_threads(self, fake_stripe, http_client):
+        """Test that concurrent threads share the pool instead of one session each."""
+        http_client(RequestsClient())
+        create_customers(threads=8, calls_per_thread=3)
+        default_connections = fake_stripe.connections
+
+        fake_stripe.connections = 0
+        http_client(PooledStripeClient(pool_size=2))
+        create_customers(threads=8, calls_per_thread=3)
+
+        assert default_connections == 8
+        assert fake_stripe.connections <= 2
+
+    def test_server_errors_retried_with_backoff(self, fake_stripe, http_client):
+        """Test that 5xx responses are retried using the configured delays."""
+        http_client(PooledStripeClient(retry_initial_delay=0.01, retry_max_delay=0.02), max_retries=2)
+        fake_stripe.fail_statuses = [500, 503]
+
+        customer = stripe.Customer.create(email='member@example.com')
+
+        assert customer.object == 'customer'
+        assert len(fake_stripe.requests) == 3
+
+    def test_backoff_is_capped_and_jittered(self):
+        """Test that retry delays grow exponentially up to the cap, with jitter."""
+        client = PooledStripeClient(retry_initial_delay=0.1, retry_max_delay=0.3)
+
+        assert 0.05 <= client._sleep_time_seconds(1) <= 0.1
+        assert 0.1 <= client._sleep_time_seconds(2) <= 0.2
+        assert 0.15 <= client._sleep_time_seconds(5) <= 0.3
@@ -0,0 +1,162 @@
+import pytest
+import json
+import threading
+import time
+import stripe
+from services.stripe_client import PooledStripeClient
+from services.stripe_guard import StripeGuard, StripeUnavailable
+from routes.stripe import stripe_http_client
+from tests.fake_stripe import fake_stripe
+from tests.test_stripe_client import http_client
+from test_config import client, auth_client
+
+def guarded_client(http_client, max_retries=0, **guard_options):
+    guard = StripeGuard(**guard_options)
+    http_client(PooledStripeClient(retry_initial_delay=0.01, retry_max_delay=0.02, guard=guard), max_retries)
+    return guard
+
+def create_customer():
+    return stripe.Customer.create(email='member@example.com')
+
+def trip(guard):
+    for _ in range(guard.breaker.failure_threshold):
+        with pytest.raises(stripe.APIError):
+            create_customer()
+
+class TestStripeGuard:
+    """Test the deadline, bulkhead and circuit breaker around Stripe calls."""
+
+    def test_calls_pass_through(self, fake_stripe, http_client):
+        """Test that healthy calls are counted and leave the breaker closed."""
+        guard = guarded_client(http_client)
+
+        assert create_customer().object == 'customer'
+
+        stats = guard.stats()
+        assert stats['calls'] == 1
+        assert stats['in_flight'] == 0
+        assert stats['breaker']['state'] == 'closed'
+
+    def test_deadline_cuts_off_slow_call(self, fake_stripe, http_client):
+        """Test that a slow response is abandoned at the deadline without retries."""
+        guard = guarded_client(http_client, max_retries=2, deadline=0.2)
+        fake_stripe.latency = 1
+
+        started = time.monotonic()
+        with pytest.raises(StripeUnavailable, match='deadline exceeded'):
+            create_customer()
+
+        assert time.monotonic() - started < 0.6
+        assert len(fake_stripe.requests) == 1
+        assert guard.stats()['rejected_deadline'] == 1
+
+    def test_bulkhead_rejects_excess_calls(self, fake_stripe, http_client):
+        """Test that calls beyond the concurrency limit are rejected, not queued."""
+        guard = guarded_client(http_client, max_concurrent=2, bulkhead_wait=0.01)
+        fake_stripe.latency = 0.3
+        outcomes = []
+
+        def worker():
+            try:
+                create_customer()
+                outcomes.append('ok')
+            except StripeUnavailable as e:
+                outcomes.append(e.reason)
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(outcomes) == ['ok', 'ok'] + ['too many concurrent calls'] * 3
+        assert len(fake_stripe.requests) == 2
+        assert guard.stats()['rejected_bulkhead'] == 3
+
+    def test_breaker_opens_and_fails_fast(self, fake_stripe, http_client):
+        """Test that consecutive server errors open the circuit and stop calls to Stripe."""
+        guard = guarded_client(http_client, failure_threshold=3, reset_timeout=30)
+        fake_stripe.fail_statuses = [500, 503, 500]
+        trip(guard)
+
+        with pytest.raises(StripeUnavailable) as error:
+            create_customer()
+
+        assert error.value.reason == 'circuit open'
+        assert 0 < error.value.retry_after <= 30
+        assert len(fake_stripe.requests) == 3
+        stats = guard.stats()
+        assert stats['breaker']['state'] == 'open'
+        assert stats['rejected_open'] == 1
+        assert stats['failures'] == 3
+
+    def test_client_errors_do_not_trip_breaker(self, fake_stripe, http_client):
+        """Test that 4xx responses are the caller's problem, not Stripe being down."""
+        guard = guarded_client(http_client, failure_threshold=2)
+        fake_stripe.fail_statuses = [400, 400, 400]
+
+        for _ in range(3):
+            with pytest.raises(stripe.InvalidRequestError):
+                create_customer()
+
+        assert guard.stats()['breaker']['state'] == 'closed'
+
+    def test_half_open_trial_closes_breaker(self, fake_stripe, http_client):
+        """Test that a successful trial call after the reset timeout closes the circuit."""
+        guard = guarded_client(http_client, failure_threshold=2, reset_timeout=0.1)
+        fake_stripe.fail_statuses = [500, 500]
+        trip(guard)
+
+        time.sleep(0.15)
+        assert create_customer().object == 'customer'
+
+        assert guard.stats()['breaker'] == {'state': 'closed', 'consecutive_failures': 0, 'times_opened': 1}
+
+    def test_half_open_failure_reopens_breaker(self, fake_stripe, http_client):
+        """Test that a failed trial call opens the circuit again straight away."""
+        guard = guarded_client(http_client, failure_threshold=2, reset_timeout=0.1)
+        fake_stripe.fail_statuses = [500, 500, 500]
+        trip(guard)
+
+        time.sleep(0.15)
+        with pytest.raises(stripe.APIError):
+            create_customer()
+        with pytest.raises(StripeUnavailable, match='circuit open'):
+            create_customer()
+
+        assert guard.stats()['breaker']['times_opened'] == 2
+
+    def test_route_returns_503_when_breaker_open(self, fake_stripe, http_client, auth_client):
+        """Test that routes answer 503 with Retry-After once Stripe is considered down."""
+        http_client(stripe_http_client)
+        fake_stripe.fail_statuses = [500] * 10
+
+        def create_intent():
+            return auth_client.post('/api/stripe/create-payment-intent',
+                                    data=json.dumps({'amount': 17500}),
+                                    content_type='application/json')
+
+        statuses = [create_intent().status_code for _ in range(5)]
+        response = create_intent()
+
+        assert statuses == [500] * 5
+        assert response.status_code == 503
+        assert int(response.headers['Retry-After']) > 0
+        assert len(fake_stripe.requests) == 5
+        guard_stats = json.loads(auth_client.get('/api/metrics').data)['stripe_guard']
+        assert guard_stats['breaker']['state'] == 'open'
+        assert guard_stats['rejected_open'] == 1
+
+    def test_deadline_is_shared_within_a_request(self, fake_stripe, http_client, auth_client):
+        """Test that the calls made by one request share a single deadline."""
+        guard = guarded_client(http_client, deadline=0.5)
+        fake_stripe.latency = 0.3
+
+        response = auth_client.post('/api/stripe/membership/create-checkout-session',
+                                    data=json.dumps({'plan_id': 'monthly'}),
+                                    content_type='application/json')
+
+        assert response.status_code == 503
+        # The customer was created; the checkout session ran out of time
+        assert [path for _, path, _ in fake_stripe.requests] == ['/v1/customers', '/v1/checkout/sessions']
+        assert guard.stats()['rejected_deadline'] == 1
@@ -335,4 +335,72 @@ class TestStripeRoutes:
                               data=json.dumps(webhook_data),
                               content_type='application/json')
         
-        assert response.status_code == 200  # Should still return 200 for unsupported events 
\ No newline at end of file
+        assert response.status_code == 200  # Should still return 200 for unsupported events 
+
+
+def paid_checkout_session(user_id, subscription_id='sub_test123'):
+    """A paid checkout session retrieved with its subscription expanded"""
+    return MagicMock(
+        payment_status='paid',
+        metadata={'user_id': str(user_id), 'plan_id': 'monthly'},
+        subscription={
+            'id': subscription_id,
+            'status': 'active',
+            'current_period_start': 1700000000,
+            'current_period_end': 1702592000
+        }
+    )
+
+
+def verify(client, session_id='cs_test123'):
+    return client.post('/api/stripe/membership/verify-payment',
+                       data=json.dumps({'session_id': session_id}),
+                       content_type='application/json')
+
+
+class TestVerifyPayment:
+    """Test checkout verification after payment."""
+
+    @patch('routes.stripe.stripe.Subscription.retrieve')
+    @patch('routes.stripe.stripe.checkout.Session.retrieve')
+    def test_verify_creates_membership_in_one_call(self, mock_session, mock_subscription, auth_client):
+        """Test that the subscription comes expanded on the session, not from a second call."""
+        with auth_client.session_transaction() as sess:
+            user_id = sess['user_id']
+        mock_session.return_value = paid_checkout_session(user_id)
+
+        response = verify(auth_client)
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['message'] == 'Membership created successfully'
+        mock_session.assert_called_once_with('cs_test123', expand=['subscription'])
+        mock_subscription.assert_not_called()
+        with auth_client.application.app_context():
+            membership = Membership.query.filter_by(stripe_subscription_id='sub_test123').one()
+            assert membership.user_id == user_id
+            assert membership.status == 'active'
+
+    @patch('routes.stripe.stripe.checkout.Session.retrieve')
+    def test_repeated_verification_skips_stripe(self, mock_session, auth_client):
+        """Test that polling a verified session is answered locally."""
+        with auth_client.session_transaction() as sess:
+            user_id = sess['user_id']
+        mock_session.return_value = paid_checkout_session(user_id)
+
+        responses = [verify(auth_client) for _ in range(3)]
+
+        assert [json.loads(r.data)['message'] for r in responses] == \
+            ['Membership created successfully'] + ['Membership already exists'] * 2
+        assert mock_session.call_count == 1
+        stats = json.loads(auth_client.get('/api/metrics').data)['verified_sessions']
+        assert stats['hits'] == 2
+
+    @patch('routes.stripe.stripe.checkout.Session.retrieve')
+    def test_unpaid_session_is_not_cached(self, mock_session, auth_client):
+        """Test that an unpaid session is checked with Stripe again on the next poll."""
+        mock_session.return_value = MagicMock(payment_status='unpaid')
+
+        assert verify(auth_client).status_code == 400
+        assert verify(auth_client).status_code == 400
+
+        assert mock_session.call_count == 2
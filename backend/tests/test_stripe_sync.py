@@ -0,0 +1,147 @@
+import pytest
+import os
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+from models import db, User, Membership
+from services.stripe_sync import sync_subscriptions
+from test_config import client
+
+PRICE_ID = 'price_1Rc9bqDCByDO1M05EKF5yK8c'
+
+def stripe_subscription(number, customer='cus_1', status='active'):
+    return {
+        'id': f'sub_{number:05d}',
+        'customer': customer,
+        'status': status,
+        'current_period_start': 1640995200,
+        'current_period_end': 1643673600,
+        'items': {'data': [{'price': {'id': PRICE_ID}}]}
+    }
+
+def mock_listing(mock_list, subscriptions):
+    """Serve subscriptions from Subscription.list, honouring starting_after"""
+    def list_subscriptions(**params):
+        start = 0
+        if params.get('starting_after'):
+            start = [sub['id'] for sub in subscriptions].index(params['starting_after']) + 1
+        listing = MagicMock()
+        listing.auto_paging_iter.return_value = iter(subscriptions[start:])
+        return listing
+    mock_list.side_effect = list_subscriptions
+
+def sync(client, *args):
+    return client.application.test_cli_runner().invoke(args=['stripe', 'sync-subscriptions', *args])
+
+@pytest.fixture
+def customer(client):
+    with client.application.app_context():
+        user = User(username='member', email='member@example.com', password_hash='hash',
+                    stripe_customer_id='cus_1')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+@pytest.fixture
+def cursor_file(tmp_path):
+    return str(tmp_path / 'sync.cursor')
+
+class TestStripeSync:
+    """Test the Stripe to memberships reconciliation command."""
+
+    @patch('stripe.Subscription.list')
+    def test_creates_and_updates_memberships(self, mock_list, client, customer, cursor_file):
+        """Test that missing memberships are created and drifted ones corrected."""
+        with client.application.app_context():
+            db.session.add(Membership(user_id=customer, stripe_subscription_id='sub_00001',
+                                      plan_type='monthly', status='past_due',
+                                      current_period_start=datetime.fromtimestamp(1640995200),
+                                      current_period_end=datetime.fromtimestamp(1643673600)))
+            db.session.commit()
+        mock_listing(mock_list, [
+            stripe_subscription(1),
+            stripe_subscription(2, status='canceled'),
+            stripe_subscription(3, customer='cus_unknown'),
+        ])
+
+        result = sync(client, '--cursor-file', cursor_file)
+
+        assert result.exit_code == 0, result.output
+        assert 'Created 1, updated 1, unchanged 0, skipped 1' in result.output
+        assert mock_list.call_args.kwargs == {'limit': 100, 'status': 'all'}
+        with client.application.app_context():
+            memberships = {m.stripe_subscription_id: m for m in Membership.query.all()}
+            assert set(memberships) == {'sub_00001', 'sub_00002'}
+            assert memberships['sub_00001'].status == 'active'
+            assert memberships['sub_00002'].status == 'cancelled'
+            assert memberships['sub_00002'].plan_type == 'monthly'
+            assert memberships['sub_00002'].user_id == customer
+        # A completed run leaves nothing to resume
+        assert not os.path.exists(cursor_file)
+
+    @patch('stripe.Subscription.list')
+    def test_dry_run_prints_diff_without_writing(self, mock_list, client, customer, cursor_file):
+        """Test that --dry-run reports changes and leaves the table alone."""
+        mock_listing(mock_list, [stripe_subscription(1)])
+
+        result = sync(client, '--dry-run', '--cursor-file', cursor_file)
+
+        assert result.exit_code == 0
+        assert "create sub_00001: user_id: None -> 1, plan_type: None -> 'monthly'" in result.output
+        assert 'Would create 1' in result.output
+        with client.application.app_context():
+            assert Membership.query.count() == 0
+        assert not os.path.exists(cursor_file)
+
+    @patch('stripe.Subscription.list')
+    def test_unchanged_rows_are_not_written(self, mock_list, client, customer, cursor_file):
+        """Test that a second run finds nothing to change."""
+        mock_listing(mock_list, [stripe_subscription(n) for n in range(1, 4)])
+        sync(client, '--cursor-file', cursor_file)
+
+        result = sync(client, '--cursor-file', cursor_file)
+
+        assert 'Created 0, updated 0, unchanged 3' in result.output
+
+    @patch('stripe.Subscription.list')
+    def test_interrupted_run_resumes_from_cursor(self, mock_list, client, customer, cursor_file):
+        """Test that --resume continues after the last committed batch."""
+        subscriptions = [stripe_subscription(n) for n in range(1, 8)]
+
+        def interrupt_after_two_batches(report, changes):
+            if report['seen'] >= 4:
+                raise KeyboardInterrupt
+        mock_listing(mock_list, subscriptions)
+        with client.application.app_context():
+            with pytest.raises(KeyboardInterrupt):
+                sync_subscriptions({PRICE_ID: 'monthly'}, batch_size=2, on_batch=interrupt_after_two_batches)
+            assert Membership.query.count() == 4
+
+        with open(cursor_file, 'w') as f:
+            f.write('sub_00004')
+        result = sync(client, '--resume', '--batch-size', '2', '--cursor-file', cursor_file)
+
+        assert result.exit_code == 0, result.output
+        assert 'Resuming after sub_00004' in result.output
+        assert mock_list.call_args.kwargs['starting_after'] == 'sub_00004'
+        assert 'Created 3' in result.output
+        with client.application.app_context():
+            assert Membership.query.count() == 7
+
+    @patch('stripe.Subscription.list')
+    def test_cursor_saved_after_each_batch(self, mock_list, client, customer, cursor_file):
+        """Test that progress is recorded as batches commit."""
+        mock_listing(mock_list, [stripe_subscription(n) for n in range(1, 6)])
+        saved = []
+        original_remove = os.remove
+
+        def record_remove(path):
+            with open(path) as f:
+                saved.append(f.read())
+            original_remove(path)
+
+        with patch('routes.stripe.os.remove', side_effect=record_remove):
+            result = sync(client, '--batch-size', '2', '--cursor-file', cursor_file)
+
+        assert result.exit_code == 0
+        assert saved == ['sub_00005']
+        assert result.output.count('subscriptions in') == 3
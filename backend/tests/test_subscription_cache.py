@@ -0,0 +1,108 @@
+import pytest
+import json
+import threading
+import time
+from unittest.mock import patch
+from models import db, User, Membership
+from services.subscription_cache import SubscriptionCache, subscription_cache
+from test_config import client
+
+def subscription_payload(subscription_id='sub_test123', status='active'):
+    return {
+        'id': subscription_id,
+        'object': 'subscription',
+        'status': status,
+        'current_period_start': 1640995200,
+        'current_period_end': 1643673600
+    }
+
+class TestSubscriptionCache:
+    """Test the Stripe subscription cache."""
+
+    @patch('stripe.Subscription.retrieve')
+    def test_concurrent_misses_make_one_call(self, mock_retrieve, client):
+        """Test that simultaneous misses for one id share a single Stripe call."""
+        def slow_retrieve(subscription_id):
+            time.sleep(0.1)
+            return subscription_payload(subscription_id)
+        mock_retrieve.side_effect = slow_retrieve
+        cache = SubscriptionCache()
+        app = client.application
+        results = []
+
+        def worker():
+            with app.app_context():
+                results.append(cache.get('sub_test123'))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert mock_retrieve.call_count == 1
+        assert len(results) == 8
+        assert all(result['id'] == 'sub_test123' for result in results)
+        assert cache.stats()['coalesced'] == 7
+
+    @patch('stripe.Subscription.retrieve')
+    def test_hit_within_ttl(self, mock_retrieve, client):
+        """Test that repeated lookups are served from the cache."""
+        mock_retrieve.return_value = subscription_payload()
+
+        subscription_cache.get('sub_test123')
+        subscription_cache.get('sub_test123')
+
+        assert mock_retrieve.call_count == 1
+        assert subscription_cache.stats()['hits'] == 1
+
+    @patch('stripe.Subscription.retrieve')
+    def test_failed_fetch_is_not_cached(self, mock_retrieve, client):
+        """Test that errors propagate and the next call retries."""
+        mock_retrieve.side_effect = [Exception('Stripe error'), subscription_payload()]
+
+        with pytest.raises(Exception):
+            subscription_cache.get('sub_test123')
+        assert subscription_cache.get('sub_test123')['status'] == 'active'
+
+    @patch('stripe.Subscription.retrieve')
+    def test_subscription_event_overwrites_entry(self, mock_retrieve, client):
+        """Test that customer.subscription.* webhooks replace the cached copy."""
+        mock_retrieve.return_value = subscription_payload()
+        subscription_cache.get('sub_test123')
+
+        client.post('/api/stripe/webhook',
+                   data=json.dumps({
+                       'type': 'customer.subscription.updated',
+                       'data': {'object': subscription_payload(status='past_due')}
+                   }),
+                   content_type='application/json')
+
+        assert subscription_cache.get('sub_test123')['status'] == 'past_due'
+        assert mock_retrieve.call_count == 1
+
+    @patch('stripe.Subscription.retrieve')
+    def test_invoice_event_invalidates_entry(self, mock_retrieve, client):
+        """Test that invoice webhooks force the next lookup to refetch."""
+        with client.application.app_context():
+            user = User(username='member', email='member@example.com', password_hash='hash')
+            db.session.add(user)
+            db.session.commit()
+            db.session.add(Membership(user_id=user.id, stripe_subscription_id='sub_test123',
+                                      plan_type='monthly', status='active'))
+            db.session.commit()
+        mock_retrieve.return_value = subscription_payload()
+        subscription_cache.get('sub_test123')
+
+        mock_retrieve.return_value = subscription_payload(status='past_due')
+        client.post('/api/stripe/webhook',
+                   data=json.dumps({
+                       'type': 'invoice.payment_succeeded',
+                       'data': {'object': {'id': 'in_test', 'subscription': 'sub_test123'}}
+                   }),
+                   content_type='application/json')
+
+        assert mock_retrieve.call_count == 2
+        with client.application.app_context():
+            membership = Membership.query.filter_by(stripe_subscription_id='sub_test123').first()
+            assert membership.status == 'past_due'
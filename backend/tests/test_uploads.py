@@ -0,0 +1,472 @@
+import pytest
+import io
+import os
+import json
+from unittest.mock import patch
+from PIL import Image
+from models import db, User, ProfilePictureFile
+from services.thumbnails import VARIANT_SIZES, variant_filename, variant_filenames
+from services import uploads
+from services.uploads import shard_directory, relative_stored_path, acquire_file, remove_unreferenced_file
+from test_config import client, auth_client
+
+def image_bytes(image_format, size=(600, 400), color=(200, 30, 30)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, image_format)
+    return buffer.getvalue()
+
+PNG_BYTES = image_bytes('PNG')
+GIF_BYTES = image_bytes('GIF', color=(30, 30, 200))
+
+@pytest.fixture
+def upload_dir(client, tmp_path):
+    """Point profile picture storage at a temporary directory."""
+    client.application.config['UPLOAD_FOLDER'] = str(tmp_path)
+    yield tmp_path
+    client.application.config['UPLOAD_FOLDER'] = None
+
+def upload(client, content, filename):
+    return client.post('/api/upload-profile-picture',
+                       data={'file': (io.BytesIO(content), filename)},
+                       content_type='multipart/form-data')
+
+def all_files(directory):
+    return sorted(name for _, _, files in os.walk(directory) for name in files)
+
+def stored_files(directory):
+    """Originals in the upload directory, ignoring resized variants"""
+    return [name for name in all_files(directory) if '_' not in name]
+
+def stored_path(directory, filename):
+    return os.path.join(shard_directory(str(directory), filename), filename)
+
+class TestProfilePictureUploads:
+    """Test streamed, content-addressed profile picture uploads."""
+
+    def test_upload_stored_by_content_hash(self, auth_client, upload_dir):
+        """Test that uploads are named after their SHA-256 digest."""
+        import hashlib
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['profile_picture'] == f"{hashlib.sha256(PNG_BYTES).hexdigest()}.png"
+        assert stored_files(upload_dir) == [data['profile_picture']]
+
+    def test_duplicate_uploads_share_one_file(self, auth_client, upload_dir):
+        """Test that identical content from two users is stored once."""
+        upload(auth_client, PNG_BYTES, 'avatar.png')
+
+        with auth_client.application.app_context():
+            other = User(username='other', email='other@example.com', password_hash='hash')
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+        with auth_client.session_transaction() as sess:
+            sess['user_id'] = other_id
+
+        response = upload(auth_client, PNG_BYTES, 'copy.jpg')
+
+        assert response.status_code == 200
+        assert len(stored_files(upload_dir)) == 1
+        with auth_client.application.app_context():
+            stored_file = ProfilePictureFile.query.one()
+            assert stored_file.ref_count == 2
+
+        # The file survives until its last reference is dropped
+        auth_client.delete('/api/delete-profile-picture')
+        assert len(stored_files(upload_dir)) == 1
+        with auth_client.session_transaction() as sess:
+            sess['user_id'] = 1
+        auth_client.delete('/api/delete-profile-picture')
+        assert all_files(upload_dir) == []
+
+    def test_replacing_picture_reclaims_old_file(self, auth_client, upload_dir):
+        """Test that replacing a picture deletes the unreferenced old file."""
+        upload(auth_client, PNG_BYTES, 'avatar.png')
+        response = upload(auth_client, GIF_BYTES, 'avatar.gif')
+
+        data = json.loads(response.data)
+        assert all_files(upload_dir) == sorted(
+            [data['profile_picture']] +
+            [variant_filename(data['profile_picture'], size) for size in VARIANT_SIZES]
+        )
+
+    def test_cleanup_spares_file_acquired_again(self, auth_client, upload_dir):
+        """Test that a queued deletion leaves a file alone once it is referenced again."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        with auth_client.application.app_context():
+            assert remove_unreferenced_file(str(upload_dir), filename) is False
+
+        assert stored_files(upload_dir) == [filename]
+
+    def test_upload_restores_file_deleted_before_commit(self, auth_client, upload_dir):
+        """Test that an upload puts its file back if a cleanup of the same content removed it."""
+        filename = json.loads(upload(auth_client, PNG_BYTES, 'avatar.png').data)['profile_picture']
+        real_acquire = acquire_file
+
+        def acquire_after_cleanup(*args):
+            # The old owner's cleanup runs between storing the upload and committing its reference
+            os.remove(stored_path(upload_dir, filename))
+            return real_acquire(*args)
+
+        with patch('routes.auth.acquire_file', side_effect=acquire_after_cleanup):
+            response = upload(auth_client, PNG_BYTES, 'again.png')
+
+        assert response.status_code == 200
+        with open(stored_path(upload_dir, filename), 'rb') as f:
+            assert f.read() == PNG_BYTES
+        assert not [name for name in all_files(upload_dir) if name.startswith('.upload-')]
+
+    def test_concurrent_first_upload_shares_row(self, client):
+        """Test that losing the race to insert a file's row adds a reference to the winner's."""
+        real_increment = uploads._increment_ref_count
+        calls = []
+
+        def racing_increment(filename, amount=1):
+            calls.append(filename)
+            # The first lookup misses the row another upload is about to commit
+            return 0 if len(calls) == 1 else real_increment(filename, amount)
+
+        with client.application.app_context():
+            db.session.add(ProfilePictureFile(filename='abcd.png', size=10, ref_count=1))
+            db.session.commit()
+
+            with patch('services.uploads._increment_ref_count', side_effect=racing_increment):
+                acquire_file('abcd.png', 10)
+            db.session.commit()
+
+            assert ProfilePictureFile.query.one().ref_count == 2
+
+    def test_magic_bytes_mismatch_rejected(self, auth_client, upload_dir):
+        """Test that content that isn't an allowed image is rejected."""
+        response = upload(auth_client, b'<html>not an image</html>', 'avatar.png')
+
+        assert response.status_code == 400
+        assert 'Invalid file type' in json.loads(response.data)['error']
+        assert all_files(upload_dir) == []
+
+    def test_disallowed_extension_rejected(self, auth_client, upload_dir):
+        """Test that disallowed extensions are rejected before storing anything."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.exe')
+
+        assert response.status_code == 400
+        assert all_files(upload_dir) == []
+
+    def test_oversized_upload_rejected(self, auth_client, upload_dir):
+        """Test that uploads over the byte limit are rejected."""
+        auth_client.application.config['PROFILE_PICTURE_MAX_BYTES'] = 256
+        try:
+            response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        finally:
+            auth_client.application.config['PROFILE_PICTURE_MAX_BYTES'] = 5 * 1024 * 1024
+
+        assert response.status_code == 413
+        assert all_files(upload_dir) == []
+
+    def test_upload_not_authenticated(self, client, upload_dir):
+        """Test uploading when not authenticated."""
+        response = upload(client, PNG_BYTES, 'avatar.png')
+
+        assert response.status_code == 401
+
+class TestProfilePictureVariants:
+    """Test resized profile picture variants."""
+
+    def test_variants_generated_after_upload(self, auth_client, upload_dir):
+        """Test that every variant size is generated as a square WebP."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        for size in VARIANT_SIZES:
+            with Image.open(stored_path(upload_dir, variant_filename(filename, size))) as variant:
+                assert variant.size == (size, size)
+                assert variant.format == 'WEBP'
+
+    def test_size_parameter_serves_nearest_variant(self, auth_client, upload_dir):
+        """Test that ?size= serves the smallest variant at least that large."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        response = auth_client.get(f'/api/profile-picture/{filename}?size=100')
+
+        assert response.status_code == 200
+        assert response.mimetype == 'image/webp'
+        assert Image.open(io.BytesIO(response.data)).size == (256, 256)
+        assert len(response.data) < len(PNG_BYTES)
+
+    def test_size_parameter_falls_back_to_original(self, auth_client, upload_dir):
+        """Test that the original is served when no variant exists yet."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+        os.remove(stored_path(upload_dir, variant_filename(filename, 64)))
+
+        response = auth_client.get(f'/api/profile-picture/{filename}?size=64')
+
+        assert response.status_code == 200
+        assert response.data == PNG_BYTES
+
+    def test_size_larger_than_variants_serves_original(self, auth_client, upload_dir):
+        """Test that sizes beyond the largest variant get the original."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        response = auth_client.get(f'/api/profile-picture/{filename}?size=2048')
+
+        assert response.data == PNG_BYTES
+
+class TestProfilePictureCaching:
+    """Test conditional and ranged profile picture requests."""
+
+    def test_response_is_immutable_with_strong_etag(self, auth_client, upload_dir):
+        """Test that pictures carry a strong ETag and long-lived immutable caching."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        response = auth_client.get(f'/api/profile-picture/{filename}')
+
+        assert response.status_code == 200
+        assert response.get_etag() == (filename.rsplit('.', 1)[0], False)
+        assert response.cache_control.immutable
+        assert response.cache_control.max_age == 365 * 24 * 60 * 60
+
+    def test_if_none_match_returns_304_without_opening_file(self, auth_client, upload_dir):
+        """Test that a matching ETag is answered before touching the file."""
+        from unittest.mock import patch
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+        etag = filename.rsplit('.', 1)[0]
+
+        with patch('routes.auth.send_from_directory') as mock_send:
+            response = auth_client.get(f'/api/profile-picture/{filename}',
+                                       headers={'If-None-Match': f'"{etag}"'})
+            mock_send.assert_not_called()
+
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.cache_control.immutable
+
+    def test_if_none_match_mismatch_sends_file(self, auth_client, upload_dir):
+        """Test that a stale ETag gets the full picture."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        response = auth_client.get(f'/api/profile-picture/{filename}',
+                                   headers={'If-None-Match': '"stale"'})
+
+        assert response.status_code == 200
+        assert response.data == PNG_BYTES
+
+    def test_if_modified_since_returns_304(self, auth_client, upload_dir):
+        """Test that any cached copy of an immutable picture is revalidated."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        response = auth_client.get(f'/api/profile-picture/{filename}',
+                                   headers={'If-Modified-Since': 'Thu, 01 Jan 2026 00:00:00 GMT'})
+
+        assert response.status_code == 304
+
+    def test_range_request(self, auth_client, upload_dir):
+        """Test that byte ranges are served as partial content."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        response = auth_client.get(f'/api/profile-picture/{filename}',
+                                   headers={'Range': 'bytes=0-7'})
+
+        assert response.status_code == 206
+        assert response.data == PNG_BYTES[:8]
+        assert response.headers['Content-Range'] == f'bytes 0-7/{len(PNG_BYTES)}'
+
+    def test_fallback_original_is_not_immutable(self, auth_client, upload_dir):
+        """Test that the original served in place of a missing variant is cached briefly."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+        os.remove(stored_path(upload_dir, variant_filename(filename, 64)))
+
+        response = auth_client.get(f'/api/profile-picture/{filename}?size=64')
+
+        assert response.status_code == 200
+        assert not response.cache_control.immutable
+        assert response.cache_control.max_age == 60
+
+class TestProfilePictureOffload:
+    """Test handing profile picture transfers to the front proxy."""
+
+    @pytest.fixture
+    def offload(self, client):
+        def set_mode(mode):
+            client.application.config['PROFILE_PICTURE_OFFLOAD'] = mode
+        yield set_mode
+        client.application.config['PROFILE_PICTURE_OFFLOAD'] = None
+
+    def test_x_accel_redirect(self, auth_client, upload_dir, offload):
+        """Test that nginx mode emits X-Accel-Redirect under the internal prefix."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+        offload('x-accel-redirect')
+
+        response = auth_client.get(f'/api/profile-picture/{filename}')
+
+        assert response.status_code == 200
+        assert response.headers['X-Accel-Redirect'] == f'/protected/profile_pictures/{relative_stored_path(filename)}'
+        assert response.mimetype == 'image/png'
+        assert response.data == b''
+        assert response.get_etag() == (filename.rsplit('.', 1)[0], False)
+        assert response.cache_control.immutable
+
+    def test_x_accel_redirect_serves_variant(self, auth_client, upload_dir, offload):
+        """Test that the redirect points at the resized variant when one is requested."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+        offload('x-accel-redirect')
+
+        response = auth_client.get(f'/api/profile-picture/{filename}?size=64')
+
+        assert response.headers['X-Accel-Redirect'] == \
+            f'/protected/profile_pictures/{relative_stored_path(variant_filename(filename, 64))}'
+        assert response.mimetype == 'image/webp'
+
+    def test_x_sendfile(self, auth_client, upload_dir, offload):
+        """Test that sendfile mode emits the absolute file path."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+        offload('x-sendfile')
+
+        response = auth_client.get(f'/api/profile-picture/{filename}')
+
+        assert response.status_code == 200
+        assert response.headers['X-Sendfile'] == stored_path(upload_dir, filename)
+        assert response.data == b''
+
+    def test_offload_still_answers_304(self, auth_client, upload_dir, offload):
+        """Test that revalidation never reaches the proxy."""
+        offload('x-accel-redirect')
+
+        response = auth_client.get('/api/profile-picture/abc.png',
+                                   headers={'If-None-Match': '"abc"'})
+
+        assert response.status_code == 304
+        assert 'X-Accel-Redirect' not in response.headers
+
+class TestUploadReconciliation:
+    """Test the sharded layout and the orphan reconciler."""
+
+    def test_upload_is_sharded_by_name_prefix(self, auth_client, upload_dir):
+        """Test that files are stored two directory levels deep."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        filename = json.loads(response.data)['profile_picture']
+
+        assert os.path.exists(upload_dir / filename[:2] / filename[2:4] / filename)
+
+    def test_reconcile_removes_orphans_and_reshards(self, auth_client, upload_dir):
+        """Test that unreferenced files go and flat referenced files move into shards."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        kept = json.loads(response.data)['profile_picture']
+
+        # A crash between saving and committing leaves an unreferenced file
+        orphan_directory = upload_dir / 'ff' / 'ee'
+        orphan_directory.mkdir(parents=True)
+        (orphan_directory / 'ffee0000.png').write_bytes(PNG_BYTES)
+        # A pre-sharding upload still referenced by a user
+        (upload_dir / 'legacy-0001.png').write_bytes(GIF_BYTES)
+        with auth_client.application.app_context():
+            db.session.add(User(username='legacy', email='legacy@example.com',
+                                password_hash='hash', profile_picture='legacy-0001.png'))
+            db.session.commit()
+
+        runner = auth_client.application.test_cli_runner()
+        result = runner.invoke(args=['auth', 'reconcile-uploads', '--grace-seconds', '0'])
+
+        assert result.exit_code == 0
+        assert 'Removed 1 orphaned files' in result.output
+        assert stored_files(upload_dir) == sorted([kept, 'legacy-0001.png'])
+        assert os.path.exists(stored_path(upload_dir, 'legacy-0001.png'))
+        with auth_client.application.app_context():
+            stored_file = ProfilePictureFile.query.filter_by(filename='legacy-0001.png').one()
+            assert stored_file.ref_count == 1
+
+    def test_reconcile_keeps_references_made_during_walk(self, auth_client, upload_dir):
+        """Test that uploads committed while the folder is walked aren't undone."""
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+        kept = json.loads(response.data)['profile_picture']
+        orphan_directory = upload_dir / 'ff' / 'ee'
+        orphan_directory.mkdir(parents=True)
+        (orphan_directory / 'ffee0000.png').write_bytes(PNG_BYTES)
+
+        real_walk = os.walk
+        def walk_during_uploads(path):
+            # Other requests share the kept picture and take up the old one
+            with db.engine.begin() as connection:
+                connection.execute(User.__table__.insert(), [
+                    {'username': 'second', 'email': 'second@example.com',
+                     'password_hash': 'hash', 'profile_picture': kept},
+                    {'username': 'revived', 'email': 'revived@example.com',
+                     'password_hash': 'hash', 'profile_picture': 'ffee0000.png'},
+                ])
+                connection.execute(ProfilePictureFile.__table__.update()
+                                   .where(ProfilePictureFile.filename == kept)
+                                   .values(ref_count=2))
+                connection.execute(ProfilePictureFile.__table__.insert(),
+                                   {'filename': 'ffee0000.png', 'size': len(PNG_BYTES), 'ref_count': 1})
+            return real_walk(path)
+
+        with auth_client.application.app_context():
+            with patch('services.uploads.os.walk', side_effect=walk_during_uploads):
+                report = uploads.reconcile_uploads(str(upload_dir), variant_filenames, grace_seconds=0)
+
+            assert report['orphans'] == []
+            assert os.path.exists(orphan_directory / 'ffee0000.png')
+            counts = dict(db.session.query(ProfilePictureFile.filename, ProfilePictureFile.ref_count))
+            assert counts == {kept: 2, 'ffee0000.png': 1}
+
+    def test_legacy_flat_picture_is_served(self, auth_client, upload_dir):
+        """Test that pictures reconcile hasn't moved yet are served from the flat layout."""
+        (upload_dir / 'legacy-0001.png').write_bytes(PNG_BYTES)
+
+        response = auth_client.get('/api/profile-picture/legacy-0001.png')
+        resized = auth_client.get('/api/profile-picture/legacy-0001.png?size=64')
+
+        assert response.status_code == 200
+        assert response.data == PNG_BYTES
+        assert resized.status_code == 200
+        assert resized.data == PNG_BYTES
+
+    def test_replacing_legacy_picture_removes_flat_file(self, auth_client, upload_dir):
+        """Test that an unsharded picture is deleted once it's replaced."""
+        (upload_dir / 'legacy-0001.png').write_bytes(GIF_BYTES)
+        with auth_client.application.app_context():
+            with auth_client.session_transaction() as sess:
+                user = db.session.get(User, sess['user_id'])
+            user.profile_picture = 'legacy-0001.png'
+            db.session.commit()
+
+        response = upload(auth_client, PNG_BYTES, 'avatar.png')
+
+        assert response.status_code == 200
+        assert stored_files(upload_dir) == [json.loads(response.data)['profile_picture']]
+
+    def test_reconcile_dry_run_changes_nothing(self, auth_client, upload_dir):
+        """Test that a dry run only reports orphans."""
+        orphan_directory = upload_dir / 'ab' / 'cd'
+        orphan_directory.mkdir(parents=True)
+        (orphan_directory / 'abcd.png').write_bytes(PNG_BYTES)
+
+        runner = auth_client.application.test_cli_runner()
+        result = runner.invoke(args=['auth', 'reconcile-uploads', '--dry-run', '--grace-seconds', '0'])
+
+        assert 'Would remove 1 orphaned files' in result.output
+        assert all_files(upload_dir) == ['abcd.png']
+
+    def test_reconcile_spares_recent_files(self, auth_client, upload_dir):
+        """Test that files inside the grace period are kept."""
+        (upload_dir / '.upload-inflight').write_bytes(b'partial')
+
+        runner = auth_client.application.test_cli_runner()
+        result = runner.invoke(args=['auth', 'reconcile-uploads'])
+
+        assert 'Removed 0 orphaned files' in result.output
+        assert all_files(upload_dir) == ['.upload-inflight']
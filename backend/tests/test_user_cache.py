@@ -0,0 +1,73 @@
+import pytest
+import json
+from unittest.mock import patch
+from models import db, User
+from services.user_cache import UserCache, user_cache
+from test_config import client, auth_client
+
+class TestUserCache:
+    """Test the per-process user cache."""
+
+    def test_check_auth_served_from_cache(self, auth_client):
+        """Test that repeated /api/check calls hit the cache."""
+        auth_client.get('/api/check')
+        with patch('services.user_cache.db.session.get') as mock_get:
+            response = auth_client.get('/api/check')
+            mock_get.assert_not_called()
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['user']['username'].startswith('testuser')
+        assert user_cache.stats()['hits'] == 1
+
+    def test_profile_update_writes_through(self, auth_client):
+        """Test that a profile update replaces the cached payload."""
+        auth_client.get('/api/user')
+
+        auth_client.put('/api/user',
+                       data=json.dumps({'email': 'cached@example.com'}),
+                       content_type='application/json')
+
+        response = auth_client.get('/api/user')
+        data = json.loads(response.data)
+        assert data['user']['email'] == 'cached@example.com'
+
+    def test_delete_profile_picture_invalidates(self, auth_client):
+        """Test that deleting a profile picture drops the cached payload."""
+        with auth_client.application.app_context():
+            user = User.query.first()
+            user.profile_picture = 'missing.png'
+            db.session.commit()
+            user_id = user.id
+
+        auth_client.get('/api/check')
+        assert user_cache.stats()['size'] == 1
+
+        auth_client.delete('/api/delete-profile-picture')
+        assert user_cache.stats()['size'] == 0
+
+        response = auth_client.get('/api/check')
+        data = json.loads(response.data)
+        assert data['user']['profile_picture'] is None
+
+    def test_lru_eviction_and_ttl(self, client):
+        """Test that the cache evicts the least recently used entry and expires old ones."""
+        cache = UserCache()
+        client.application.config['USER_CACHE_SIZE'] = 2
+        try:
+            cache.set(1, {'id': 1})
+            cache.set(2, {'id': 2})
+            cache.get(1)
+            cache.set(3, {'id': 3})
+
+            assert cache.get(2) is None
+            assert cache.get(1) == {'id': 1}
+            assert cache.stats()['evictions'] == 1
+
+            client.application.config['USER_CACHE_TTL'] = 0
+            cache.set(4, {'id': 4})
+            assert cache.get(4) is None
+            assert cache.stats()['expirations'] == 1
+        finally:
+            client.application.config['USER_CACHE_SIZE'] = 1024
+            client.application.config['USER_CACHE_TTL'] = 30
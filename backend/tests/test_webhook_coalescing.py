@@ -0,0 +1,257 @@
+import pytest
+import json
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from models import db, User, Membership, WebhookEvent
+from routes.stripe import webhook_queue
+from services.webhook_coalescing import webhook_coalescer, subscription_key
+from test_config import client
+
+def subscription_payload(status='active'):
+    return {
+        'id': 'sub_test123',
+        'object': 'subscription',
+        'status': status,
+        'current_period_start': 1640995200,
+        'current_period_end': 1643673600
+    }
+
+def checkout_event(user_id, created):
+    return {
+        'id': 'evt_checkout',
+        'created': created,
+        'type': 'checkout.session.completed',
+        'data': {'object': {
+            'id': 'cs_test123',
+            'subscription': 'sub_test123',
+            'metadata': {'user_id': str(user_id), 'plan_id': 'monthly'}
+        }}
+    }
+
+def invoice_event(created, event_id='evt_invoice'):
+    return {
+        'id': event_id,
+        'created': created,
+        'type': 'invoice.payment_succeeded',
+        'data': {'object': {'id': 'in_test', 'subscription': 'sub_test123'}}
+    }
+
+def subscription_event(event_type, created, status='active'):
+    return {
+        'id': f'evt_{event_type}',
+        'created': created,
+        'type': event_type,
+        'data': {'object': subscription_payload(status)}
+    }
+
+def post_event(client, event):
+    return client.post('/api/stripe/webhook',
+                       data=json.dumps(event),
+                       content_type='application/json')
+
+@pytest.fixture
+def buffered(client):
+    """Queue events with a coalescing window instead of applying them inline"""
+    app = client.application
+    app.config['WEBHOOK_WORKERS'] = 1
+    app.config['WEBHOOK_COALESCE_WINDOW'] = 60
+    with patch.object(webhook_queue, '_ensure_workers'):
+        yield app
+    app.config['WEBHOOK_WORKERS'] = 0
+    app.config['WEBHOOK_COALESCE_WINDOW'] = 0
+
+def close_window(app):
+    """Make the oldest buffered event due, as if the window had elapsed"""
+    with app.app_context():
+        oldest = WebhookEvent.query.order_by(WebhookEvent.id).first()
+        oldest.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+@pytest.fixture
+def user_id(client):
+    with client.application.app_context():
+        user = User(username='member', email='member@example.com', password_hash='hash')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+class TestWebhookCoalescing:
+    """Test that bursts of events for one subscription are applied together."""
+
+    def test_subscription_key(self):
+        """Test that events are keyed by the subscription they describe."""
+        assert subscription_key(checkout_event(1, 0)) == 'sub_test123'
+        assert subscription_key(invoice_event(0)) == 'sub_test123'
+        assert subscription_key(subscription_event('customer.subscription.updated', 0)) == 'sub_test123'
+        assert subscription_key({'type': 'payment_intent.succeeded',
+                                 'data': {'object': {'id': 'pi_test'}}}) is None
+
+    @patch('stripe.Subscription.retrieve')
+    def test_signup_burst_makes_one_lookup_and_one_write(self, mock_retrieve, client, buffered, user_id):
+        """Test that checkout and invoice events for a new member are merged."""
+        mock_retrieve.return_value = subscription_payload()
+
+        post_event(client, checkout_event(user_id, 100))
+        post_event(client, invoice_event(101))
+
+        with buffered.app_context():
+            # Still inside the window
+            assert webhook_queue.drain() == 0
+        close_window(buffered)
+        with buffered.app_context():
+            assert webhook_queue.drain() == 2
+            assert WebhookEvent.query.count() == 0
+            membership = Membership.query.filter_by(stripe_subscription_id='sub_test123').one()
+            assert membership.user_id == user_id
+            assert membership.status == 'active'
+
+        assert mock_retrieve.call_count == 1
+        stats = webhook_coalescer.stats()
+        assert stats['groups'] == 1
+        assert stats['events'] == 2
+        assert stats['writes_saved'] == 1
+        assert stats['api_calls_saved'] == 1
+
+    @patch('stripe.Subscription.retrieve')
+    def test_subscription_event_supplies_state_without_lookup(self, mock_retrieve, client, buffered, user_id):
+        """Test that a newer subscription payload in the burst avoids the Stripe call."""
+        post_event(client, checkout_event(user_id, 100))
+        post_event(client, subscription_event('customer.subscription.created', 101, status='trialing'))
+
+        close_window(buffered)
+        with buffered.app_context():
+            webhook_queue.drain()
+            membership = Membership.query.filter_by(stripe_subscription_id='sub_test123').one()
+            assert membership.status == 'trialing'
+        mock_retrieve.assert_not_called()
+        stats = webhook_coalescer.stats()
+        assert stats['writes_saved'] == 1
+        assert stats['api_calls_saved'] == 1
+
+    @patch('stripe.Subscription.retrieve')
+    def test_newest_event_wins(self, mock_retrieve, client, buffered, user_id):
+        """Test that events are ordered by creation time, not arrival."""
+        with buffered.app_context():
+            db.session.add(Membership(user_id=user_id, stripe_subscription_id='sub_test123',
+                                      plan_type='monthly', status='active'))
+            db.session.commit()
+
+        # The cancellation is newer even though it arrives first
+        post_event(client, subscription_event('customer.subscription.deleted', 200, status='canceled'))
+        post_event(client, invoice_event(150))
+
+        close_window(buffered)
+        with buffered.app_context():
+            webhook_queue.drain()
+            membership = Membership.query.filter_by(stripe_subscription_id='sub_test123').one()
+            assert membership.status == 'cancelled'
+        mock_retrieve.assert_not_called()
+
+    def test_other_subscriptions_are_not_swept_up(self, client, buffered):
+        """Test that claiming a group leaves other subscriptions' events buffered."""
+        post_event(client, invoice_event(100))
+        other = invoice_event(100, event_id='evt_other')
+        other['data']['object']['subscription'] = 'sub_other'
+        post_event(client, other)
+
+        close_window(buffered)
+        with buffered.app_context():
+            assert webhook_queue.drain() == 1
+            remaining = WebhookEvent.query.one()
+            assert remaining.group_key == 'sub_other'
+
+    @patch('stripe.Subscription.retrieve')
+    def test_failed_group_is_retried_together(self, mock_retrieve, client, buffered, user_id):
+        """Test that a failure leaves every event of the group queued for retry."""
+        mock_retrieve.side_effect = Exception('Stripe unavailable')
+
+        post_event(client, checkout_event(user_id, 100))
+        post_event(client, invoice_event(101))
+
+        close_window(buffered)
+        with buffered.app_context():
+            assert webhook_queue.drain() == 2
+            queued = WebhookEvent.query.all()
+            assert len(queued) == 2
+            assert all(event.attempts == 1 for event in queued)
+            assert Membership.query.count() == 0
+
+def paid_invoice_event(created, amount_paid=2999):
+    event = invoice_event(created)
+    event['data']['object'].update({
+        'amount_paid': amount_paid,
+        'lines': {'data': [{
+            'subscription': 'sub_test123',
+            'period': {'start': 1643673600, 'end': 1646092800}
+        }]}
+    })
+    return event
+
+@pytest.fixture
+def membership(client, user_id):
+    with client.application.app_context():
+        db.session.add(Membership(user_id=user_id, stripe_subscription_id='sub_test123',
+                                  plan_type='monthly', status='active', stripe_event_created=100))
+        db.session.commit()
+
+def stored_membership(client):
+    with client.application.app_context():
+        return Membership.query.filter_by(stripe_subscription_id='sub_test123').one().to_dict()
+
+class TestWebhookPayloadState:
+    """Test that membership state is taken from event payloads when possible."""
+
+    @patch('stripe.Subscription.retrieve')
+    def test_renewal_uses_invoice_line_period(self, mock_retrieve, client, membership):
+        """Test that a paid invoice supplies the new period without a Stripe call."""
+        post_event(client, paid_invoice_event(200))
+
+        mock_retrieve.assert_not_called()
+        stored = stored_membership(client)
+        assert stored['status'] == 'active'
+        assert stored['current_period_end'] == datetime.fromtimestamp(1646092800).isoformat()
+
+    @patch('stripe.Subscription.retrieve')
+    def test_subscription_update_applies_payload(self, mock_retrieve, client, membership):
+        """Test that customer.subscription.updated writes its status directly."""
+        post_event(client, subscription_event('customer.subscription.updated', 200, status='past_due'))
+
+        mock_retrieve.assert_not_called()
+        assert stored_membership(client)['status'] == 'past_due'
+        with client.application.app_context():
+            assert Membership.query.one().stripe_event_created == 200
+
+    @patch('stripe.Subscription.retrieve')
+    def test_missing_fields_fall_back_to_api(self, mock_retrieve, client, membership):
+        """Test that a $0 invoice, which may be a trial, asks Stripe for the status."""
+        mock_retrieve.return_value = subscription_payload(status='trialing')
+
+        post_event(client, paid_invoice_event(200, amount_paid=0))
+
+        assert mock_retrieve.call_count == 1
+        assert stored_membership(client)['status'] == 'trialing'
+
+    @patch('stripe.Subscription.retrieve')
+    def test_out_of_order_event_falls_back_to_api(self, mock_retrieve, client, membership):
+        """Test that an event older than the applied state is not trusted."""
+        mock_retrieve.return_value = subscription_payload(status='active')
+
+        post_event(client, subscription_event('customer.subscription.updated', 50, status='incomplete'))
+
+        assert mock_retrieve.call_count == 1
+        assert stored_membership(client)['status'] == 'active'
+        with client.application.app_context():
+            assert Membership.query.one().stripe_event_created == 100
+
+    @patch('stripe.Subscription.retrieve')
+    def test_payload_mode_can_be_disabled(self, mock_retrieve, client, membership):
+        """Test that WEBHOOK_STATE_FROM_PAYLOAD=False always reads from Stripe."""
+        mock_retrieve.return_value = subscription_payload()
+        client.application.config['WEBHOOK_STATE_FROM_PAYLOAD'] = False
+        try:
+            post_event(client, paid_invoice_event(200))
+        finally:
+            client.application.config['WEBHOOK_STATE_FROM_PAYLOAD'] = True
+
+        assert mock_retrieve.call_count == 1
+        assert stored_membership(client)['current_period_end'] == datetime.fromtimestamp(1643673600).isoformat()
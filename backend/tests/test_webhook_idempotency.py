@@ -0,0 +1,159 @@
+import pytest
+import json
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from models import db, User, PaymentHistory, ProcessedWebhookEvent, WebhookEvent
+from routes.stripe import webhook_queue
+from services.webhook_idempotency import processed_events
+from test_config import client
+
+def payment_event(user_id, event_id='evt_payment1'):
+    return {
+        'id': event_id,
+        'type': 'payment_intent.succeeded',
+        'data': {
+            'object': {
+                'id': f'pi_{event_id}',
+                'amount': 2999,
+                'currency': 'usd',
+                'status': 'succeeded',
+                'metadata': {'user_id': str(user_id)}
+            }
+        }
+    }
+
+def post_event(client, event):
+    return client.post('/api/stripe/webhook',
+                       data=json.dumps(event),
+                       content_type='application/json')
+
+@pytest.fixture
+def user_id(client):
+    with client.application.app_context():
+        user = User(username='payer', email='payer@example.com', password_hash='hash')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+class TestWebhookIdempotency:
+    """Test that redelivered Stripe events are applied once."""
+
+    def test_redelivery_is_acknowledged_without_work(self, client, user_id):
+        """Test that a repeated event id returns 200 and adds no payment row."""
+        first = post_event(client, payment_event(user_id))
+        second = post_event(client, payment_event(user_id))
+
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert json.loads(second.data)['status'] == 'duplicate'
+        with client.application.app_context():
+            assert PaymentHistory.query.count() == 1
+            assert ProcessedWebhookEvent.query.filter_by(stripe_event_id='evt_payment1').count() == 1
+            assert WebhookEvent.query.count() == 0
+        assert processed_events.stats()['memory_hits'] == 1
+
+    def test_duplicate_detected_from_table(self, client, user_id):
+        """Test that ids recorded by another process are found in the table."""
+        post_event(client, payment_event(user_id))
+        processed_events.clear()
+
+        response = post_event(client, payment_event(user_id))
+
+        assert json.loads(response.data)['status'] == 'duplicate'
+        assert processed_events.stats()['db_hits'] == 1
+        with client.application.app_context():
+            assert PaymentHistory.query.count() == 1
+
+    @patch('stripe.Subscription.retrieve')
+    def test_checkout_redelivery_skips_stripe_call(self, mock_retrieve, client, user_id):
+        """Test that a redelivered checkout event doesn't fetch the subscription again."""
+        mock_retrieve.return_value = {
+            'id': 'sub_test123',
+            'status': 'active',
+            'current_period_start': 1640995200,
+            'current_period_end': 1643673600
+        }
+        event = {
+            'id': 'evt_checkout1',
+            'type': 'checkout.session.completed',
+            'data': {'object': {
+                'id': 'cs_test123',
+                'subscription': 'sub_test123',
+                'metadata': {'user_id': str(user_id), 'plan_id': 'monthly'}
+            }}
+        }
+
+        post_event(client, event)
+        post_event(client, event)
+
+        assert mock_retrieve.call_count == 1
+
+    def test_duplicates_queued_together_apply_once(self, client, user_id):
+        """Test that two queued copies of one event only run the handler once."""
+        app = client.application
+        app.config['WEBHOOK_WORKERS'] = 1
+        try:
+            with patch.object(webhook_queue, '_ensure_workers'):
+                post_event(client, payment_event(user_id))
+                post_event(client, payment_event(user_id))
+            with app.app_context():
+                assert WebhookEvent.query.count() == 2
+                assert webhook_queue.drain() == 2
+                assert PaymentHistory.query.count() == 1
+                assert WebhookEvent.query.count() == 0
+        finally:
+            app.config['WEBHOOK_WORKERS'] = 0
+
+    def test_failed_handler_does_not_record_event(self, client):
+        """Test that a marker is only kept when the handler's changes commit."""
+        with patch('routes.stripe.handle_payment_intent_succeeded', side_effect=Exception('boom')):
+            post_event(client, payment_event(1))
+
+        with client.application.app_context():
+            assert ProcessedWebhookEvent.query.count() == 0
+            assert not processed_events.is_processed('evt_payment1')
+
+    def test_events_without_id_are_always_processed(self, client, user_id):
+        """Test that events missing an id skip deduplication."""
+        event = payment_event(user_id)
+        del event['id']
+
+        post_event(client, event)
+
+        with client.application.app_context():
+            assert PaymentHistory.query.count() == 1
+            assert ProcessedWebhookEvent.query.count() == 0
+
+    def test_prune_removes_expired_markers(self, client):
+        """Test that markers past the retention window are deleted."""
+        with client.application.app_context():
+            db.session.add(ProcessedWebhookEvent(stripe_event_id='evt_old', event_type='invoice.paid',
+                                                 processed_at=datetime.utcnow() - timedelta(days=45)))
+            db.session.add(ProcessedWebhookEvent(stripe_event_id='evt_new', event_type='invoice.paid'))
+            db.session.commit()
+
+        result = client.application.test_cli_runner().invoke(args=['stripe', 'prune-webhook-events'])
+
+        assert result.exit_code == 0
+        assert 'Removed 1' in result.output
+        with client.application.app_context():
+            remaining = [row.stripe_event_id for row in ProcessedWebhookEvent.query.all()]
+            assert remaining == ['evt_new']
+
+    def test_prune_runs_on_interval(self, client, user_id):
+        """Test that recording an event prunes once the interval has elapsed."""
+        app = client.application
+        app.config['WEBHOOK_DEDUP_PRUNE_INTERVAL'] = 0
+        try:
+            with app.app_context():
+                db.session.add(ProcessedWebhookEvent(stripe_event_id='evt_old',
+                                                     processed_at=datetime.utcnow() - timedelta(days=45)))
+                db.session.commit()
+
+            post_event(client, payment_event(user_id))
+
+            with app.app_context():
+                assert ProcessedWebhookEvent.query.filter_by(stripe_event_id='evt_old').count() == 0
+            assert processed_events.stats()['pruned'] == 1
+        finally:
+            app.config['WEBHOOK_DEDUP_PRUNE_INTERVAL'] = 3600
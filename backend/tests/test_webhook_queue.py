@@ -0,0 +1,224 @@
+import pytest
+import json
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from models import db, User, Membership, PaymentHistory, WebhookEvent, WebhookDeadLetter
+from routes.stripe import webhook_queue
+from test_config import client
+
+def payment_event(user_id, payment_id='pi_queue123'):
+    return {
+        'id': f'evt_{payment_id}',
+        'type': 'payment_intent.succeeded',
+        'data': {
+            'object': {
+                'id': payment_id,
+                'amount': 2999,
+                'currency': 'usd',
+                'status': 'succeeded',
+                'metadata': {'user_id': str(user_id)}
+            }
+        }
+    }
+
+def renewal_event():
+    return {
+        'id': 'evt_renewal',
+        'type': 'invoice.payment_succeeded',
+        'data': {'object': {'id': 'in_test', 'subscription': 'sub_test123'}}
+    }
+
+def post_event(client, event):
+    return client.post('/api/stripe/webhook',
+                       data=json.dumps(event),
+                       content_type='application/json')
+
+def make_due(app):
+    """Pull every pending retry forward so the next drain picks it up"""
+    with app.app_context():
+        WebhookEvent.query.update({'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+@pytest.fixture
+def member(client):
+    with client.application.app_context():
+        user = User(username='member', email='member@example.com', password_hash='hash')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(Membership(user_id=user.id, stripe_subscription_id='sub_test123',
+                                  plan_type='monthly', status='active'))
+        db.session.commit()
+        return user.id
+
+class TestWebhookQueue:
+    """Test the durable webhook queue."""
+
+    def test_event_is_processed_and_removed(self, client, member):
+        """Test that an acknowledged event is applied and leaves the queue."""
+        response = post_event(client, payment_event(member))
+
+        assert response.status_code == 200
+        with client.application.app_context():
+            assert PaymentHistory.query.filter_by(stripe_payment_intent_id='pi_queue123').count() == 1
+            assert WebhookEvent.query.count() == 0
+
+    def test_ack_does_not_wait_for_processing(self, client, member):
+        """Test that with workers enabled the endpoint returns before the handler runs."""
+        app = client.application
+        app.config['WEBHOOK_WORKERS'] = 1
+        try:
+            with patch.object(webhook_queue, '_ensure_workers') as mock_workers:
+                response = post_event(client, payment_event(member))
+
+            assert response.status_code == 200
+            mock_workers.assert_called_once()
+            with app.app_context():
+                queued = WebhookEvent.query.one()
+                assert queued.event_type == 'payment_intent.succeeded'
+                assert queued.stripe_event_id == 'evt_pi_queue123'
+                assert PaymentHistory.query.count() == 0
+
+                assert webhook_queue.drain() == 1
+                assert PaymentHistory.query.count() == 1
+        finally:
+            app.config['WEBHOOK_WORKERS'] = 0
+
+    @patch('stripe.Subscription.retrieve')
+    def test_failure_is_retried_with_backoff(self, mock_retrieve, client, member):
+        """Test that a failing handler schedules a later retry and then succeeds."""
+        mock_retrieve.side_effect = [Exception('Stripe unavailable'), {
+            'id': 'sub_test123',
+            'status': 'past_due',
+            'current_period_start': 1640995200,
+            'current_period_end': 1643673600
+        }]
+        app = client.application
+
+        response = post_event(client, renewal_event())
+
+        assert response.status_code == 200
+        with app.app_context():
+            queued = WebhookEvent.query.one()
+            assert queued.attempts == 1
+            assert 'Stripe unavailable' in queued.last_error
+            assert queued.locked_until is None
+            delay = (queued.next_attempt_at - datetime.utcnow()).total_seconds()
+            base = app.config['WEBHOOK_RETRY_BASE_DELAY']
+            assert 0 < delay <= base
+            # Not due yet, so nothing is picked up
+            assert webhook_queue.drain() == 0
+
+        make_due(app)
+        with app.app_context():
+            assert webhook_queue.drain() == 1
+            assert WebhookEvent.query.count() == 0
+            membership = Membership.query.filter_by(stripe_subscription_id='sub_test123').first()
+            assert membership.status == 'past_due'
+
+    @patch('stripe.Subscription.retrieve')
+    def test_dead_letter_after_max_attempts(self, mock_retrieve, client, member):
+        """Test that an event failing every attempt is parked in the dead-letter table."""
+        mock_retrieve.side_effect = Exception('Stripe unavailable')
+        app = client.application
+        max_attempts = app.config['WEBHOOK_MAX_ATTEMPTS']
+
+        post_event(client, renewal_event())
+        for _ in range(max_attempts - 1):
+            make_due(app)
+            with app.app_context():
+                webhook_queue.drain()
+
+        with app.app_context():
+            assert WebhookEvent.query.count() == 0
+            dead = WebhookDeadLetter.query.one()
+            assert dead.stripe_event_id == 'evt_renewal'
+            assert dead.event_type == 'invoice.payment_succeeded'
+            assert dead.attempts == max_attempts
+            assert json.loads(dead.payload) == renewal_event()
+        assert mock_retrieve.call_count == max_attempts
+
+    def test_leased_event_is_not_claimed_twice(self, client):
+        """Test that an event leased by one worker is skipped until the lease expires."""
+        app = client.application
+        with app.app_context():
+            db.session.add(WebhookEvent(event_type='unsupported.event', payload='{}',
+                                        locked_until=datetime.utcnow() + timedelta(minutes=5)))
+            db.session.commit()
+            assert webhook_queue.drain() == 0
+
+            WebhookEvent.query.update({'locked_until': datetime.utcnow() - timedelta(seconds=1)})
+            db.session.commit()
+            assert webhook_queue.drain() == 1
+            assert WebhookEvent.query.count() == 0
+
+    def test_metrics_report_depth_and_lag(self, client):
+        """Test that queue depth and lag are exposed on the metrics endpoint."""
+        with client.application.app_context():
+            db.session.add(WebhookEvent(event_type='unsupported.event', payload='{}',
+                                        created_at=datetime.utcnow() - timedelta(seconds=30),
+                                        next_attempt_at=datetime.utcnow() + timedelta(minutes=5)))
+            db.session.commit()
+
+        response = client.get('/api/metrics')
+
+        stats = json.loads(response.data)['webhook_queue']
+        assert stats['depth'] == 1
+        assert stats['lag_seconds'] >= 30
+        assert stats['dead_letters'] == 0
+
+    def test_worker_threads_process_events(self, client, member):
+        """Test that background workers drain the queue without a request."""
+        app = client.application
+        app.config['WEBHOOK_WORKERS'] = 1
+        app.config['WEBHOOK_POLL_INTERVAL'] = 0.05
+        try:
+            post_event(client, payment_event(member))
+            deadline = time.monotonic() + 5
+            with app.app_context():
+                while WebhookEvent.query.count() and time.monotonic() < deadline:
+                    db.session.remove()
+                    time.sleep(0.05)
+                assert WebhookEvent.query.count() == 0
+                assert PaymentHistory.query.count() == 1
+        finally:
+            webhook_queue.stop()
+            app.config['WEBHOOK_WORKERS'] = 0
+            app.config['WEBHOOK_POLL_INTERVAL'] = 1
+
+    def test_stored_backlog_is_processed_by_command(self, client, member):
+        """Test that events stored before a restart can be drained without a new webhook."""
+        with client.application.app_context():
+            db.session.add(WebhookEvent(stripe_event_id='evt_pi_queue123', event_type='payment_intent.succeeded',
+                                        payload=json.dumps(payment_event(member))))
+            db.session.commit()
+
+        result = client.application.test_cli_runner().invoke(args=['stripe', 'process-webhooks'])
+
+        assert 'Processed 1 webhook events' in result.output
+        with client.application.app_context():
+            assert WebhookEvent.query.count() == 0
+            assert PaymentHistory.query.count() == 1
+
+    def test_any_request_starts_workers(self, client, member):
+        """Test that a process picks up stored events after a restart without receiving a webhook."""
+        app = client.application
+        with app.app_context():
+            db.session.add(WebhookEvent(stripe_event_id='evt_pi_queue123', event_type='payment_intent.succeeded',
+                                        payload=json.dumps(payment_event(member))))
+            db.session.commit()
+        app.config['WEBHOOK_WORKERS'] = 1
+        app.config['WEBHOOK_POLL_INTERVAL'] = 0.05
+        try:
+            assert client.get('/api/health').status_code == 200
+            deadline = time.monotonic() + 5
+            with app.app_context():
+                while WebhookEvent.query.count() and time.monotonic() < deadline:
+                    db.session.remove()
+                    time.sleep(0.05)
+                assert WebhookEvent.query.count() == 0
+                assert PaymentHistory.query.count() == 1
+        finally:
+            webhook_queue.stop()
+            app.config['WEBHOOK_WORKERS'] = 0
+            app.config['WEBHOOK_POLL_INTERVAL'] = 1
@@ -216,7 +216,7 @@ const Profile: React.FC<ProfileProps> = ({ user, setUser }) => {
                   >
                     {user.profile_picture ? (
                       <img 
-                        src={profileService.getProfilePictureUrl(user.profile_picture) || ''}
+                        src={profileService.getProfilePictureUrl(user.profile_picture, 256) || ''}
                         alt="Profile"
                         style={{
                           width: '100%',
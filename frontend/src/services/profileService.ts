@@ -20,10 +20,11 @@ export const profileService = {
     return response.json();
   },
 
-  // Get profile picture URL
-  getProfilePictureUrl(filename: string | undefined): string | null {
+  // Get profile picture URL, optionally for a resized variant at least `size` pixels wide
+  getProfilePictureUrl(filename: string | undefined, size?: number): string | null {
     if (!filename) return null;
-    return `${API_BASE}/profile-picture/${filename}`;
+    const url = `${API_BASE}/profile-picture/${filename}`;
+    return size ? `${url}?size=${size}` : url;
   },
 
   // Delete profile picture